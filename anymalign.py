@@ -29,16 +29,37 @@ import sys
 import optparse
 from time import time
 
+import json
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
 import bz2
 import gzip
+import zlib
+import threading
+from Queue import Queue
+from collections import deque, namedtuple, OrderedDict
 from xml.sax.saxutils import escape
 from tempfile import NamedTemporaryFile
+import shutil
 
 import math
+import mmap
+from hashlib import md5
+import struct
 import random
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 from array import array
 from operator import mul
-from bisect import bisect_left
+from itertools import chain, izip
+from bisect import bisect_left, bisect_right
+from heapq import merge as merge_sorted, nlargest
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __version__ = '2.5 (May 4th 2011)'
@@ -46,13 +67,89 @@ __author__ = 'Adrien Lardilleux <Adrien.Lardilleux@limsi.fr>'
 __scriptName__ = 'anymalign'
 __verbose__ = False
 __tmpDir__ = None
+__jobs__ = 1
+__pipelineWriter__ = None   # Writer inherited by formatting processes
+__sharedOffsets__ = None    # Offsets array inherited by indexing processes
+__subcorpusAligner__ = None # Aligner inherited by subcorpus processes
+__subcorpusStop__ = None    # Event set on ctrl-c: skip subcorpora left
+__coocSources__ = None      # Corpus inherited by cooccurrence processes
 
 MAX_SUBCORPUS_SIZE = 100000
+CONVERGENCE_CHECK_INTERVAL = 10 # Minimum seconds between convergence checks
+ADAPTIVE_EXPLORATION = 0.5      # Share of -t spent evenly with --adaptive
+COVERAGE_MIX = 0.5              # Share of coverage-driven line sampling
+IMPORTANCE_WEIGHT_UNIT = 16     # Frequency unit with importance weights
+MEMORY_PILOT_LINES = 1000       # Sample size for --memory-limit estimates
+MEMORY_PILOT_TIME = 1.          # Seconds spent aligning the pilot sample
+MEMORY_SAFETY = 0.8             # Share of memory left given to a subcorpus
+MEMORY_MIN_LINES = 100          # Smallest subcorpus with --memory-limit
+DIGEST_SIZE = 16                # Bytes of a line digest (MD5), with -u
+LINE_BYTES = 200                # Approximate memory per line (lists)
+TOKEN_BYTES = 24                # Approximate memory per token or n-gram
+TYPE_BYTES = 250                # Approximate memory per distinct word
+ALIGNMENT_BYTES = 120           # Approximate memory per counted alignment
+STATE_FILENAME = "state.json"   # Description of input files with --state
+STATE_CHECK_SIZE = 4096         # Bytes checked unchanged at end of inputs
+SIGNATURE_MIN_LINES = 1000      # Smallest subcorpus grouped by signatures
+ALIGN_BATCH_LINES = 256         # Lines of small subcorpora aligned at once
+NUMPY_MIN_LINES = 32            # Smallest subcorpus aligned with NumPy
+NUMPY_CHUNK_TOKENS = 1 << 18    # Tokens of (group, line) rows masked at once
+OUTPUT_BLOCK_SIZE = 4 << 20     # Bytes buffered before writing/compressing
+INDEX_CHUNK_SIZE = 64 << 20     # Bytes of input indexed at once by a process
+OUTPUT_BATCH_SIZE = 2000        # Alignments per formatting job
+SORT_MAX_RUNS = 64              # Sorted runs merged at once
+INDEX_SORT_ENTRIES = 1 << 20    # Phrases sorted in memory at once (--index)
+COOC_BUFFER_PAIRS = 1 << 19     # Word pairs counted in memory at once
+COOC_CACHE_WORDS = 1 << 16      # Word ids cached by a cooccurrence store
+COOC_PARALLEL_WORDS = 4096      # Fewer source words are counted in-process
+COOC_SHARDS_PER_JOB = 4         # Shards of source words per process (-j)
+SWEEP_TAG = '\x0b%i'            # Configuration tag (never in a word)
+INDEX_MAGIC = "AMINDEX1"
+INDEX_HEADER = struct.Struct('<8sIQ')   # Magic, languages, alignments
+INDEX_TABLE = struct.Struct('<QQ')      # Table position, number of entries
+COOC_MAGIC = "AMCOOC02"
+COOC_HEADER = struct.Struct('<8sIQQQQQQQQ') # Magic, languages, lines,
+                                            # input size and time, words,
+                                            # pairs, freqs, keys and counts
+                                            # positions
+COOC_ENTRY = struct.Struct('<QI')       # Word position, word id
 
 ###############################################################################
 # Utility functions
 ###############################################################################
 
+# An alignment as output by set_proba(). <phrases> is a tuple of strings (1
+# per language), <lexWeights> a tuple of floats (None if not computed),
+# <probas> a tuple of floats (1 per language), <freq> an integer.
+AlignmentRecord = namedtuple('AlignmentRecord',
+                             'phrases lexWeights probas freq')
+
+# Filters of one table of a sweep (see Aligner.set_sweep()), with the same
+# meaning as the arguments of Aligner.set_parameters().
+FilterConfig = namedtuple('FilterConfig',
+                          'discontiguousFields minLanguages minSize maxSize')
+
+def parse_alignment(line):
+    """Return an AlignmentRecord from a line in plain output format.
+
+    -- line: str
+
+    >>> parse_alignment("a b\\tc\\t-\\t1.000000 0.500000\\t3\\n")
+    ...                                   # doctest: +NORMALIZE_WHITESPACE
+    AlignmentRecord(phrases=('a b', 'c'), lexWeights=None,
+                    probas=(1.0, 0.5), freq=3)
+
+    """
+    fields = line.rstrip('\n').split('\t')
+    freq = int(fields.pop())
+    probas = tuple([float(p) for p in fields.pop().split()])
+    lexWeights = fields.pop()
+    try:
+        lexWeights = tuple([float(lw) for lw in lexWeights.split()])
+    except ValueError:
+        lexWeights = None
+    return AlignmentRecord(tuple(fields), lexWeights, probas, freq)
+
 def parse_field_numbers(fields, maxFields):
     """Get a set of integers from a command line option.
 
@@ -95,6 +192,61 @@ def parse_field_numbers(fields, maxFields):
             selection.update(xrange(start, end + 1))
     return selection
 
+def parse_pairs(pairs):
+    """Get a list of language pairs from a command line option.
+
+    -- pairs: str
+
+    <pairs> is a comma-separated list of pairs of field numbers (1-based)
+    joined by a dash, or "all" for all pairs of languages. A list of pairs
+    of 0-based language numbers is returned, None for "all". Raise
+    ValueError if <pairs> is not well formed.
+
+    >>> parse_pairs("1-2,3-1")
+    [(0, 1), (2, 0)]
+    >>> parse_pairs("all") is None
+    True
+
+    """
+    if pairs == "all":
+        return None
+    selection = []
+    for pair in pairs.split(','):
+        source, target = [int(f) - 1 for f in pair.split('-')]
+        if source == target or min(source, target) < 0:
+            raise ValueError
+        selection.append((source, target))
+    return selection
+
+def parse_sweep(sweep):
+    """Get filter configurations from a command line option.
+
+    -- sweep: str
+
+    <sweep> is a semicolon-separated list of configurations, each made of
+    filtering options -D, -l, -n and -N followed by their values. A list of
+    dicts is returned, one per configuration, mapping option letters to
+    values (str). Raise ValueError if <sweep> is not well formed, or has
+    an empty configuration (e.g. a trailing semicolon).
+
+    >>> [sorted(c.items()) for c in parse_sweep("-N 3; -n 2 -D 1,3")]
+    [[('N', '3')], [('D', '1,3'), ('n', '2')]]
+
+    """
+    configs = []
+    for config in sweep.split(';'):
+        tokens = config.split()
+        if not tokens or len(tokens) % 2:
+            raise ValueError
+        options = {}
+        for option, value in zip(tokens[::2], tokens[1::2]):
+            if option not in ('-D', '-l', '-n', '-N') or \
+               option[1] in options:
+                raise ValueError
+            options[option[1]] = value
+        configs.append(options)
+    return configs
+
 
 
 def make_temp_file(suf=''):
@@ -125,6 +277,74 @@ def open_compressed(filename):
         return bz2.BZ2File(filename, 'r')
     else:
         return open(filename, 'rb')
+
+def open_output(filename, nbThreads=1):
+    """Open a file for writing, based on its name.
+
+    -- filename: str
+    -- nbThreads: int
+
+    Return a BlockCompressor writing into <filename>, compressed with gzip or
+    bzip2 if its name ends with .gz or .bz2. gzip blocks are compressed by
+    <nbThreads> background threads. bzip2 output is a single stream,
+    compressed by one background thread, since Python 2's bz2 module (see
+    open_compressed()) only reads the first of concatenated streams.
+
+    """
+    if filename.endswith('.gz'):
+        return BlockCompressor(open(filename, 'wb'), gzip_block, nbThreads)
+    elif filename.endswith('.bz2'):
+        compressor = bz2.BZ2Compressor()
+        return BlockCompressor(open(filename, 'wb'), compressor.compress, 1,
+                               compressor.flush)
+    else:
+        return BlockCompressor(open(filename, 'wb'))
+
+def shard_filenames(filename, nbShards):
+    """Return the names of the files an output is split into.
+
+    -- filename: str
+    -- nbShards: int
+
+    Shard numbers are inserted before the compression extension, if any.
+
+    >>> shard_filenames("table.txt.gz", 3)
+    ['table.txt.0.gz', 'table.txt.1.gz', 'table.txt.2.gz']
+
+    """
+    width = len(str(nbShards - 1))
+    return suffixed_filenames(filename, ["%0*i" % (width, i)
+                                         for i in xrange(nbShards)])
+
+def suffixed_filenames(filename, suffixes):
+    """Return names derived from an output file name.
+
+    -- filename: str
+    -- suffixes: list(str)
+
+    Each suffix is inserted, after a dot, before the compression extension
+    if any.
+
+    >>> suffixed_filenames("table.gz", ["en-fr", "en-de"])
+    ['table.en-fr.gz', 'table.en-de.gz']
+
+    """
+    base, ext = filename, ''
+    for compression in ('.gz', '.bz2'):
+        if filename.endswith(compression):
+            base, ext = filename[:-len(compression)], compression
+    return ["%s.%s%s" % (base, suffix, ext) for suffix in suffixes]
+
+def gzip_block(data):
+    """Compress a string into a standalone gzip member.
+
+    -- data: str
+
+    Concatenated gzip members form a valid gzip file.
+    
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
     
 
 def message(msg, out=sys.stderr):
@@ -158,15 +378,68 @@ def optimum_array(initialList, maxi=None):
     """
     if maxi is None:
         maxi = max(initialList)
+    typecode = optimum_typecode(maxi)
+    if typecode is None:
+        return tuple(initialList)
+    return array(typecode, initialList)
+
+def optimum_typecode(maxi):
+    """Return the smallest array.array typecode that can hold an integer.
+
+    -- maxi: int
+
+    None is returned if no typecode fits.
+
+    >>> optimum_typecode(256)
+    'H'
+
+    """
     for typecode in "BHiIlL":
         try:
             array(typecode, [maxi])
         except OverflowError:
             pass
         else:
-            return array(typecode, initialList)
-    return tuple(initialList)
+            return typecode
+    return None
+
+def current_rss():
+    """Return the resident set size of the current process, in bytes.
+
+    Read from /proc where available. Otherwise, the peak resident set size
+    is returned instead (resource module), which never decreases.
+
+    """
+    try:
+        statm = open("/proc/self/statm")
+        try:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            statm.close()
+    except (IOError, OSError, ValueError, IndexError):
+        import resource
+        maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':    # Bytes on Mac OS, kilobytes elsewhere
+            return maxRss
+        return maxRss << 10
+
+
+def cooc_arrays(cooc):
+    """Return cooccurrence counts as stored by CoocDB.
 
+    -- cooc: dict(int:int)
+        Mapping between target word ids (keys) and frequencies (values).
+
+    Return a tuple (target word ids, frequencies), as arrays in ascending
+    order of target words.
+
+    >>> cooc_arrays({4:5, 3:2})
+    (array('B', [3, 4]), array('B', [2, 5]))
+
+    """
+    targets = sorted(cooc)
+    return (optimum_array(targets, targets[-1]),
+            optimum_array([cooc[tw] for tw in targets]))
 
 class CoocDB:
     """Container for word cooccurrence counts.
@@ -212,9 +485,18 @@ class CoocDB:
         -- cooc: dict(int:int)
             Mapping between target word ids (keys) and frequencies (values).
         """
-        targets = sorted(cooc)
-        self.pairs[sourceWord] = optimum_array(targets, targets[-1])
-        self.freqs[sourceWord] = optimum_array([cooc[tw] for tw in targets])
+        self.set(sourceWord, *cooc_arrays(cooc))
+
+    def set(self, sourceWord, pairs, freqs):
+        """Add cooccurrence counts already arranged by cooc_arrays().
+
+        -- sourceWord: int
+            The source word id.
+        -- pairs: array.array
+        -- freqs: array.array
+        """
+        self.pairs[sourceWord] = pairs
+        self.freqs[sourceWord] = freqs
     
     def get(self, sourceWord, targetWord):
         """Retrieve cooccurrence count between a source and a target word.
@@ -304,6 +586,471 @@ class Distribution:
         return self.start + i    # We should never reach this line
 
 
+class ConvergenceMonitor:
+    """Measure how much the most frequent alignments change over time.
+
+    -- self.topK: int
+        Number of most frequent alignments compared.
+    -- self.snapshot: dict((int, int): float)
+        Relative frequencies of the self.topK most frequent alignments at
+        last check, keyed by (alignment length, alignment hash).
+    -- self.nextCheck: float
+        Time before which no check is needed.
+    -- self.distance: float
+        Result of last comparison (None before the second check).
+
+    The distance between two checks is the total variation distance
+    between the distributions of the top-K alignment frequencies, each
+    normalized over its own top-K. It is 0 when both the ranking of the
+    most frequent alignments and their relative frequencies are stable.
+    Each check costs a pass over all counts, so checks are spaced by at
+    least CONVERGENCE_CHECK_INTERVAL seconds, and by at least 20 times the
+    duration of the previous check (at most 5% of alignment time).
+    """
+
+    def __init__(self, topK):
+        """Initializer.
+
+        -- topK: int
+            = self.topK
+        """
+        self.topK = topK
+        self.snapshot = None
+        self.nextCheck = time() + CONVERGENCE_CHECK_INTERVAL
+        self.distance = None
+
+    def check(self, counts, now):
+        """Compare current top alignments to the previous ones, if due.
+
+        -- counts: dict(int: dict(int: int))
+            Absolute frequencies of alignments (see set_proba()).
+        -- now: float
+            Current time.
+
+        Return the new distance, or None if no comparison was made.
+        """
+        if now < self.nextCheck:
+            return None
+        top = nlargest(self.topK, ((freq, (alLength, alHash))
+                                   for alLength, c in counts.iteritems()
+                                   for alHash, freq in c.iteritems()))
+        total = 1. * sum([freq for freq, _ in top]) or 1.
+        snapshot = dict([(key, freq / total) for freq, key in top])
+        previous, self.snapshot = self.snapshot, snapshot
+        checkEnd = time()
+        self.nextCheck = checkEnd + max(CONVERGENCE_CHECK_INTERVAL,
+                                        20 * (checkEnd - now))
+        if previous is None:
+            return None
+        distance = 0.
+        for key, relFreq in snapshot.iteritems():
+            distance += abs(relFreq - previous.get(key, 0.))
+        for key, relFreq in previous.iteritems():
+            if key not in snapshot:
+                distance += relFreq
+        self.distance = distance / 2
+        return self.distance
+
+
+class CoverageSampler:
+    """Sample subcorpora, favouring lines with poorly covered words.
+
+    -- self.corpus: list(list(int))
+        See Aligner.corpus.
+    -- self.coverage: array.array('L')
+        For each word id, number of distinct alignments found so far that
+        contain it (maintained by Aligner.align()).
+    -- self.probas: array.array('d')
+        For each line, probability of being chosen as seed line.
+    -- self.cumulative: array.array('d')
+        Cumulative sums of self.probas.
+    -- self.nextUpdate: float
+        Time before which self.probas need not be updated.
+
+    A subcorpus of size k is drawn by choosing a seed line l with
+    probability q(l), then k - 1 other lines uniformly. The probability of
+    drawing a given set S of lines is thus sum(q(l), l in S) / C(n-1, k-1),
+    instead of 1 / C(n, k) with uniform sampling, so alignments from S have
+    to be counted with importance weight (k / n) / sum(q(l), l in S) to
+    keep frequencies unbiased. q mixes the uniform distribution (share 1 -
+    COVERAGE_MIX, which bounds weights by 1 / (1 - COVERAGE_MIX)) and a
+    distribution proportional to the rarity of the least covered word of
+    each line, 1 / (1 + coverage).
+    """
+
+    def __init__(self, corpus, nbWords):
+        """Initializer.
+
+        -- corpus: list(list(int))
+            = self.corpus
+        -- nbWords: int
+            Size of vocabulary.
+        """
+        self.corpus = corpus
+        self.coverage = array('L', [0]) * nbWords
+        self.probas = self.cumulative = None
+        self.nextUpdate = 0
+        self.update()
+
+    def update(self):
+        """Recompute seed line probabilities from current coverage."""
+        startTime = time()
+        coverage = self.coverage
+        rarity = [max([1. / (1 + coverage[word]) for word in line] or [0.])
+                  for line in self.corpus]
+        nbLines = len(rarity)
+        totalRarity = sum(rarity)
+        uniform = (1. - COVERAGE_MIX) / nbLines
+        if totalRarity:
+            fact = COVERAGE_MIX / totalRarity
+        else:
+            uniform, fact = 1. / nbLines, 0.
+        self.probas = array('d', [uniform + fact * r for r in rarity])
+        s = 0.
+        for i in xrange(nbLines):    # Reuse list for cumulative sums
+            s += self.probas[i]
+            rarity[i] = s
+        self.cumulative = array('d', rarity)
+        # Do not spend more than 10% of the time updating
+        self.nextUpdate = time() + max(1, 10 * (time() - startTime))
+
+    def sample(self, size):
+        """Return a new subcorpus and its importance weight.
+
+        -- size: int
+            Number of lines to draw.
+
+        Return a tuple (list of line ids, float weight).
+        """
+        if time() >= self.nextUpdate:
+            self.update()
+        nbLines = len(self.probas)
+        seed = min(bisect_right(self.cumulative,
+                                random.random() * self.cumulative[-1]),
+                   nbLines - 1)
+        lineIds = [seed]
+        for lineId in random.sample(xrange(nbLines - 1), size - 1):
+            if lineId >= seed:
+                lineId += 1
+            lineIds.append(lineId)
+        probas = self.probas
+        return lineIds, (1. * size / nbLines) / sum([probas[lineId]
+                                                     for lineId in lineIds])
+
+
+class MemoryModel:
+    """Predict the memory needed to align a subcorpus of a given size.
+
+    -- self.limit: int
+        Bytes the whole process may use.
+    -- self.lineBytes: float
+        Memory per line: tokens, and n-grams with -i.
+    -- self.vocabK: float
+    -- self.vocabBeta: float
+        Parameters of Heaps' law, V(n) = K * n^beta, giving the number of
+        distinct words and n-grams in n lines.
+    -- self.alignmentsPerLine: float
+        New alignments per line found in self.pilotTime seconds.
+    -- self.pilotTime: float
+        Alignment time of the pilot sample.
+    -- self.factor: float
+        Ratio of observed to predicted memory (see update()).
+
+    The prediction for n lines aligned during t seconds is
+    n * lineBytes + V(n) * TYPE_BYTES + A * ALIGNMENT_BYTES, where the
+    number A of new entries in Aligner.counts is
+    n * alignmentsPerLine * sqrt(t / pilotTime): new alignments come
+    slower and slower. This is only a rough guess, corrected by
+    self.factor as actual resident set sizes are observed.
+    """
+
+    def __init__(self, limit, lineBytes, vocabK, vocabBeta,
+                 alignmentsPerLine, pilotTime):
+        """Initializer.
+
+        -- limit: int
+            = self.limit
+        -- lineBytes: float
+            = self.lineBytes
+        -- vocabK: float
+            = self.vocabK
+        -- vocabBeta: float
+            = self.vocabBeta
+        -- alignmentsPerLine: float
+            = self.alignmentsPerLine
+        -- pilotTime: float
+            = self.pilotTime
+        """
+        self.limit = limit
+        self.lineBytes = lineBytes
+        self.vocabK = vocabK
+        self.vocabBeta = vocabBeta
+        self.alignmentsPerLine = alignmentsPerLine
+        self.pilotTime = max(pilotTime, 1e-3)
+        self.factor = 1.
+
+    def estimate(self, nbLines, timeout):
+        """Return the predicted number of bytes for a subcorpus.
+
+        -- nbLines: int
+            Size of subcorpus.
+        -- timeout: float
+            Alignment time of subcorpus (None if unknown).
+        """
+        if timeout is None:
+            timeout = MEMORY_PILOT_TIME * 100
+        nbTypes = self.vocabK * nbLines ** self.vocabBeta
+        nbAlignments = nbLines * self.alignmentsPerLine * \
+                       math.sqrt(max(timeout / self.pilotTime, 1.))
+        return self.factor * (nbLines * self.lineBytes +
+                              nbTypes * TYPE_BYTES +
+                              nbAlignments * ALIGNMENT_BYTES)
+
+    def size_for(self, maxLines, timeout, totalLines):
+        """Return the largest subcorpus size that fits in memory left.
+
+        -- maxLines: int
+            Number of lines left to align.
+        -- timeout: float
+            Time left to align them (None if unlimited).
+        -- totalLines: int
+            Number of lines <timeout> is shared among.
+
+        At least MEMORY_MIN_LINES (or <maxLines> if less) is returned,
+        even if nothing fits: subcorpora of a few lines would take forever
+        and find almost nothing.
+        """
+        budget = MEMORY_SAFETY * (self.limit - current_rss())
+
+        def share(nbLines):
+            if timeout is None:
+                return None
+            return timeout * nbLines / totalLines
+
+        low, high = min(MEMORY_MIN_LINES, maxLines), maxLines
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.estimate(middle, share(middle)) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def update(self, nbLines, timeout, observed):
+        """Correct predictions after aligning a subcorpus.
+
+        -- nbLines: int
+            Size of subcorpus.
+        -- timeout: float
+            Its alignment time.
+        -- observed: int
+            Increase of resident set size while loading and aligning it.
+
+        Overestimations are forgotten slowly, underestimations at once.
+        """
+        if observed <= 0:   # Memory reused from previous subcorpora
+            return
+        ratio = self.factor * observed / self.estimate(nbLines, timeout)
+        if ratio > self.factor:
+            self.factor = ratio
+        else:
+            self.factor = (self.factor + ratio) / 2
+
+
+###############################################################################
+# Output sinks
+###############################################################################
+
+class CompressedBlock:
+    """A block of output waiting for compression.
+
+    -- self.data: str
+        Uncompressed data (None once compressed).
+    -- self.result: str
+        Compressed data, available once self.done is set.
+    -- self.done: threading.Event
+    """
+
+    def __init__(self, data):
+        """Initializer.
+
+        -- data: str
+            = self.data
+        """
+        self.data = data
+        self.result = None
+        self.done = threading.Event()
+
+
+class BlockCompressor:
+    """File-like object writing output by large blocks.
+
+    -- self.outputFile: file
+        Where (compressed) data is eventually written.
+    -- self.compress: function
+        1-argument function compressing a string, or None to write blocks
+        as they are.
+    -- self.finish: function
+        0-argument function returning the end of the compressed data, or
+        None. Used by a stateful self.compress (one thread only).
+    -- self.buffer: list(str)
+        Data written since the last block was submitted.
+    -- self.bufferSize: int
+        Total length of strings in self.buffer.
+    -- self.pending: deque(CompressedBlock)
+        Submitted blocks, in output order, not yet written.
+    -- self.tasks: Queue(CompressedBlock)
+        Blocks to be compressed by background threads.
+    -- self.threads: list(threading.Thread)
+    -- self.name: str
+        Name of self.outputFile.
+
+    Data is accumulated until OUTPUT_BLOCK_SIZE bytes are available. The
+    block is then compressed independently in a background thread, and
+    compressed blocks are written in order. gzip accepts concatenated
+    compressed streams.
+    """
+
+    def __init__(self, outputFile, compress=None, nbThreads=1, finish=None):
+        """Initializer.
+
+        -- outputFile: file
+            = self.outputFile
+        -- compress: function
+            = self.compress
+        -- nbThreads: int
+            Number of compression threads.
+        -- finish: function
+            = self.finish
+        """
+        self.outputFile = outputFile
+        self.name = outputFile.name
+        self.compress = compress
+        self.finish = finish
+        self.buffer = []
+        self.bufferSize = 0
+        self.pending = deque()
+        self.tasks = Queue()
+        self.threads = []
+        if compress is not None:
+            for _ in xrange(max(nbThreads, 1)):
+                thread = threading.Thread(target=self._compress_blocks)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _compress_blocks(self):
+        """Compress submitted blocks until None is received (thread)."""
+        while True:
+            block = self.tasks.get()
+            if block is None:
+                return
+            block.result = self.compress(block.data)
+            block.data = None
+            block.done.set()
+
+    def _submit(self):
+        """Send buffered data to compression."""
+        if not self.bufferSize:
+            return
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.bufferSize = 0
+        if self.compress is None:
+            self.outputFile.write(data)
+            return
+        block = CompressedBlock(data)
+        self.pending.append(block)
+        self.tasks.put(block)
+        # Bound memory: do not keep more than 2 blocks per thread in flight
+        while len(self.pending) > 2 * len(self.threads):
+            self._write_next()
+
+    def _write_next(self):
+        """Write the oldest pending block, waiting for its compression."""
+        block = self.pending.popleft()
+        block.done.wait()
+        self.outputFile.write(block.result)
+
+    def write(self, data):
+        """Buffer new data.
+
+        -- data: str
+        """
+        self.buffer.append(data)
+        self.bufferSize += len(data)
+        if self.bufferSize >= OUTPUT_BLOCK_SIZE:
+            self._submit()
+
+    def flush(self):
+        """Compress and write everything buffered so far."""
+        self._submit()
+        while self.pending:
+            self._write_next()
+        self.outputFile.flush()
+
+    def close(self):
+        """Flush, stop compression threads and close output file."""
+        try:
+            self.flush()
+            if self.finish is not None:
+                self.outputFile.write(self.finish())
+                self.finish = None
+        finally:
+            for _ in self.threads:
+                self.tasks.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+            self.outputFile.close()
+
+
+class ShardedOutput:
+    """File-like object dealing written lines to several files in turn.
+
+    -- self.outputFiles: list(file)
+    -- self.next: int
+        Index in self.outputFiles of the file the next line goes to.
+
+    Each call to write() must consist of whole lines, so that every shard
+    is a valid output file on its own. Lines are dealt one at a time, even
+    when a whole batch of alignments is written at once, so that shards
+    have the same size and remain sorted by decreasing frequency (one
+    alignment per line, see the plain and Moses formats).
+    """
+
+    def __init__(self, outputFiles):
+        """Initializer.
+
+        -- outputFiles: list(file)
+            = self.outputFiles
+        """
+        self.outputFiles = outputFiles
+        self.next = 0
+
+    def write(self, data):
+        """Deal lines of data into the shards, starting with the next one.
+
+        -- data: str
+        """
+        lines = data.splitlines(True)
+        nbShards = len(self.outputFiles)
+        for i in xrange(min(nbShards, len(lines))):
+            self.outputFiles[(self.next + i) % nbShards].write(
+                ''.join(lines[i::nbShards]))
+        self.next = (self.next + len(lines)) % nbShards
+
+    def flush(self):
+        """Flush all shards."""
+        for f in self.outputFiles:
+            f.flush()
+
+    def close(self):
+        """Close all shards."""
+        for f in self.outputFiles:
+            f.close()
+
+
 ###############################################################################
 # Output formatters
 ###############################################################################
@@ -324,12 +1071,37 @@ class PlainWriter:
         self.outputFile = outputFile
     
     def write(self, line):
-        """Write new alignment as it is (do not modify anything).
+        """Write new alignment.
 
         -- line: str
             The alignment to be written.
         """
-        self.outputFile.write(line)
+        self.outputFile.write(self.format(line))
+
+    def format(self, line):
+        """Return new alignment as it is (do not modify anything).
+
+        -- line: str
+            The alignment to be formatted.
+        """
+        return line
+
+    def write_formatted(self, text):
+        """Write alignments already formatted by self.format().
+
+        -- text: str
+        """
+        self.outputFile.write(text)
+
+    def set_position(self, alNo):
+        """Tell the writer how many alignments precede the next one.
+
+        -- alNo: int
+
+        Only needed when alignments are formatted out of order (see
+        write_alignments()).
+        """
+        pass
     
     def terminate(self):
         """Terminates writing."""
@@ -339,11 +1111,11 @@ class PlainWriter:
 class MosesWriter(PlainWriter):
     """Output alignments in a format suitable for the Moses decoder."""
     
-    def write(self, line):
-        """Write new alignment.
+    def format(self, line):
+        """Return new alignment formatted.
 
         -- line: str
-            The alignment to be written.
+            The alignment to be formatted.
 
         - Replace tabs between languages by " ||| ";
         - scores are separated by spaces, in a single field;
@@ -358,12 +1130,11 @@ class MosesWriter(PlainWriter):
             lexWeights = ""
         else:
             lexWeights = " " + lexWeights
-        self.outputFile.write("%s |||%s %s 2.718\n" %
-                              (alignment.replace('\t', ' ||| '),
-                               lexWeights, probas))
+        return "%s |||%s %s 2.718\n" % (alignment.replace('\t', ' ||| '),
+                                        lexWeights, probas)
 
 
-class HTMLWriter:
+class HTMLWriter(PlainWriter):
     """Output alignments in XHTML.
 
     -- self.outputFile: file
@@ -415,11 +1186,11 @@ class HTMLWriter:
      inputEncoding, inputEncoding,
      "".join([" <th>%s</th>\n" % l for l in langList])))
 
-    def write(self, line):
-        """Write new alignment.
+    def format(self, line):
+        """Return new alignment formatted.
 
         -- line: str
-            The alignment to be written.
+            The alignment to be formatted.
 
         - Alignment is wrapped in a table row;
         - scores are displayed first, preceded by alignment counter.
@@ -439,8 +1210,7 @@ class HTMLWriter:
             self.maxFreq = math.log(freq)
         red = 255. * (1. - math.log(freq) / self.maxFreq)
         green = 255 * (1 - reduce(mul, probas, 1.) ** (1./len(probas)))
-        self.outputFile.write(
-            """<tr>\n <td class="n">%i</td>
+        text = """<tr>\n <td class="n">%i</td>
  <td class="n" style="background-color:rgb(255,%i,%i)">%i</td>
  <td class="n" style="background-color:rgb(%i,255,%i)">%s</td>
  <td class="n" style="background-color:rgb(%i,%i,255)">%s</td>
@@ -448,15 +1218,24 @@ class HTMLWriter:
                 "&nbsp;".join(["%.2f" % p for p in probas]), blue, blue,
                 lexWeights,
                 "".join([" <td>%s</td>\n" % escape(cell)
-                         for cell in alignment])))
+                         for cell in alignment]))
         self.counter += 1
+        return text
+
+    def set_position(self, alNo):
+        """Set alignment counter.
+
+        -- alNo: int
+            Number of alignments preceding the next one.
+        """
+        self.counter = alNo + 1
 
     def terminate(self):
         """Terminates writing (close HTML tags)."""
         self.outputFile.write("</table>\n</body>\n</html>\n")
         self.outputFile.flush()
 
-class TMXWriter:
+class TMXWriter(PlainWriter):
     """Output alignments in XML (TMX).
 
     -- self.outputFile: file
@@ -494,11 +1273,11 @@ class TMXWriter:
  segtype="phrase" adminlang="en-us" srclang="*all*" o-tmf="none" />
 <body>\n''' % (__scriptName__, __version__))
 
-    def write(self, line):
-        """Write new alignment.
+    def format(self, line):
+        """Return new alignment formatted.
 
         -- line: str
-            The alignment to be written.
+            The alignment to be formatted.
 
         - Alignment is wrapped in translation unit <tu>;
         - one variant <tuv> per language;
@@ -512,7 +1291,7 @@ class TMXWriter:
                    ["_lang%i_" % i
                     for i in xrange(self.nbLanguages + 1,
                                     len(alignment) + 1)]
-        self.outputFile.write(
+        return (
             '<tu>\n <prop type="freq">%s</prop>\n'
             ' <prop type="probas">%s</prop>\n'
             ' <prop type="lexWeights">%s</prop>\n%s</tu>\n' %
@@ -529,114 +1308,1582 @@ class TMXWriter:
         self.outputFile.flush()
 
 
+class SortingWriter:
+    """Sort formatted alignments in bounded memory before writing them.
+
+    -- self.writer: {Plain,Moses}Writer
+        Formats alignments, and eventually writes them.
+    -- self.bufferSize: int
+        Maximum number of bytes of formatted alignments kept in memory.
+    -- self.lines: list(str)
+        Formatted alignments not yet sorted.
+    -- self.linesSize: int
+        Total length of strings in self.lines.
+    -- self.runs: list(file)
+        Temporary files containing sorted runs of formatted alignments.
+
+    Formatted lines are sorted as with "LC_ALL=C sort", i.e. by source
+    phrase (first language), which is the order Moses tools expect before
+    binarizing a phrase table. When self.bufferSize is reached, buffered
+    lines are sorted and spilled into a compressed temporary file. Runs are
+    merged at the end (and beforehand if more than SORT_MAX_RUNS are
+    created).
+    """
+
+    def __init__(self, writer, bufferSize):
+        """Initializer.
+
+        -- writer: {Plain,Moses}Writer
+            = self.writer
+        -- bufferSize: int
+            = self.bufferSize
+        """
+        self.writer = writer
+        self.bufferSize = bufferSize
+        self.lines = []
+        self.linesSize = 0
+        self.runs = []
+
+    def write(self, line):
+        """Buffer new alignment.
+
+        -- line: str
+        """
+        self.write_formatted(self.writer.format(line))
+
+    def format(self, line):
+        """See PlainWriter.format()."""
+        return self.writer.format(line)
+
+    def set_position(self, alNo):
+        """See PlainWriter.set_position()."""
+        self.writer.set_position(alNo)
+
+    def write_formatted(self, text):
+        """Buffer alignments formatted by self.format().
+
+        -- text: str
+        """
+        self.lines.extend(text.splitlines(True))
+        self.linesSize += len(text)
+        if self.linesSize >= self.bufferSize:
+            self._spill()
+
+    def _spill(self):
+        """Sort buffered lines and dump them into a new run."""
+        self.lines.sort()
+        self._add_run(self.lines)
+        self.lines = []
+        self.linesSize = 0
+        if len(self.runs) >= SORT_MAX_RUNS:
+            runs, self.runs = self.runs, []
+            try:
+                self._add_run(merge_sorted(*[self._read_run(run)
+                                             for run in runs]))
+            finally:
+                for run in runs:
+                    run.close()
+
+    def _add_run(self, lines):
+        """Write sorted lines into a new run.
+
+        -- lines: iterable(str)
+        """
+        run = make_temp_file(".run.gz")
+        zRun = gzip.GzipFile(fileobj=run, mode="wb", compresslevel=1)
+        zRun.writelines(lines)
+        zRun.close()
+        self.runs.append(run)
+
+    def _read_run(self, run):
+        """Return an iterator over the lines of a run.
+
+        -- run: file
+        """
+        run.seek(0)
+        return gzip.GzipFile(fileobj=run, mode="rb")
+
+    def terminate(self):
+        """Merge runs and write sorted alignments."""
+        try:
+            self.lines.sort()
+            if self.runs:
+                message("\rMerging %i sorted runs...\n" % len(self.runs))
+                lines = merge_sorted(self.lines, *[self._read_run(run)
+                                                   for run in self.runs])
+            else:
+                lines = self.lines
+            chunk = []
+            chunkSize = 0
+            for line in lines:
+                chunk.append(line)
+                chunkSize += len(line)
+                if chunkSize >= OUTPUT_BLOCK_SIZE:
+                    self.writer.write_formatted(''.join(chunk))
+                    chunk = []
+                    chunkSize = 0
+            self.writer.write_formatted(''.join(chunk))
+            self.writer.terminate()
+        finally:
+            self.lines = []
+            for run in self.runs:
+                run.close()
+            self.runs = []
+
+
+class PairWriter:
+    """Project multilingual alignments onto pairs of languages.
+
+    -- self.pairs: list((int, int))
+        Source and target languages (0-based) of each pair, or None for all
+        pairs until the first alignment is written.
+    -- self.make_writer: function
+        Called with source and target languages, returns the writer of a
+        pair.
+    -- self.counts: list(dict(int: dict(int: int)))
+        For each pair, absolute frequencies of projected alignments (see
+        set_proba()).
+    -- self.files: list(file)
+        For each pair, projected alignments (see set_proba()).
+    -- self.minFreq: int
+    -- self.minProba: float
+    -- self.topK: int
+        Filters applied to each pair table (see score_alignments()).
+
+    The projection of an alignment onto a pair keeps its phrases in both
+    languages, if both are non-empty. Its frequency is the sum of the
+    frequencies of all alignments with the same projection, and translation
+    probabilities are computed again from these frequencies by set_proba(),
+    so that each pair table is normalized as if it came from a bilingual
+    run. Lexical weights cannot be projected, and are left out ("-").
+    """
+
+    def __init__(self, pairs, make_writer, minFreq=1, minProba=0., topK=0):
+        """Initializer.
+
+        -- pairs: list((int, int))
+            = self.pairs
+        -- make_writer: function
+            = self.make_writer
+        -- minFreq: int
+            = self.minFreq
+        -- minProba: float
+            = self.minProba
+        -- topK: int
+            = self.topK
+        """
+        self.pairs = pairs
+        self.make_writer = make_writer
+        self.minFreq = minFreq
+        self.minProba = minProba
+        self.topK = topK
+        self.counts = self.files = None
+
+    def write(self, line):
+        """Project new alignment.
+
+        -- line: str
+        """
+        self.write_formatted(line)
+
+    def format(self, line):
+        """Return new alignment as it is (projected by write_formatted())."""
+        return line
+
+    def set_position(self, alNo):
+        """See PlainWriter.set_position()."""
+        pass
+
+    def write_formatted(self, text):
+        """Project alignments formatted by self.format().
+
+        -- text: str
+        """
+        for line in text.splitlines():
+            alignment, _, _, freq = line.rsplit('\t', 3)
+            phrases = alignment.split('\t')
+            if self.files is None:
+                self._start(len(phrases))
+            freq = int(freq)
+            for (source, target), counts, pairFile in \
+                    zip(self.pairs, self.counts, self.files):
+                if not (phrases[source] and phrases[target]):
+                    continue
+                projection = "%s\t%s" % (phrases[source], phrases[target])
+                bucket = counts.setdefault(len(projection), {})
+                projectionHash = hash(projection)
+                previousFreq = bucket.get(projectionHash)
+                if previousFreq is None:
+                    bucket[projectionHash] = freq
+                    print >> pairFile, "%s\t-" % projection
+                else:
+                    bucket[projectionHash] = previousFreq + freq
+
+    def _start(self, nbLanguages):
+        """Create temporary files once the number of languages is known.
+
+        -- nbLanguages: int
+        """
+        if self.pairs is None:
+            self.pairs = [(source, target)
+                          for source in xrange(nbLanguages)
+                          for target in xrange(source + 1, nbLanguages)]
+        for source, target in self.pairs:
+            assert max(source, target) < nbLanguages, \
+                   "No language %i in %i-language alignments" % \
+                   (max(source, target) + 1, nbLanguages)
+        self.counts = [{} for _ in self.pairs]
+        self.files = [make_temp_file(".pair") for _ in self.pairs]
+
+    def terminate(self):
+        """Compute probabilities and write each pair table."""
+        if self.files is None:
+            return
+        try:
+            for (source, target), counts, pairFile in \
+                    zip(self.pairs, self.counts, self.files):
+                message("\rLanguages %i and %i:\n" % (source + 1, target + 1))
+                set_proba(pairFile, counts, self.make_writer(source, target),
+                          None, self.minFreq, self.minProba, self.topK)
+        finally:
+            for pairFile in self.files:
+                pairFile.close()
+
+
 ###############################################################################
-# Function shared by Aligner class and merge() function
+# Functions shared by Aligner class and merge() function
 ###############################################################################
 
-def set_proba(inputFile, inputDict, writer):
-    """Update probabilities in alignment file.
+def format_batch(batch):
+    """Format a batch of scored alignments with __pipelineWriter__.
+
+    -- batch: (int, list((str, str, list(float), int)))
+        Number of alignments preceding the batch, and alignments as
+        (alignment, lexical weights, translation probabilities, frequency).
+
+    Return a string made of all formatted alignments.
+    
+    """
+    alNo, alignments = batch
+    writer = __pipelineWriter__
+    writer.set_position(alNo)
+    return ''.join([writer.format("%s\t%s\t%s\t%i\n" %
+                                  (alignment, lexWeights,
+                                   ' '.join(["%f" % p for p in probas]),
+                                   freq))
+                    for alignment, lexWeights, probas, freq in alignments])
+
+def write_alignments(batches, writer, nextPercentage):
+    """Format and write batches of scored alignments, in order.
+
+    -- batches: iterable(list((str, str, list(float), int)))
+        See format_batch().
+    -- writer: {Plain,Moses,HTML,TMX}Writer
+    -- nextPercentage: function
+        Called with the number of alignments written.
+
+    If __jobs__ > 1, formatting is done by as many worker processes, while
+    <batches> is consumed by a background thread and formatted batches are
+    written by the main thread, in their original order. The first batch is
+    formatted before the workers are started, so that they inherit any
+    writer state depending on the first alignment (e.g. HTMLWriter.maxFreq).
+    
+    """
+    global __pipelineWriter__
+    __pipelineWriter__ = writer
+    batches = iter(batches)
+    alNo = 0
+    for batch in batches:
+        writer.write_formatted(format_batch((alNo, batch)))
+        alNo += len(batch)
+        nextPercentage(len(batch))
+        if __jobs__ > 1:
+            break
+    else:
+        return
+    
+    # Bound the number of batches in flight, otherwise the whole output
+    # would be read ahead into memory
+    inFlight = threading.Semaphore(4 * __jobs__)
+    batchSizes = deque()
+    def numbered_batches(alNo):
+        for batch in batches:
+            inFlight.acquire()
+            batchSizes.append(len(batch))
+            yield alNo, batch
+            alNo += len(batch)
+    
+    pool = multiprocessing.Pool(__jobs__)
+    try:
+        for text in pool.imap(format_batch, numbered_batches(alNo)):
+            inFlight.release()
+            writer.write_formatted(text)
+            nextPercentage(batchSizes.popleft())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def score_alignments(inputFile, inputDict, minFreq=1, minProba=0.,
+                     topK=0):
+    """Sort alignments by frequency and compute translation probabilities.
 
     -- inputFile: file
-        Contains alignments, tab-separated languages + lexical
-        weights in last field.
     -- inputDict: dict(int: dict(int: int))
-        Absolute frequencies of alignments. Keys are alignment lengths (number
-        of bytes), values are dictionaries which keys are alignment hashes and
-        values are integer frequencies.
-    -- writer: {Plain,Moses,HTML,TMX}Writer
+        See set_proba(). <inputDict> is cleared, and <inputFile> closed.
+    -- minFreq: int
+        Alignments less frequent than this are left out.
+    -- minProba: float
+        Alignments whose translation probabilities are all lower than this
+        are left out.
+    -- topK: int
+        If positive, only the <topK> most frequent alignments of each
+        phrase in the first language are kept.
+
+    Return a tuple (number of alignments, iterator). The iterator yields
+    tuples (alignment string, lexical weights string, list of translation
+    probabilities, absolute frequency), by decreasing frequency.
+
+    Occurrences of phrases are counted while reading <inputFile> for the
+    first time, so that filters can be applied before alignments are
+    sorted. They are counted over all alignments, so that filters do not
+    change the probabilities of alignments kept.
     """
-    nbAlignments = 0
-    # Sort: read inputFile once to determine where each line begins
+    nbTotal = nbAlignments = 0
+    # Sort: read inputFile once to determine where each line begins, and
+    # count the number of occurrences of all parts of alignments
     offsetsByFreq = {}
+    phraseFreq = None
     inputFile.seek(0)
     offset = 0
     for line in inputFile:
-        nbAlignments += 1
+        nbTotal += 1
         alignment = line.rsplit('\t', 1)[0] # Remove lexical weights
         freq = inputDict[len(alignment)][hash(alignment)]
-        offsetsByFreq.setdefault(freq, []).append(offset)
+        if phraseFreq is None:
+            phraseFreq = [{} for _ in xrange(alignment.count('\t') + 1)]
+        for phrase, counts in zip(alignment.split('\t'), phraseFreq):
+            phraseHash = hash(phrase)
+            counts[phraseHash] = counts.get(phraseHash, 0) + freq
+        if freq >= minFreq:
+            nbAlignments += 1
+            offsetsByFreq.setdefault(freq, []).append(offset)
         offset += len(line)
     inputDict.clear()   # Release memory
     
-    message("\r%i alignments\n" % nbAlignments)
+    message("\r%i alignments\n" % nbTotal)
     if not nbAlignments:
-        return
+        inputFile.close()
+        return 0, iter([])
 
     # Read inputFile once more, according to absolute frequencies, and
     # dump everything into compressed file
     message("Sorting alignments\n")
     nextPercentage = Progression(nbAlignments).next
+    nbLanguages = len(phraseFreq)
+    nbKept = 0
+    keptBySource = {}   # With topK only
     tmpFile = make_temp_file(".al_lw.gz")
-    compressedFile = gzip.GzipFile(fileobj=tmpFile, mode="wb", compresslevel=1)
     try:
-        alNo = 0
+        compressedFile = gzip.GzipFile(fileobj=tmpFile, mode="wb",
+                                       compresslevel=1)
         for freq in sorted(offsetsByFreq.iterkeys(), reverse=True):
             for offset in offsetsByFreq.pop(freq):
-                alNo += 1
-                inputFile.seek(offset)
-                print >> compressedFile, "%s\t%x" % \
-                      (inputFile.readline().rstrip('\n'), freq)
                 nextPercentage()
+                inputFile.seek(offset)
+                line = inputFile.readline().rstrip('\n')
+                if minProba > 0 or topK > 0:
+                    alignment = line.split('\t', nbLanguages)[:-1]
+                    if minProba > 0 and \
+                       max([1. * freq / counts[hash(phrase)]
+                            for phrase, counts in zip(alignment,
+                                                      phraseFreq)]) \
+                       < minProba:
+                        continue
+                    if topK > 0:
+                        sourceHash = hash(alignment[0])
+                        nbSourceKept = keptBySource.get(sourceHash, 0)
+                        if nbSourceKept >= topK:
+                            continue
+                        keptBySource[sourceHash] = nbSourceKept + 1
+                nbKept += 1
+                print >> compressedFile, "%s\t%x" % (line, freq)
         compressedFile.close()
         inputFile.close()   # Delete temporary input file
         offsetsByFreq.clear()
+        keptBySource.clear()
+    except:
+        tmpFile.close()
+        raise
+    if nbKept < nbTotal:
+        message("\r%i alignments kept\n" % nbKept)
 
-        message("\rComputing conditional probabilities...\n")
-        nextPercentage = Progression(nbAlignments).next
-        tmpFile.seek(0)
-        compressedFile = gzip.GzipFile(fileobj=tmpFile, mode="rb")
-        # Count the number of occurrences of all parts of alignments
-        nbLanguages, nbSplits = None, None
-        for line in compressedFile:
-            if nbLanguages is None:
-                nbSplits = line.count('\t')
-                nbLanguages = nbSplits - 1
-                phraseFreq = [{} for _ in xrange(nbLanguages)]
-            alignment = line.split('\t', nbSplits)
-            freq = int(alignment.pop(), 16)
-            alignment.pop() # Remove lexical weights
-            for phrase, counts in zip(alignment, phraseFreq):
-                phraseHash = hash(phrase)
-                counts[phraseHash] = counts.get(phraseHash, 0) + freq
-            nextPercentage()
-        compressedFile.close()
-        
-        # Output alignments
-        tmpFile.seek(0)
-        compressedFile = gzip.GzipFile(fileobj=tmpFile, mode="rb")
-        message("\rOutputting results...\n")
-        nextPercentage = Progression(nbAlignments).next
-        nbSplits = nbLanguages
+    def scored_alignments():
         try:
+            tmpFile.seek(0)
+            compressedFile = gzip.GzipFile(fileobj=tmpFile, mode="rb")
             for line in compressedFile:
                 alignmentStr, lexWeights, freq = line.rsplit('\t', 2)
-                alignment = alignmentStr.split('\t', nbSplits)
+                alignment = alignmentStr.split('\t', nbLanguages - 1)
                 freq = int(freq, 16)
-                probas = ' '.join(["%f" % (1. * freq / counts[hash(phrase)])
-                                   for phrase, counts
-                                   in zip(alignment, phraseFreq)])
-                writer.write("%s\t%s\t%s\t%i\n" % (alignmentStr, lexWeights,
-                                                   probas, freq))
-                nextPercentage()
+                probas = [1. * freq / counts[hash(phrase)]
+                          for phrase, counts in zip(alignment, phraseFreq)]
+                yield alignmentStr, lexWeights, probas, freq
+            compressedFile.close()
+        finally:
+            tmpFile.close()
+    return nbKept, scored_alignments()
+
+def set_proba(inputFile, inputDict, writer, index=None, minFreq=1,
+              minProba=0., topK=0):
+    """Update probabilities in alignment file.
+
+    -- inputFile: file
+        Contains alignments, tab-separated languages + lexical
+        weights in last field.
+    -- inputDict: dict(int: dict(int: int))
+        Absolute frequencies of alignments. Keys are alignment lengths (number
+        of bytes), values are dictionaries which keys are alignment hashes and
+        values are integer frequencies.
+    -- writer: {Plain,Moses,HTML,TMX}Writer
+    -- index: PhraseIndexBuilder
+        If specified, alignments are also added to this index.
+    -- minFreq: int
+    -- minProba: float
+    -- topK: int
+        Filters, see score_alignments().
+    """
+    nbAlignments, scored = score_alignments(inputFile, inputDict, minFreq,
+                                            minProba, topK)
+    if not nbAlignments:
+        return
+
+    # Output alignments
+    message("\rOutputting results...\n")
+    nextPercentage = Progression(nbAlignments).next
+    def scored_batches():
+        batch = []
+        for alignment in scored:
+            if index is not None:
+                index.add(*alignment)
+            batch.append(alignment)
+            if len(batch) == OUTPUT_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    try:
+        try:
+            write_alignments(scored_batches(), writer, nextPercentage)
             writer.terminate()
         except IOError:
             pass
         message("\r")
     finally:
-        tmpFile.close()
+        scored.close()
+
+
+###############################################################################
+# Phrase table index
+###############################################################################
+
+class PhraseIndexBuilder:
+    """Write a sorted, memory-mappable index of alignments.
+
+    -- self.indexFile: file
+        The index file, open for writing.
+    -- self.offsets: list(array.array('L'))
+        For each language, positions (in self.indexFile) of all non-empty
+        phrases in that language.
+    -- self.nbRecords: int
+        Number of alignments added so far.
+
+    File layout (all integers are unsigned little endian):
+    - header: magic string INDEX_MAGIC, number of languages (32 bits),
+    number of alignments (64 bits), then for each language the position of
+    its entry table and its number of entries (64 bits each);
+    - alignments, in plain output format, in decreasing order of
+    frequency;
+    - for each language, an entry table: positions (64 bits each) of the
+    phrases of that language in the alignments, sorted by phrase. Entries
+    with equal phrases keep the alignment order, i.e. decreasing
+    frequency. Since all alignments sharing a phrase in a given language
+    have the same denominator for that language's translation probability,
+    this is also decreasing probability order.
+    """
+
+    def __init__(self, filename):
+        """Initializer.
+
+        -- filename: str
+            Where the index is written.
+        """
+        self.indexFile = open(filename, 'w+b')
+        self.offsets = None
+        self.nbRecords = 0
+        self.indexFile.write(INDEX_MAGIC)
+
+    def add(self, alignment, lexWeights, probas, freq):
+        """Add a new alignment to the index.
+
+        -- alignment: str
+            Tab-separated phrases.
+        -- lexWeights: str
+        -- probas: list(float)
+        -- freq: int
+
+        Alignments must be added in decreasing order of frequency.
+        """
+        phrases = alignment.split('\t')
+        if self.offsets is None:
+            self.offsets = [array('L') for _ in phrases]
+            # Reserve room for header
+            self.indexFile.write('\0' * (INDEX_HEADER.size - len(INDEX_MAGIC)
+                                         + INDEX_TABLE.size * len(phrases)))
+        offset = self.indexFile.tell()
+        for phrase, offsets in zip(phrases, self.offsets):
+            if phrase:
+                offsets.append(offset)
+            offset += len(phrase) + 1
+        self.indexFile.write("%s\t%s\t%s\t%i\n" %
+                             (alignment, lexWeights,
+                              ' '.join(["%f" % p for p in probas]), freq))
+        self.nbRecords += 1
+
+    def close(self):
+        """Sort entries, write entry tables and header, close index file."""
+        if self.offsets is None:
+            self.offsets = []
+        self.indexFile.flush()
+        tables = []
+        if self.nbRecords:
+            data = mmap.mmap(self.indexFile.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+            try:
+                for offsets in self.offsets:
+                    tables.append((self.indexFile.tell(), len(offsets)))
+                    self._write_table(data, offsets)
+            finally:
+                data.close()
+        self.offsets = None
+        self.indexFile.seek(0)
+        self.indexFile.write(INDEX_HEADER.pack(INDEX_MAGIC, len(tables),
+                                               self.nbRecords))
+        for table in tables:
+            self.indexFile.write(INDEX_TABLE.pack(*table))
+        self.indexFile.close()
+
+    def _write_table(self, data, offsets):
+        """Write the entry table of a language, sorted by phrase.
+
+        -- data: mmap.mmap
+            The index file, where phrases are read.
+        -- offsets: array.array('L')
+            Positions of the phrases of the language, in alignment order.
+
+        Equal phrases keep the alignment order, i.e. decreasing frequency
+        (positions increase with it). At most INDEX_SORT_ENTRIES phrases
+        are sorted in memory at once: larger tables are sorted by runs of
+        positions, spilled into temporary files, then merged (beforehand if
+        more than SORT_MAX_RUNS are created), phrases being read in place.
+        """
+        def key(offset):
+            return data[offset:data.find('\t', offset)]
+        def write(f, entries):
+            chunk = []
+            for offset in entries:
+                chunk.append(offset)
+                if len(chunk) == 65536:
+                    f.write(struct.pack('<65536Q', *chunk))
+                    chunk = []
+            f.write(struct.pack('<%iQ' % len(chunk), *chunk))
+        def read(run):
+            run.seek(0)
+            while True:
+                block = run.read(8 * 65536)
+                if not block:
+                    return
+                for offset in struct.unpack('<%iQ' % (len(block) // 8),
+                                            block):
+                    yield key(offset), offset
+        def merge(runs):
+            return (offset for _, offset
+                    in merge_sorted(*[read(run) for run in runs]))
+
+        if len(offsets) <= INDEX_SORT_ENTRIES:
+            write(self.indexFile, sorted(offsets, key=key))
+            return
+        runs = []
+        try:
+            for start in xrange(0, len(offsets), INDEX_SORT_ENTRIES):
+                if len(runs) >= SORT_MAX_RUNS:
+                    run = make_temp_file(".run")
+                    write(run, merge(runs))
+                    for oldRun in runs:
+                        oldRun.close()
+                    runs = [run]
+                run = make_temp_file(".run")
+                write(run, sorted(offsets[start:start + INDEX_SORT_ENTRIES],
+                                  key=key))
+                runs.append(run)
+            write(self.indexFile, merge(runs))
+        finally:
+            for run in runs:
+                run.close()
+
+
+class PhraseIndex:
+    """Look up alignments in an index written by PhraseIndexBuilder.
+
+    -- self.indexFile: file
+    -- self.data: mmap.mmap
+        The whole index file, memory-mapped.
+    -- self.nbLanguages: int
+    -- self.nbRecords: int
+        Number of alignments in index.
+    -- self.tables: list((int, int))
+        For each language, position and number of entries of its table.
+    -- self.recordsStart: int
+        Position of the first alignment, right after the header.
+
+    Lookups are done by dichotomy directly in the memory-mapped file: only
+    the pages that are actually read are loaded.
+
+    >>> index = PhraseIndex("table.idx")          # doctest: +SKIP
+    >>> index.lookup("the cat", 0, 2)             # doctest: +SKIP
+    [AlignmentRecord(phrases=('the cat', 'le chat'), ...), ...]
+    
+    """
+
+    def __init__(self, filename):
+        """Initializer.
+
+        -- filename: str
+            The index file name.
+        """
+        self.indexFile = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(self.indexFile.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):   # Empty file
+            raise ValueError("%s is not an alignment index" % filename)
+        magic, self.nbLanguages, self.nbRecords = \
+               INDEX_HEADER.unpack_from(self.data)
+        if magic != INDEX_MAGIC:
+            raise ValueError("%s is not an alignment index" % filename)
+        self.tables = [INDEX_TABLE.unpack_from(self.data, INDEX_HEADER.size
+                                               + i * INDEX_TABLE.size)
+                       for i in xrange(self.nbLanguages)]
+        self.recordsStart = INDEX_HEADER.size + \
+                            INDEX_TABLE.size * self.nbLanguages
+
+    def _phrase(self, table, i):
+        """Return the phrase referenced by the i-th entry of a table.
+
+        -- table: int
+            Position of the table in index.
+        -- i: int
+        """
+        start = struct.unpack_from('<Q', self.data, table + 8 * i)[0]
+        return self.data[start:self.data.find('\t', start)]
+
+    def _record(self, table, i):
+        """Return the AlignmentRecord referenced by the i-th entry of a table.
+
+        -- table: int
+            Position of the table in index.
+        -- i: int
+        """
+        start = struct.unpack_from('<Q', self.data, table + 8 * i)[0]
+        # The header is binary: do not look for line ends in it
+        start = max(self.data.rfind('\n', self.recordsStart, start) + 1,
+                    self.recordsStart)
+        return parse_alignment(self.data[start:self.data.find('\n', start)])
+
+    def lookup(self, phrase, language, k=None):
+        """Return alignments containing a phrase.
+
+        -- phrase: str
+        -- language: int
+            0-based index of the language <phrase> belongs to.
+        -- k: int
+            Maximum number of alignments to return (None for all).
+
+        Alignments are returned as a list of AlignmentRecord's, by
+        decreasing frequency (which is also decreasing translation
+        probability for <language>).
+        """
+        table, nbEntries = self.tables[language]
+        low, high = 0, nbEntries
+        while low < high:
+            middle = (low + high) // 2
+            if self._phrase(table, middle) < phrase:
+                low = middle + 1
+            else:
+                high = middle
+        records = []
+        while low < nbEntries and (k is None or len(records) < k) and \
+              self._phrase(table, low) == phrase:
+            records.append(self._record(table, low))
+            low += 1
+        return records
+
+    def close(self):
+        """Release index file."""
+        self.data.close()
+        self.indexFile.close()
+
+
+class PhraseTable:
+    """In-memory phrase table, with the same lookup interface as PhraseIndex.
+
+    -- self.data: str
+        All alignments, in plain output format.
+    -- self.entries: list(dict(str: array.array('L')))
+        For each language, maps phrases to the positions (in self.data) of
+        the alignments containing them, by decreasing frequency.
+    -- self.nbLanguages: int
+    -- self.nbRecords: int
+        Number of alignments in table.
+    """
+
+    def __init__(self, filenames):
+        """Initializer.
+
+        -- filenames: list(str)
+            Alignment files (plain text format), as output by set_proba()
+            i.e. sorted by decreasing frequency. Standard input is refered
+            to as "-".
+        """
+        lines = []
+        offset = 0
+        self.entries = None
+        for filename in filenames:
+            if filename == "-":
+                f = sys.stdin
+            else:
+                f = open_compressed(filename)
+            try:
+                for line in f:
+                    phrases = line.split('\t')[:-3]
+                    if self.entries is None:
+                        self.entries = [{} for _ in phrases]
+                    for phrase, entries in zip(phrases, self.entries):
+                        if phrase:
+                            offsets = entries.get(phrase)
+                            if offsets is None:
+                                offsets = entries[phrase] = array('L')
+                            offsets.append(offset)
+                    lines.append(line)
+                    offset += len(line)
+            finally:
+                f.close()
+        if self.entries is None:
+            self.entries = []
+        self.nbLanguages = len(self.entries)
+        self.nbRecords = len(lines)
+        self.data = ''.join(lines)
+        del lines
+        if len(filenames) > 1:  # Files are sorted, not their concatenation
+            for entries in self.entries:
+                for phrase, offsets in entries.iteritems():
+                    entries[phrase] = array('L', sorted(offsets,
+                                                        key=self._freq,
+                                                        reverse=True))
+
+    def _freq(self, offset):
+        """Return frequency of the alignment at some position.
+
+        -- offset: int
+        """
+        end = self.data.find('\n', offset)
+        return int(self.data[self.data.rfind('\t', offset, end) + 1:end])
+
+    def lookup(self, phrase, language, k=None):
+        """Return alignments containing a phrase (see PhraseIndex.lookup())."""
+        return [parse_alignment(self.data[o:self.data.find('\n', o)])
+                for o in self.entries[language].get(phrase, ())[:k]]
+
+    def close(self):
+        """Release memory."""
+        self.data, self.entries = '', []
+
+
+def open_phrase_table(filenames):
+    """Return a PhraseIndex or a PhraseTable, based on file contents.
+
+    -- filenames: list(str)
+
+    A single index file (see PhraseIndexBuilder) is memory-mapped, anything
+    else is loaded into memory as alignment files.
+    
+    """
+    if len(filenames) == 1 and filenames[0] != "-":
+        f = open(filenames[0], 'rb')
+        try:
+            magic = f.read(len(INDEX_MAGIC))
+        finally:
+            f.close()
+        if magic == INDEX_MAGIC:
+            return PhraseIndex(filenames[0])
+    return PhraseTable(filenames)
+
+
+###############################################################################
+# Corpus-wide cooccurrence store
+###############################################################################
+
+class CoocStoreBuilder:
+    """Count word cooccurrences over a whole corpus, in bounded memory.
+
+    -- self.filename: str
+        Where the store is written.
+    -- self.bufferSize: int
+        Maximum number of distinct word pairs counted in memory at once.
+    -- self.wordIds: list(dict(str: int))
+        For each language, ids of its words. Ids are shared by all
+        languages, in order of first appearance.
+    -- self.wordFreqs: array.array
+        For each word id, number of lines the word appears on.
+    -- self.pairs: dict(int: int)
+        Cooccurrence counts not yet spilled, keyed by source word id * 2^32
+        + target word id (the source word belongs to the first language).
+    -- self.runs: list(file)
+        Temporary files containing sorted runs of cooccurrence counts.
+    -- self.nbLines: int
+    -- self.inputSize: int
+        Total size of the input lines, in bytes.
+    -- self.inputTime: int
+        Latest modification time of the input files (see
+        input_identity()).
+
+    Cooccurrences are only counted between words of different languages,
+    as the number of lines both words appear on. When self.bufferSize pairs
+    are counted, they are sorted and spilled into a compressed temporary
+    file, as "<key in hexadecimal, 16 digits> <count in hexadecimal>"
+    lines (so that lines sort like keys). Runs are merged at the end (and
+    beforehand if more than SORT_MAX_RUNS are created), see
+    SortingWriter.
+
+    File layout (all integers are unsigned little endian):
+    - header (COOC_HEADER): magic string COOC_MAGIC, number of languages
+    and lines, size and time of the input, number of words and word
+    pairs, then the positions of the word
+    frequencies, pair keys and pair counts, and for each language the
+    position of its word table and its number of words (INDEX_TABLE);
+    - words, one per line, in id order;
+    - for each language, a word table: position of each word and its id
+    (COOC_ENTRY), sorted by word;
+    - word frequencies (32 bits each), in id order;
+    - pair keys (64 bits each), sorted;
+    - pair counts (32 bits each), in the order of keys.
+    """
+
+    def __init__(self, filename, bufferSize=COOC_BUFFER_PAIRS, inputTime=0):
+        """Initializer.
+
+        -- filename: str
+            = self.filename
+        -- bufferSize: int
+            = self.bufferSize
+        -- inputTime: int
+            = self.inputTime
+        """
+        self.filename = filename
+        self.bufferSize = bufferSize
+        self.wordIds = []
+        self.wordFreqs = array('L')
+        self.pairs = {}
+        self.runs = []
+        self.nbLines = 0
+        self.inputSize = 0
+        self.inputTime = inputTime
+
+    def add(self, sentences, nbCopies=1):
+        """Count cooccurrences of a new line.
+
+        -- sentences: list(str)
+            The sentence in each language.
+        -- nbCopies: int
+            Number of times the line occurs.
+        """
+        while len(self.wordIds) < len(sentences):
+            self.wordIds.append({})
+        lineWords = []
+        for sentence, wordIds in zip(sentences, self.wordIds):
+            words = set()
+            for word in sentence.split():
+                wordId = wordIds.get(word)
+                if wordId is None:
+                    wordId = wordIds[word] = len(self.wordFreqs)
+                    self.wordFreqs.append(0)
+                words.add(wordId)
+            for wordId in words:
+                self.wordFreqs[wordId] += nbCopies
+            lineWords.append(words)
+        pairs = self.pairs
+        pairsGet = pairs.get
+        for sourceLanguage, sourceWords in enumerate(lineWords):
+            for targetWords in lineWords[sourceLanguage+1:]:
+                for sw in sourceWords:
+                    sw <<= 32
+                    for tw in targetWords:
+                        pairs[sw | tw] = pairsGet(sw | tw, 0) + nbCopies
+        self.nbLines += nbCopies
+        if len(pairs) >= self.bufferSize:
+            self._spill()
+
+    def _spill(self):
+        """Sort buffered counts and dump them into a new run."""
+        self._add_run("%016x %x\n" % pair
+                      for pair in sorted(self.pairs.iteritems()))
+        self.pairs = {}
+        if len(self.runs) >= SORT_MAX_RUNS:
+            runs, self.runs = self.runs, []
+            try:
+                self._add_run("%016x %x\n" % pair for pair in
+                              self._merge_runs(runs, []))
+            finally:
+                for run in runs:
+                    run.close()
+
+    def _add_run(self, lines):
+        """Write sorted lines into a new run (see SortingWriter._add_run()).
+
+        -- lines: iterable(str)
+        """
+        run = make_temp_file(".cooc.gz")
+        zRun = gzip.GzipFile(fileobj=run, mode="wb", compresslevel=1)
+        zRun.writelines(lines)
+        zRun.close()
+        self.runs.append(run)
+
+    def _merge_runs(self, runs, pairs):
+        """Return an iterator over sorted (key, count) with summed counts.
+
+        -- runs: list(file)
+        -- pairs: list((int, int))
+            Sorted counts not spilled yet.
+        """
+        def read(run):
+            run.seek(0)
+            for line in gzip.GzipFile(fileobj=run, mode="rb"):
+                key, count = line.split()
+                yield int(key, 16), int(count, 16)
+        previousKey = None
+        total = 0
+        for key, count in merge_sorted(pairs, *[read(run) for run in runs]):
+            if key != previousKey:
+                if previousKey is not None:
+                    yield previousKey, total
+                previousKey = key
+                total = 0
+            total += count
+        if previousKey is not None:
+            yield previousKey, total
+
+    def close(self):
+        """Merge runs and write the store."""
+        def write_chunked(f, fmt, values):
+            chunk = []
+            for value in values:
+                chunk.append(value)
+                if len(chunk) == 65536:
+                    f.write(struct.pack('<%i%s' % (len(chunk), fmt), *chunk))
+                    chunk = []
+            f.write(struct.pack('<%i%s' % (len(chunk), fmt), *chunk))
+
+        storeFile = open(self.filename, 'wb')
+        countsFile = make_temp_file(".counts")
+        try:
+            storeFile.write('\0' * (COOC_HEADER.size + INDEX_TABLE.size *
+                                    len(self.wordIds)))
+            words = [None] * len(self.wordFreqs)
+            for wordIds in self.wordIds:
+                for word, wordId in wordIds.iteritems():
+                    words[wordId] = word
+            positions = array('L')
+            for word in words:
+                positions.append(storeFile.tell())
+                storeFile.write(word + '\n')
+            del words
+            tables = []
+            for wordIds in self.wordIds:
+                tables.append((storeFile.tell(), len(wordIds)))
+                for word in sorted(wordIds):
+                    wordId = wordIds[word]
+                    storeFile.write(COOC_ENTRY.pack(positions[wordId],
+                                                    wordId))
+            del positions
+            self.wordIds = []
+            freqsPosition = storeFile.tell()
+            write_chunked(storeFile, 'I', self.wordFreqs)
+
+            keysPosition = storeFile.tell()
+            nbPairs = [0]
+            def keys(pairs):
+                for key, count in pairs:
+                    nbPairs[0] += 1
+                    counts.append(count)
+                    if len(counts) == 65536:
+                        countsFile.write(struct.pack('<65536I', *counts))
+                        del counts[:]
+                    yield key
+            counts = []
+            pairs = sorted(self.pairs.iteritems())
+            self.pairs = {}
+            if self.runs:
+                message("\rMerging %i sorted runs...\n" % len(self.runs))
+            write_chunked(storeFile, 'Q', keys(self._merge_runs(self.runs,
+                                                                pairs)))
+            del pairs
+            countsFile.write(struct.pack('<%iI' % len(counts), *counts))
+            countsPosition = storeFile.tell()
+            countsFile.seek(0)
+            shutil.copyfileobj(countsFile, storeFile)
+
+            storeFile.seek(0)
+            storeFile.write(COOC_HEADER.pack(COOC_MAGIC, len(tables),
+                                             self.nbLines, self.inputSize,
+                                             self.inputTime,
+                                             len(self.wordFreqs), nbPairs[0],
+                                             freqsPosition, keysPosition,
+                                             countsPosition))
+            for table in tables:
+                storeFile.write(INDEX_TABLE.pack(*table))
+        finally:
+            countsFile.close()
+            storeFile.close()
+            for run in self.runs:
+                run.close()
+            self.runs = []
+        return nbPairs[0]
+
+
+def input_identity(filenames, nbLanguages, nbLines, inputSize):
+    """Return what a cooccurrence store records about its input.
+
+    -- filenames: list(str)
+        Input file names ("-" for standard input).
+    -- nbLanguages: int
+    -- nbLines: int
+        Number of input lines, duplicates included.
+    -- inputSize: int
+        Total size of the input lines, in bytes.
+
+    The latest modification time of input files (in seconds, 0 for the
+    standard input only) is added, so that a store is rebuilt when its
+    input changes, even to the same size. The result is compared to
+    CoocStore.identity().
+
+    """
+    inputTime = max([int(os.path.getmtime(f)) for f in filenames
+                     if f != "-"] or [0])
+    return nbLanguages, nbLines, inputSize, inputTime
+
+def is_cooc_store(filename):
+    """Tell whether a file starts like a cooccurrence store.
+
+    -- filename: str
+
+    Stores of other versions (other COOC_MAGIC digits) are recognized
+    too, so that they can be rebuilt rather than reported.
+    
+    """
+    f = open(filename, 'rb')
+    try:
+        magic = f.read(len(COOC_MAGIC))
+    finally:
+        f.close()
+    return magic[:-2] == COOC_MAGIC[:-2]
+
+def build_cooc_store(files, filename, inputTime=0):
+    """Count word cooccurrences of a whole corpus into a new store.
+
+    -- files: list(file)
+        Input files, read from the beginning (one pass), in parallel.
+    -- filename: str
+    -- inputTime: int
+        See CoocStoreBuilder.
+    """
+    message("Building cooccurrence store %s...\n" % filename)
+    builder = CoocStoreBuilder(filename, inputTime=inputTime)
+    for f in files:
+        f.seek(0)
+    for lines in izip(*files):
+        builder.inputSize += sum([len(line) for line in lines])
+        builder.add([sentence for line in lines
+                     for sentence in line.rstrip('\n').split('\t')])
+    nbWords = len(builder.wordFreqs)
+    nbPairs = builder.close()
+    message("\r%i words, %i cooccurring pairs\n" % (nbWords, nbPairs))
+
+
+class CoocStore:
+    """Look up word cooccurrences in a store written by CoocStoreBuilder.
+
+    -- self.storeFile: file
+    -- self.data: mmap.mmap
+        The whole store file, memory-mapped.
+    -- self.nbLanguages: int
+    -- self.nbLines: int
+    -- self.inputSize: int
+    -- self.inputTime: int
+        See CoocStoreBuilder.
+    -- self.nbWords: int
+    -- self.nbPairs: int
+    -- self.freqsPosition: int
+    -- self.keysPosition: int
+    -- self.countsPosition: int
+    -- self.tables: list((int, int))
+        For each language, position and number of entries of its word
+        table.
+    -- self.cache: LRUCache
+        Ids of recently looked up words, keyed by (language, word).
+
+    As with PhraseIndex, lookups are done by dichotomy in the
+    memory-mapped file, so that only pages actually read are loaded. The
+    same store can be used for all subcorpora and all merges.
+
+    >>> store = CoocStore("corpus.cooc")                  # doctest: +SKIP
+    >>> store.lexical_weights([["the", "cat"], ["le", "chat"]])
+    ...                                                   # doctest: +SKIP
+    [0.25, 0.5]
+    
+    """
+
+    def __init__(self, filename):
+        """Initializer.
+
+        -- filename: str
+            The store file name.
+        """
+        self.storeFile = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(self.storeFile.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):   # Empty file
+            self.storeFile.close()
+            raise ValueError("%s is not a cooccurrence store" % filename)
+        if len(self.data) < COOC_HEADER.size or \
+           self.data[:len(COOC_MAGIC)] != COOC_MAGIC:
+            self.close()
+            raise ValueError("%s is not a cooccurrence store of this "
+                             "version" % filename)
+        magic, self.nbLanguages, self.nbLines, self.inputSize, \
+               self.inputTime, self.nbWords, self.nbPairs, \
+               self.freqsPosition, self.keysPosition, self.countsPosition = \
+               COOC_HEADER.unpack_from(self.data)
+        if len(self.data) < COOC_HEADER.size + \
+           INDEX_TABLE.size * self.nbLanguages:
+            self.close()
+            raise ValueError("%s is a truncated cooccurrence store" %
+                             filename)
+        self.tables = [INDEX_TABLE.unpack_from(self.data, COOC_HEADER.size
+                                               + i * INDEX_TABLE.size)
+                       for i in xrange(self.nbLanguages)]
+        self.cache = LRUCache(COOC_CACHE_WORDS)
+
+    def identity(self):
+        """Return what the store records about its input (see
+        input_identity())."""
+        return self.nbLanguages, self.nbLines, self.inputSize, self.inputTime
+
+    def word_id(self, word, language):
+        """Return the id of a word, or -1 if it is not in the store.
+
+        -- word: str
+        -- language: int
+            0-based index of the language <word> belongs to.
+        """
+        wordId = self.cache.get((language, word))
+        if wordId is not None:
+            return wordId
+        wordId = -1
+        if language < self.nbLanguages:
+            table, nbEntries = self.tables[language]
+            data = self.data
+            low, high = 0, nbEntries
+            while low < high:
+                middle = (low + high) // 2
+                position, middleId = COOC_ENTRY.unpack_from(
+                    data, table + middle * COOC_ENTRY.size)
+                middleWord = data[position:data.find('\n', position)]
+                if middleWord < word:
+                    low = middle + 1
+                elif middleWord > word:
+                    high = middle
+                else:
+                    wordId = middleId
+                    break
+        self.cache.put((language, word), wordId)
+        return wordId
+
+    def freq(self, wordId):
+        """Return the number of lines a word appears on.
+
+        -- wordId: int
+        """
+        return struct.unpack_from('<I', self.data,
+                                  self.freqsPosition + 4 * wordId)[0]
+
+    def get(self, sourceWord, targetWord):
+        """Return the number of lines two words appear on together.
+
+        -- sourceWord: int
+            Id of a word of a language before that of <targetWord>.
+        -- targetWord: int
+        """
+        key = sourceWord << 32 | targetWord
+        data, keysPosition = self.data, self.keysPosition
+        low, high = 0, self.nbPairs
+        while low < high:
+            middle = (low + high) // 2
+            middleKey = struct.unpack_from('<Q', data,
+                                           keysPosition + 8 * middle)[0]
+            if middleKey < key:
+                low = middle + 1
+            elif middleKey > key:
+                high = middle
+            else:
+                return struct.unpack_from('<I', data, self.countsPosition
+                                          + 4 * middle)[0]
+        return 0
+
+    def lexical_weights(self, phrases):
+        """Return the lexical weight of each phrase of an alignment.
+
+        -- phrases: list(list(str))
+            Words of the phrase in each language.
+
+        Same as Aligner._lexical_weight(), with corpus-wide counts: the
+        weight of a phrase is the product, for each of its words, of the
+        highest cooccurrence count with a word of the other phrases,
+        divided by the frequency of the word. Words that are not in the
+        store (e.g. discontinuity delimiters) are left out.
+        """
+        alignment = [[wordId for wordId in [self.word_id(word, language)
+                                            for word in phrase]
+                      if wordId >= 0]
+                     for language, phrase in enumerate(phrases)]
+        lexWeights = []
+        for srcLang, sourcePhrase in enumerate(alignment):
+            lexWeight = 1.
+            for sw in sourcePhrase:
+                highestCooc = 0
+                for tgtLang, targetPhrase in enumerate(alignment):
+                    if srcLang < tgtLang:
+                        for tw in targetPhrase:
+                            highestCooc = max(highestCooc, self.get(sw, tw))
+                    elif srcLang > tgtLang:
+                        for tw in targetPhrase:
+                            highestCooc = max(highestCooc, self.get(tw, sw))
+                lexWeight *= 1. * highestCooc / self.freq(sw)
+            lexWeights.append(lexWeight)
+        return lexWeights
+
+    def close(self):
+        """Release store file."""
+        self.data.close()
+        self.storeFile.close()
+
+
+###############################################################################
+# Lookup server
+###############################################################################
+
+class LRUCache:
+    """Thread-safe cache of bounded size, discarding least recently used items.
+
+    -- self.maxSize: int
+    -- self.items: OrderedDict
+        Least recently used first.
+    -- self.lock: threading.Lock
+    -- self.hits: int
+    -- self.misses: int
+    """
+
+    def __init__(self, maxSize):
+        """Initializer.
+
+        -- maxSize: int
+            = self.maxSize
+        """
+        self.maxSize = maxSize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        """Return cached value for <key>, or None."""
+        self.lock.acquire()
+        try:
+            value = self.items.pop(key, None)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        """Cache a new value."""
+        if self.maxSize < 1:
+            return
+        self.lock.acquire()
+        try:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+        finally:
+            self.lock.release()
+
+
+class LatencyStats:
+    """Keep track of the most recent request latencies.
+
+    -- self.latencies: deque(float)
+        Latencies in seconds, most recent last.
+    -- self.nbRequests: int
+        Total number of requests.
+    """
+
+    def __init__(self, maxSize=100000):
+        """Initializer.
+
+        -- maxSize: int
+            Number of latencies kept for computing percentiles.
+        """
+        self.latencies = deque(maxlen=maxSize)
+        self.nbRequests = 0
+
+    def add(self, latency):
+        """Record a new latency (in seconds)."""
+        self.latencies.append(latency)
+        self.nbRequests += 1
+
+    def percentiles(self, ranks=(50, 90, 99, 99.9)):
+        """Return a dict mapping ranks to latencies (in milliseconds)."""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {}
+        return dict([(rank, 1000 * latencies[min(len(latencies) - 1,
+                                                 int(len(latencies) * rank
+                                                     / 100.))])
+                     for rank in ranks])
+
+    def __str__(self):
+        return "%i requests, latency %s" % (
+            self.nbRequests,
+            ", ".join(["p%g=%.3fms" % rank_latency for rank_latency
+                       in sorted(self.percentiles().iteritems())]))
+
+
+class LookupRequestHandler(BaseHTTPRequestHandler):
+    """Answer phrase lookups over HTTP.
+
+    - POST /lookup with a JSON object {"phrases": [...], "language": int,
+    "k": int} (language is 0-based, k is optional) returns {"results":
+    [...]}: one list of alignments per phrase, by decreasing frequency;
+    - GET /lookup?phrase=...&language=...&k=... does the same for a single
+    phrase;
+    - GET /stats returns latency percentiles and cache statistics.
+    """
+
+    def do_GET(self):
+        """Answer single lookups and statistics requests."""
+        url = urlparse.urlparse(self.path)
+        if url.path == '/stats':
+            server = self.server
+            self.send_json({
+                "requests": server.latencies.nbRequests,
+                "latencyMs": dict([("p%g" % rank, latency) for rank, latency
+                                   in server.latencies.percentiles(
+                                       ).iteritems()]),
+                "cacheHits": server.cache.hits,
+                "cacheMisses": server.cache.misses})
+        elif url.path == '/lookup':
+            query = urlparse.parse_qs(url.query)
+            try:
+                self.lookup(query['phrase'][:1],
+                            int(query.get('language', [0])[0]),
+                            query.get('k', [None])[0])
+            except (KeyError, ValueError, IndexError):
+                self.send_error(400)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        """Answer batched lookups."""
+        if urlparse.urlparse(self.path).path != '/lookup':
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(
+                int(self.headers['Content-Length'])))
+            self.lookup([phrase.encode(self.server.encoding)
+                         for phrase in request['phrases']],
+                        int(request.get('language', 0)), request.get('k'))
+        except (KeyError, ValueError, TypeError, IndexError,
+                AttributeError):
+            self.send_error(400)
+
+    def lookup(self, phrases, language, k):
+        """Send alignments for a batch of phrases.
+
+        -- phrases: list(str)
+        -- language: int
+        -- k: int
+        """
+        startTime = time()
+        if k is not None:
+            k = int(k)
+        results = self.server.lookup(phrases, language, k)
+        self.send_json({"results": [[record._asdict() for record in records]
+                                    for records in results]}, startTime)
+
+    def send_json(self, obj, startTime=None):
+        """Send a JSON response.
+
+        -- obj: object
+        -- startTime: float
+            If specified, time the request started (for latency stats).
+        """
+        body = json.dumps(obj, encoding=self.server.encoding)
+        if startTime is not None:
+            self.server.latencies.add(time() - startTime)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Do not log every request."""
+        pass
+
+
+class LookupServer(ThreadingMixIn, HTTPServer):
+    """Multi-threaded HTTP server answering phrase lookups.
+
+    -- self.table: PhraseIndex or PhraseTable
+    -- self.cache: LRUCache
+        Maps (phrase, language, k) to lists of AlignmentRecord's.
+    -- self.latencies: LatencyStats
+    -- self.encoding: str
+        Encoding of phrases in self.table.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, table, cacheSize, encoding):
+        """Initializer.
+
+        -- address: (str, int)
+            Host and port to listen to.
+        -- table: PhraseIndex or PhraseTable
+            = self.table
+        -- cacheSize: int
+            Maximum number of lookups cached.
+        -- encoding: str
+            = self.encoding
+        """
+        HTTPServer.__init__(self, address, LookupRequestHandler)
+        self.table = table
+        self.cache = LRUCache(cacheSize)
+        self.latencies = LatencyStats()
+        self.encoding = encoding
+
+    def lookup(self, phrases, language, k):
+        """Return a list of AlignmentRecord lists, 1 per phrase.
+
+        -- phrases: list(str)
+        -- language: int
+        -- k: int
+        """
+        if not 0 <= language < self.table.nbLanguages:
+            raise ValueError("No such language: %i" % language)
+        results = []
+        for phrase in phrases:
+            key = (phrase, language, k)
+            records = self.cache.get(key)
+            if records is None:
+                records = self.table.lookup(phrase, language, k)
+                self.cache.put(key, records)
+            results.append(records)
+        return results
+
+
+def parse_address(address):
+    """Get the host and port to listen to from a command line option.
+
+    -- address: str
+        "[host:]port" (host defaults to localhost).
+
+    Return a tuple (host, port). Raise ValueError if <address> is not well
+    formed.
+
+    >>> parse_address("8080"), parse_address("0.0.0.0:80")
+    (('localhost', 8080), ('0.0.0.0', 80))
+
+    """
+    host, _, port = address.rpartition(':')
+    if not port.isdigit() or not 0 <= int(port) < 65536:
+        raise ValueError
+    return host or 'localhost', int(port)
+
+def serve(inputFilenames, address, cacheSize, encoding):
+    """Serve phrase lookups until interrupted.
+
+    -- inputFilenames: list(str)
+        Alignment files or index (see open_phrase_table()).
+    -- address: str
+        "[host:]port" to listen to (see parse_address()).
+    -- cacheSize: int
+    -- encoding: str
+    """
+    message("Loading phrase table...\n")
+    table = open_phrase_table(inputFilenames)
+    try:
+        server = LookupServer(parse_address(address), table, cacheSize,
+                              encoding)
+        message("%i alignments, %i languages. Serving on http://%s:%i/ "
+                "(ctrl-c to interrupt)\n" % ((table.nbRecords,
+                                               table.nbLanguages) +
+                                              server.server_address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        message("\r%s, %i cache hits, %i cache misses\n" %
+                (server.latencies, server.cache.hits, server.cache.misses))
+    finally:
+        table.close()
 
 
 ###############################################################################
 # Merge alignment files
 ###############################################################################
 
-def merge(inputFilenames, writer):
+def merge(inputFilenames, writer, index=None, minFreq=1, minProba=0.,
+          topK=0, coocStore=None):
     """Merge alignments from several input files.
 
     -- inputFilenames: list(str)
         List of file names from which alignments have to be merged.
         Standard input is refered to as "-".
     -- writer: {Plain,Moses,HTML,TMX}Writer
+    -- index: PhraseIndexBuilder
+    -- minFreq: int
+    -- minProba: float
+    -- topK: int
+        See set_proba().
+    -- coocStore: CoocStore
+        If specified, lexical weights are recomputed from it.
 
     An incoming alignment is assumed to be formatted as <alignment> <tab>
     <lexicalWeights> <tab> <translationProbabilities> <TAB> <integer>
@@ -676,12 +2923,18 @@ def merge(inputFilenames, writer):
                 previousFreq = bucket.get(alignmentHash)
                 if previousFreq is None:
                     bucket[alignmentHash] = int(freq)
+                    if coocStore is not None:
+                        alignment_lw = "%s\t%s" % (alignment, ' '.join(
+                            ["%f" % lw for lw in coocStore.lexical_weights(
+                                [phrase.split()
+                                 for phrase in alignment.split('\t')])]))
                     print >> weightedAlignmentFile, alignment_lw
                 else:
                     bucket[alignmentHash] = previousFreq + int(freq)
         
         weightedAlignmentFile.seek(0)
-        set_proba(weightedAlignmentFile, counts, writer)
+        set_proba(weightedAlignmentFile, counts, writer, index, minFreq,
+                  minProba, topK)
     finally:
         weightedAlignmentFile.close()
         for f in files:
@@ -689,10 +2942,189 @@ def merge(inputFilenames, writer):
     
 
     
+###############################################################################
+# Parallel indexing of input files
+###############################################################################
+
+def count_lines(chunk):
+    """Return the number of lines in a part of a file.
+
+    -- chunk: (str, int, int)
+        File name, start and end positions. The part must begin at a line
+        start, and end at a line start or at the end of file.
+    """
+    filename, start, end = chunk
+    f = open(filename, 'rb')
+    try:
+        f.seek(start)
+        data = f.read(end - start)
+    finally:
+        f.close()
+    nbLines = data.count('\n')
+    if data and not data.endswith('\n'):
+        nbLines += 1
+    return nbLines
+
+def index_chunk(chunk):
+    """Store line start positions of a part of a file in __sharedOffsets__.
+
+    -- chunk: (str, int, int, int, int)
+        File name, start and end positions (see count_lines()), number of
+        lines before start, and expected number of columns.
+
+    Return None, or a tuple (line number, number of columns) for the first
+    line which does not have the expected number of columns.
+    """
+    filename, start, end, lineNo, nbColumns = chunk
+    f = open(filename, 'rb')
+    try:
+        f.seek(start)
+        data = f.read(end - start)
+    finally:
+        f.close()
+    offsets = __sharedOffsets__
+    size = len(data)
+    pos = 0
+    while pos < size:
+        lineEnd = data.find('\n', pos)
+        if lineEnd < 0:
+            lineEnd = size
+        offsets[lineNo] = start + pos
+        lineColumns = data.count('\t', pos, lineEnd) + 1
+        if lineColumns != nbColumns:
+            return lineNo, lineColumns
+        lineNo += 1
+        pos = lineEnd + 1
+    return None
+
+def index_file(filename, nbProcesses):
+    """Index line start positions of an uncompressed file in parallel.
+
+    -- filename: str
+    -- nbProcesses: int
+
+    The file is split into parts of about INDEX_CHUNK_SIZE bytes, aligned
+    on line starts. Lines are first counted in each part, then each process
+    writes line positions of its parts directly into a shared array, and
+    checks their number of columns. Return a tuple (offsets, number of
+    columns, number of lines). Raise AssertionError if lines have different
+    numbers of columns.
+    """
+    global __sharedOffsets__
+    size = os.path.getsize(filename)
+    if not size:
+        return array('B'), None, 0
+    f = open(filename, 'rb')
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            lineEnd = data.find('\n')
+            if lineEnd < 0:
+                lineEnd = size
+            nbColumns = data[:lineEnd].count('\t') + 1
+            nbChunks = max(4 * nbProcesses, size // INDEX_CHUNK_SIZE)
+            starts = [0]
+            for i in xrange(1, nbChunks):
+                lineEnd = data.find('\n', max(i * size // nbChunks - 1,
+                                              starts[-1]))
+                if lineEnd < 0 or lineEnd + 1 >= size:
+                    break
+                if lineEnd + 1 > starts[-1]:
+                    starts.append(lineEnd + 1)
+        finally:
+            data.close()
+    finally:
+        f.close()
+    chunks = [(filename, start, end)
+              for start, end in zip(starts, starts[1:] + [size])]
+
+    pool = multiprocessing.Pool(nbProcesses)
+    try:
+        lineCounts = pool.map(count_lines, chunks)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    nbLines = sum(lineCounts)
+    __sharedOffsets__ = RawArray(optimum_typecode(size), nbLines)
+    lineNo = 0
+    for i, (_, start, end) in enumerate(chunks):
+        chunks[i] = (filename, start, end, lineNo, nbColumns)
+        lineNo += lineCounts[i]
+    
+    pool = multiprocessing.Pool(nbProcesses)
+    try:
+        errors = [error for error in pool.map(index_chunk, chunks)
+                  if error is not None]
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    offsets, __sharedOffsets__ = __sharedOffsets__, None
+    if errors:
+        lineNo, lineColumns = min(errors)
+        raise AssertionError("Found %i columns  instead of %i at line %i in "
+                             "file %s" % (lineColumns, nbColumns, lineNo + 1,
+                                          filename))
+    return offsets, nbColumns, nbLines
+
+
 ###############################################################################
 # Alignment mode
 ###############################################################################
 
+def align_subcorpus(job):
+    """Align a subcorpus with __subcorpusAligner__, in a worker process.
+
+    -- job: (list(int), float, int, int, str)
+        See Aligner.align_subcorpus().
+
+    Return the number of alignments found, or None if the subcorpus was
+    skipped: ctrl-c was hit before it was started (__subcorpusStop__ is
+    set), or while it was loaded or weighted (Aligner.run() only handles
+    it while aligning).
+    
+    """
+    global __verbose__, __jobs__
+    __verbose__ = False     # Workers would mix their progress messages
+    __jobs__ = 1            # Daemonic workers cannot start processes
+    if __subcorpusStop__.is_set():
+        return None
+    try:
+        return __subcorpusAligner__.align_subcorpus(*job)
+    except KeyboardInterrupt:
+        return None
+
+def count_cooc_shard(sources):
+    """Count cooccurrences of some source words.
+
+    -- sources: list(int)
+        Source word ids, looked up in __coocSources__, a tuple (corpus,
+        source apparitions, line multiplicities) (see
+        Aligner._count_cooc()).
+
+    Return a list of tuples (source word, target word ids, frequencies),
+    as arranged by cooc_arrays(). Source words with no cooccurrence are
+    left out.
+    
+    """
+    corpus, sourceAp, lineMultiplicity = __coocSources__
+    shard = []
+    for sw in sources:
+        cooc = {}
+        if lineMultiplicity is None:
+            for lineId in sourceAp[sw]:
+                for tw in corpus[lineId]:
+                    cooc[tw] = cooc.get(tw, 0) + 1
+        else:
+            for lineId in sourceAp[sw]:
+                nbCopies = lineMultiplicity[lineId]
+                for tw in corpus[lineId]:
+                    cooc[tw] = cooc.get(tw, 0) + nbCopies
+        if cooc:
+            shard.append((sw,) + cooc_arrays(cooc))
+    return shard
+
 class Aligner:
     """Generate word alignments from sentence-aligned corpora.
 
@@ -701,6 +3133,18 @@ class Aligner:
     -- self.offsets: list(array.array(int))
         For each file (corresponding indices in self.files), the list of
         positions of start of lines.
+    -- self.fileSizes: list(int)
+        For each file, number of bytes indexed.
+    -- self.nbLines: int
+        Number of lines in self.offsets.
+    -- self.nbOldLines: int
+        Number of lines aligned by the previous run, when resuming one
+        (see resume_state()), 0 otherwise.
+    -- self.multiplicity: array.array(int)
+        With "-u" only (None otherwise): for each line in self.offsets, the
+        number of identical lines in input files.
+    -- self.lineMultiplicity: list(int)
+        Same as self.multiplicity, for lines in self.corpus (or None).
     -- self.nbLanguages: int
         Number of languages in the corpus.
     -- self.corpus: list(lit(int))
@@ -744,6 +3188,56 @@ class Aligner:
     -- self.weightFunc: function
         {self._dummy_weight|self._lexical_weight}, according to
         "-w" command line flag.
+    -- self.convergence: float
+        The "-c" command line option value, or None.
+    -- self.convergenceTopK: int
+        The "--convergence-top" command line option value.
+    -- self.coverageSampling: bool
+        The "--coverage-sampling" command line flag.
+    -- self.sampler: CoverageSampler
+        Draws subcorpora with "--coverage-sampling" (None otherwise).
+    -- self.weightUnit: int
+        Weight of a subcorpus in self.counts (more than 1 if subcorpora are
+        given fractional importance weights).
+    -- self.minFreq: int
+    -- self.minProba: float
+    -- self.topK: int
+        Output filters (see score_alignments()).
+    -- self.countsFinal: bool
+        Indicates whether the subcorpus being aligned is the last one, so
+        that alignment frequencies are final once it is aligned.
+    -- self.stateDir: str
+        The "--state" command line option value, or None.
+    -- self.peakRss: int
+        Highest resident set size seen while aligning and weighting the
+        current subcorpus (see note_rss()).
+    -- self.signatureGrouping: bool
+        The "--signature-grouping" command line flag.
+    -- self.engine: str
+        The "--engine" command line option value: 'python' or 'numpy'.
+    -- self.parallelSubcorpora: int
+        The "--parallel-subcorpora" command line option value.
+    -- self.pipelineWeights: bool
+        The "--pipeline-weights" command line flag.
+    -- self.weighting: (multiprocessing.Process, file)
+        Process computing lexical weights of the previous subcorpus, and
+        the file it writes them into, or None (see start_weighting()).
+    -- self.coocStore: CoocStore
+        Corpus-wide word cooccurrences for lexical weights, or None (see
+        _store_weight()).
+    -- self.demandCooc: bool
+        The "--demand-cooc" command line flag (see _demand_cooc()).
+    -- self.sweep: list(FilterConfig)
+        Filters of each table with "--sweep", or None (see set_sweep()).
+    -- self.sweepFilters: list(tuple)
+        For each configuration of self.sweep, a tuple (minLanguages,
+        minSize, maxSize, contiguousFields), as used by count_batch().
+    -- self.sweepTags: list(int)
+        Word ids of the tags of configurations in the subcorpus (see
+        set_corpus()).
+    -- self.numpyCorpus: dict
+        Subcorpus as NumPy arrays for the NumPy engine, built on first use
+        after set_corpus() (see _numpy_corpus()).
 
     Main process is as follows:
     1) Read all input files, keep only line start offsets in memory;
@@ -758,22 +3252,43 @@ class Aligner:
     5) repeat steps 2-4 until all input corpus is consumed;
     6) pass main alignment file to set_proba() function to add translation
     probabilities and format output.
+
+    Steps 2-5 are performed by align_lines(), and step 6 by alignments()
+    instead of set_proba() when no writer is given (see __init__()).
     
     """
 
-    def __init__(self, inputFilenames, writer, nbNewAlignments, maxNbLines,
-                 timeout, doLexWeight, discontiguousFields, minLanguages,
-                 minSize, maxSize, delimiter, indexN):
+    def __init__(self, inputFilenames, writer=None, nbNewAlignments=-1,
+                 maxNbLines=0, timeout=-1, doLexWeight=False,
+                 discontiguousFields='', minLanguages=None, minSize=1,
+                 maxSize=7, delimiter='', indexN=1, index=None,
+                 convergence=None, convergenceTopK=1000, adaptive=False,
+                 coverageSampling=False, collapseDuplicates=False,
+                 memoryLimit=None, stateDir=None, mixRatio=0.5, minFreq=1,
+                 minProba=0., topK=0, signatureGrouping=False,
+                 engine='python', parallelSubcorpora=1,
+                 pipelineWeights=False, coocStore=None, demandCooc=False,
+                 sweep=None):
         """Initializer.
 
-        Main process is coded in initializer. That's not very clean, but
-        simpler.
+        If <writer> is specified, main process is coded in initializer.
+        That's not very clean, but simpler. Otherwise, the corpus is only
+        indexed, and alignments are obtained on demand with alignments(),
+        as many times as needed (library use):
+
+        >>> aligner = Aligner(["corpus.txt"])             # doctest: +SKIP
+        >>> for record in aligner.alignments(timeout=10): # doctest: +SKIP
+        ...     print record.phrases, record.probas
+        >>> aligner.set_parameters(maxSize=3)             # doctest: +SKIP
+        >>> short = list(aligner.alignments(timeout=10))  # doctest: +SKIP
+        >>> aligner.close()                               # doctest: +SKIP
 
         -- inputFilenames: list(str)
             Filenames specified on acommand line. Can contain standard input
             "-". If so, stdin is dumped into a temporary file to permits
             random line access.
         -- writer: {Plain,Moses,HTML,TMX}Writer
+            None to only index the corpus.
         -- nbNewAlignments: int
             The "-a" command line option value.
         -- maxNbLines: int
@@ -794,99 +3309,847 @@ class Aligner:
             The "-d" command line option value.
         -- indexN: int
             The "-i" command line option value.
+        -- index: PhraseIndexBuilder
+            Built from output if specified (see set_proba()).
+        -- convergence: float
+            The "--convergence" command line option value, or None.
+        -- convergenceTopK: int
+            The "--convergence-top" command line option value.
+        -- adaptive: bool
+            Indicates whether the timeout is shared among subcorpora
+            adaptively (see run_adaptive()).
+        -- coverageSampling: bool
+            Indicates whether subcorpora are drawn with a CoverageSampler.
+        -- collapseDuplicates: bool
+            Indicates whether identical lines are loaded only once (see
+            collapse_duplicates()).
+        -- memoryLimit: int
+            The "--memory-limit" command line option value, in bytes, or
+            None. Replaces maxNbLines (see run_memory_bounded()).
+        -- stateDir: str
+            The "--state" command line option value, or None. If this
+            directory holds the state of a previous run, only lines
+            appended to input files since then are aligned (see
+            resume_state()). The new state is saved there (see
+            save_state()). Requires <writer>.
+        -- mixRatio: float
+            The "--mix-ratio" command line option value: number of old
+            lines aligned along with each new line when resuming.
+        -- minFreq: int
+            The "--min-freq" command line option value. Lexical weights of
+            less frequent alignments are not computed, when their final
+            frequency is known (see _lexical_weight()).
+        -- minProba: float
+            The "--min-proba" command line option value.
+        -- topK: int
+            The "--top-k-per-phrase" command line option value.
+        -- signatureGrouping: bool
+            Indicates whether words of large subcorpora are grouped by
+            signatures of their apparition vectors (see align()).
+        -- engine: str
+            The "--engine" command line option value (see align()).
+        -- parallelSubcorpora: int
+            The "--parallel-subcorpora" command line option value: number
+            of subcorpora aligned at the same time (see run_parallel()).
+        -- pipelineWeights: bool
+            Indicates whether lexical weights of a subcorpus are computed
+            while the next one is aligned (see start_weighting()).
+        -- coocStore: str
+            The "--cooc-store" command line option value: file name of a
+            cooccurrence store, built from the input files if it does not
+            exist or was built from other input (see build_cooc_store()
+            and input_identity()).
+        -- demandCooc: bool
+            Indicates whether only cooccurrences of word pairs found in
+            alignments are counted for lexical weights (see
+            _demand_cooc()).
+        -- sweep: list(FilterConfig)
+            Filters of several tables counted from the same subcorpora
+            (see set_sweep()). <writer> is then a list of writers, one per
+            table.
         """
-        self.minSize = minSize
-        self.maxSize = maxSize
-        if delimiter:
-            self.delimiter = delimiter
+        assert writer is not None or stateDir is None, \
+               "Saving state requires a writer"
+        self.coverageSampling = coverageSampling
+        self.sampler = None
+        if coverageSampling:
+            self.weightUnit = IMPORTANCE_WEIGHT_UNIT
         else:
-            self.delimiter = None
-        self.indexN = max(indexN, 1)
-        if doLexWeight:
-            self.weightFunc = self._lexical_weight
-        else:
-            self.weightFunc = self._dummy_weight
+            self.weightUnit = 1
+        self.convergence = convergence
+        self.convergenceTopK = convergenceTopK
+        self.signatureGrouping = signatureGrouping
+        assert engine == 'python' or numpy is not None, \
+               "The NumPy engine requires NumPy"
+        self.engine = engine
+        self.parallelSubcorpora = parallelSubcorpora
+        self.pipelineWeights = pipelineWeights
+        self.weighting = None
+        self.coocStore = None
+        self.demandCooc = demandCooc
+        self.sweep = None
+        self.numpyCorpus = None
         self.counts = {}
         self.nbAlignments = 0   # = sum(len(c) for c in self.counts)
+        self.countsFinal = False
+        self.stateDir = stateDir
+        self.peakRss = 0
         self.files = []
         self.weightedAlignmentFile = make_temp_file(".al_lw")
         try:
-            for f in inputFilenames:
-                if f == "-":
-                    inFile = make_temp_file(".stdin")
-                    inFile.writelines(sys.stdin)
-                    inFile.seek(0)
-                    self.files.append(inFile)
+            self.index_corpus(inputFilenames, collapseDuplicates, stateDir)
+            if coocStore is not None:
+                self.open_cooc_store(coocStore, inputFilenames)
+            self.set_parameters(doLexWeight, discontiguousFields,
+                                minLanguages, minSize, maxSize, delimiter,
+                                indexN, minFreq, minProba, topK)
+            if sweep is not None:
+                self.set_sweep(sweep)
+            if writer is not None:
+                self.align_lines(self.select_lines(mixRatio),
+                                 nbNewAlignments, maxNbLines, timeout,
+                                 adaptive, memoryLimit)
+                self.rescale_counts()
+                if stateDir is not None:
+                    self.save_state(stateDir)
+                if self.sweep is None:
+                    set_proba(self.weightedAlignmentFile, self.counts,
+                              writer, index, self.minFreq, self.minProba,
+                              self.topK)
                 else:
-                    self.files.append(open_compressed(f))
-            self.offsets = []
-            nbLines = None
-            self.nbLanguages = 0
-            for f in self.files:
-                offset = 0
-                fileOffsets = []
-                fileLanguages = None
-                lineId = -1
-                for lineId, line in enumerate(f):
-                    fl = line.count('\t') + 1
-                    if fileLanguages is None:
-                        fileLanguages = fl
-                        self.nbLanguages += fl
-                    else:
-                        assert fl == fileLanguages, "Found %i columns " \
-                               " instead of %i at line %i in file %s" % \
-                               (fl, fileLanguages, lineId + 1, f.name)
-                    fileOffsets.append(offset)
-                    offset += len(line)
+                    self.write_sweep(writer)
+        except:
+            self.close()
+            raise
+        if writer is not None:
+            self.close()
+
+
+    def index_corpus(self, inputFilenames, collapseDuplicates, stateDir):
+        """Open input files and index the start offsets of their lines.
+
+        -- inputFilenames: list(str)
+        -- collapseDuplicates: bool
+        -- stateDir: str
+            See __init__().
+        """
+        for f in inputFilenames:
+            if f == "-":
+                inFile = make_temp_file(".stdin")
+                inFile.writelines(sys.stdin)
+                inFile.seek(0)
+                self.files.append(inFile)
+            else:
+                self.files.append(open_compressed(f))
+        self.offsets = []
+        self.fileSizes = []
+        nbLines = None
+        self.nbLanguages = 0
+        lineKeys = bytearray()  # With collapseDuplicates only
+        nbOldLines = 0
+        if stateDir is not None and \
+           os.path.exists(os.path.join(stateDir, STATE_FILENAME)):
+            nbOldLines, nbLines = self.resume_state(stateDir)
+            filesToIndex = []
+        else:
+            filesToIndex = self.files
+        for fileNo, f in enumerate(filesToIndex):
+            # Only plain files can be split (not compressed, not stdin)
+            if __jobs__ > 1 and not collapseDuplicates and \
+               isinstance(f, file):
+                fileOffsets, fileLanguages, fileLines = \
+                             index_file(f.name, __jobs__)
+                if fileLanguages is not None:
+                    self.nbLanguages += fileLanguages
                 if nbLines is None:
-                    nbLines = lineId + 1
+                    nbLines = fileLines
                 else:
-                    assert nbLines == lineId + 1, \
+                    assert nbLines == fileLines, \
                            "Input files have different number of lines"
-                self.offsets.append(optimum_array(fileOffsets))
-                del fileOffsets
-            message("Input corpus: %i languages, %i lines\n" %
-                    (self.nbLanguages, nbLines))
-            
-            if minLanguages is None:
-                self.minLanguages = self.nbLanguages
+                self.offsets.append(fileOffsets)
+                self.fileSizes.append(os.path.getsize(f.name))
+                continue
+            offset = 0
+            fileOffsets = []
+            fileLanguages = None
+            lineId = -1
+            for lineId, line in enumerate(f):
+                fl = line.count('\t') + 1
+                if fileLanguages is None:
+                    fileLanguages = fl
+                    self.nbLanguages += fl
+                else:
+                    assert fl == fileLanguages, "Found %i columns " \
+                           " instead of %i at line %i in file %s" % \
+                           (fl, fileLanguages, lineId + 1, f.name)
+                fileOffsets.append(offset)
+                offset += len(line)
+                if not collapseDuplicates:
+                    continue
+                # Digest of the line in all files read so far
+                if fileNo == 0:
+                    lineKeys += md5(line).digest()
+                elif lineId < len(lineKeys) // DIGEST_SIZE:
+                    start = lineId * DIGEST_SIZE
+                    lineKeys[start:start + DIGEST_SIZE] = md5(
+                        str(lineKeys[start:start + DIGEST_SIZE]) +
+                        line).digest()
+            if nbLines is None:
+                nbLines = lineId + 1
             else:
-                self.minLanguages = minLanguages
+                assert nbLines == lineId + 1, \
+                       "Input files have different number of lines"
+            self.offsets.append(optimum_array(fileOffsets))
+            self.fileSizes.append(offset)
+            del fileOffsets
+        message("Input corpus: %i languages, %i lines" %
+                (self.nbLanguages, nbLines))
+        if collapseDuplicates:
+            nbLines = self.collapse_duplicates(lineKeys)
+            message(" (%i distinct)" % nbLines)
+        else:
+            self.multiplicity = None
+        del lineKeys
+        message("\n")
+        self.nbLines, self.nbOldLines = nbLines, nbOldLines
 
-            ncf = parse_field_numbers(discontiguousFields, self.nbLanguages)
-            self.contiguousFields = [(i + 1 not in ncf)
-                                     for i in xrange(self.nbLanguages)]
 
-            if timeout < 0:
-                timeout = None
+    def open_cooc_store(self, filename, inputFilenames):
+        """Open a cooccurrence store, (re)building it if needed.
 
-            if maxNbLines < 1:
-                nbCorpora = 1
+        -- filename: str
+        -- inputFilenames: list(str)
+            See __init__().
+
+        An existing store is rebuilt if it does not match the input:
+        number of languages and lines, size and modification time (so
+        that a store becomes stale when new lines are appended for
+        --state). It is also rebuilt if it was written by another version
+        or truncated (main() checks that the file is a store beforehand).
+        Raise IOError if the input changes while the store is built.
+        """
+        nbLines = self.nbLines
+        if self.multiplicity is not None:
+            nbLines = sum(self.multiplicity)
+        identity = input_identity(inputFilenames, self.nbLanguages, nbLines,
+                                  sum(self.fileSizes))
+        if os.path.exists(filename):
+            try:
+                self.coocStore = CoocStore(filename)
+            except ValueError, e:
+                message("%s\n" % e)
             else:
-                nbCorpora = int(math.ceil(1. * nbLines / maxNbLines))
-                message("Split input corpus into %i subcorpora" % nbCorpora)
-                if timeout is not None:
-                    timeout /= 1. * nbCorpora
-                    message(" (timeout: %.2fs each)" % timeout)
-                message("\n")
-            lines = range(nbLines)
-            random.shuffle(lines)
-            for nbCorpToDo in xrange(nbCorpora, 0, -1):
+                if self.coocStore.identity() == identity:
+                    return
+                self.coocStore.close()
+                self.coocStore = None
+                message("Cooccurrence store %s does not match the input\n"
+                        % filename)
+        build_cooc_store(self.files, filename, identity[-1])
+        self.coocStore = CoocStore(filename)
+        if self.coocStore.identity() != identity:
+            raise IOError("Input files changed while building %s" %
+                          filename)
+
+
+    def set_parameters(self, doLexWeight=False, discontiguousFields='',
+                       minLanguages=None, minSize=1, maxSize=7,
+                       delimiter='', indexN=1, minFreq=1, minProba=0., topK=0):
+        """Set the parameters of subsequent alignments.
+
+        -- doLexWeight: bool
+        -- discontiguousFields: str
+        -- minLanguages: int
+        -- minSize: int
+        -- maxSize: int
+        -- delimiter: str
+        -- indexN: int
+        -- minFreq: int
+        -- minProba: float
+        -- topK: int
+            See __init__().
+
+        The corpus index is kept, so that the same corpus can be aligned
+        with several settings.
+        """
+        self.minSize = minSize
+        self.maxSize = maxSize
+        if delimiter:
+            self.delimiter = delimiter
+        else:
+            self.delimiter = None
+        self.indexN = max(indexN, 1)
+        self.minFreq = minFreq
+        self.minProba = minProba
+        self.topK = topK
+        if doLexWeight and self.coocStore is not None:
+            self.weightFunc = self._store_weight
+        elif doLexWeight:
+            self.weightFunc = self._lexical_weight
+        else:
+            self.weightFunc = self._dummy_weight
+        if minLanguages is None:
+            self.minLanguages = self.nbLanguages
+        else:
+            self.minLanguages = minLanguages
+
+        ncf = parse_field_numbers(discontiguousFields, self.nbLanguages)
+        self.contiguousFields = [(i + 1 not in ncf)
+                                 for i in xrange(self.nbLanguages)]
+
+
+    def set_sweep(self, sweep):
+        """Count alignments for several filter configurations at once.
+
+        -- sweep: list(FilterConfig)
+            = self.sweep
+
+        Filters only decide which groups of words and which phrases make
+        alignments, once subcorpora are drawn and their words grouped
+        (see count_batch()). Each configuration's filters are applied
+        there in turn, and the alignments it keeps are tagged with a word
+        of its own (SWEEP_TAG, first in the first language), so that they
+        are counted apart. Tables are separated by write_sweep(). Filters
+        set by set_parameters() are not used for alignment anymore, and
+        neither is the NumPy engine.
+        """
+        self.sweep = sweep
+        self.sweepFilters = []
+        for config in sweep:
+            ncf = parse_field_numbers(config.discontiguousFields,
+                                      self.nbLanguages)
+            self.sweepFilters.append((config.minLanguages or
+                                      self.nbLanguages,
+                                      config.minSize, config.maxSize,
+                                      [(i + 1 not in ncf)
+                                       for i in xrange(self.nbLanguages)]))
+
+
+    def write_sweep(self, writers):
+        """Output one table per filter configuration (see set_sweep()).
+
+        -- writers: list({Plain,Moses,HTML,TMX}Writer)
+            One per configuration of self.sweep, in the same order.
+
+        Alignments are dealt into one temporary file and one count
+        dictionary per configuration, without their tags. Each table is
+        then output as set_proba() does, so that it is the same as if the
+        corpus had been aligned with that configuration alone.
+        """
+        tables = [({}, make_temp_file(".al_lw")) for _ in self.sweep]
+        self.weightedAlignmentFile.seek(0)
+        for line in self.weightedAlignmentFile:
+            alString = line.rsplit('\t', 1)[0]
+            freq = self.counts[len(alString)][hash(alString)]
+            tagEnd = 1
+            while line[tagEnd].isdigit():
+                tagEnd += 1
+            counts, outputFile = tables[int(line[1:tagEnd])]
+            if line[tagEnd] == ' ':
+                tagEnd += 1
+            alString = alString[tagEnd:]
+            counts.setdefault(len(alString), {})[hash(alString)] = freq
+            outputFile.write(line[tagEnd:])
+        self.counts.clear()
+        for configNo, (counts, outputFile) in enumerate(tables):
+            message("\rConfiguration %i/%i\n" % (configNo + 1,
+                                                   len(self.sweep)))
+            set_proba(outputFile, counts, writers[configNo], None,
+                      self.minFreq, self.minProba, self.topK)
+
+
+    def select_lines(self, mixRatio):
+        """Return the line numbers to align.
+
+        -- mixRatio: float
+            See __init__().
+
+        All lines, or if resuming a previous run, new lines and some old
+        ones.
+        """
+        if self.nbOldLines:
+            # New lines, and old ones to align them with
+            lines = range(self.nbOldLines, self.nbLines)
+            nbMixed = min(int(round(mixRatio * len(lines))),
+                          self.nbOldLines)
+            if lines and nbMixed:
+                lines.extend(random.sample(xrange(self.nbOldLines), nbMixed))
+            message("%i new lines to align, along with %i old ones\n" %
+                    (self.nbLines - self.nbOldLines,
+                     len(lines) - self.nbLines + self.nbOldLines))
+        else:
+            lines = range(self.nbLines)
+        return lines
+
+
+    def align_lines(self, lines, nbNewAlignments, maxNbLines, timeout,
+                    adaptive=False, memoryLimit=None):
+        """Align the specified corpus lines, by subcorpora if needed.
+
+        -- lines: list(int)
+            Line numbers (indices of arrays in self.offsets). Emptied.
+        -- nbNewAlignments: int
+        -- maxNbLines: int
+        -- timeout: float
+        -- adaptive: bool
+        -- memoryLimit: int
+            See __init__().
+
+        Alignments add up to self.counts and self.weightedAlignmentFile.
+        """
+        if timeout is not None and timeout < 0:
+            timeout = None
+        self.countsFinal = False
+
+        nbToAlign = len(lines)
+
+        if memoryLimit is not None and nbToAlign:
+            model = self.memory_pilot(lines, memoryLimit)
+            rss = current_rss()
+            if rss >= memoryLimit:
+                raise MemoryError("Memory limit of %i MB is below the %i MB "
+                                  "already used" % (memoryLimit >> 20,
+                                                    rss >> 20))
+            maxNbLines = model.size_for(nbToAlign, timeout, nbToAlign)
+            message("Memory limit: %i lines per subcorpus at first\n" %
+                    maxNbLines)
+            if maxNbLines >= nbToAlign:
+                maxNbLines = 0
+        if not nbToAlign:
+            nbCorpora = 0
+        elif maxNbLines < 1:
+            nbCorpora = 1
+        else:
+            nbCorpora = int(math.ceil(1. * nbToAlign / maxNbLines))
+            message("Split input corpus into %i subcorpora" % nbCorpora)
+            adaptive = adaptive and timeout is not None and nbCorpora > 1
+            if adaptive:
+                message(" (timeout: %.2fs, shared adaptively)" % timeout)
+            elif memoryLimit is not None:
+                message(" (sizes adapted to memory use)")
+            elif timeout is not None:
+                timeout /= 1. * nbCorpora
+                message(" (timeout: %.2fs each)" % timeout)
+            message("\n")
+        random.shuffle(lines)
+        if memoryLimit is not None and nbCorpora > 1 and not adaptive:
+            self.run_memory_bounded(lines, model, timeout,
+                                    nbNewAlignments)
+            nbCorpora = 0   # Nothing left
+        selections = []
+        for nbCorpToDo in xrange(nbCorpora, 0, -1):
+            selection = [lines.pop() for _ in
+                         xrange(int(math.ceil(1. * len(lines) /
+                                              nbCorpToDo)))]
+            selection.sort()    # Speed up disk access
+            selections.append(selection)
+        if nbCorpora > 1 and adaptive:
+            self.run_adaptive(selections, timeout, nbNewAlignments)
+        elif nbCorpora > 1 and self.parallelSubcorpora > 1:
+            self.run_parallel(selections, timeout, nbNewAlignments)
+        else:
+            for i, selection in enumerate(selections):
                 if nbCorpora > 1:
-                    message("\r%i subcorpora remaining\n" % nbCorpToDo)
-                selection = [lines.pop() for _ in
-                             xrange(int(math.ceil(1. * len(lines) /
-                                                  nbCorpToDo)))]
-                selection.sort()    # Speed up disk access
+                    message("\r%i subcorpora remaining\n" %
+                            (nbCorpora - i))
+                self.countsFinal = i == len(selections) - 1
                 self.set_corpus(selection)
                 self.run(timeout, nbNewAlignments)
-            set_proba(self.weightedAlignmentFile, self.counts, writer)
+        self.finish_weighting()
+
+
+    def rescale_counts(self):
+        """Turn self.counts back into frequencies in numbers of subcorpora."""
+        if self.weightUnit > 1:
+            unit = 1. * self.weightUnit
+            for c in self.counts.itervalues():
+                for alHash, freq in c.iteritems():
+                    c[alHash] = max(1, int(round(freq / unit)))
+
+
+    def alignments(self, nbNewAlignments=-1, maxNbLines=0, timeout=-1,
+                   adaptive=False, memoryLimit=None, lines=None):
+        """Align the corpus and iterate over alignments found.
+
+        -- nbNewAlignments: int
+        -- maxNbLines: int
+        -- timeout: float
+        -- adaptive: bool
+        -- memoryLimit: int
+            Budgets, see __init__().
+        -- lines: iterable(int)
+            Line numbers to align (all lines by default).
+
+        AlignmentRecord's are yielded by decreasing frequency (lexWeights
+        is None without lexical weights). Alignment counts are then
+        cleared (see reset()), so that each call is independent.
+        """
+        if lines is None:
+            lines = range(self.nbLines)
+        else:
+            lines = list(lines)
+        try:
+            self.align_lines(lines, nbNewAlignments, maxNbLines, timeout,
+                             adaptive, memoryLimit)
+            self.rescale_counts()
+            nbAlignments, scored = score_alignments(
+                self.weightedAlignmentFile, self.counts, self.minFreq,
+                self.minProba, self.topK)
+            try:
+                for alignmentStr, lexWeights, probas, freq in scored:
+                    if lexWeights == "-":
+                        lexWeights = None
+                    else:
+                        lexWeights = tuple([float(lw)
+                                            for lw in lexWeights.split()])
+                    yield AlignmentRecord(tuple(alignmentStr.split('\t')),
+                                          lexWeights, tuple(probas), freq)
+            finally:
+                scored.close()
         finally:
-            self.weightedAlignmentFile.close()
-            for f in self.files:
-                f.close()
+            self.reset()
+
+
+    def reset(self):
+        """Forget alignments found so far, keeping the corpus index."""
+        self.weightedAlignmentFile.close()
+        self.weightedAlignmentFile = make_temp_file(".al_lw")
+        self.counts = {}
+        self.nbAlignments = 0
+        self.release_corpus()
+
+
+    def close(self):
+        """Close input and temporary files."""
+        self.weightedAlignmentFile.close()
+        for f in self.files:
+            f.close()
+        if self.coocStore is not None:
+            self.coocStore.close()
+            self.coocStore = None
+
+
+    def memory_pilot(self, lines, memoryLimit):
+        """Estimate memory needs from a sample of the input corpus.
+
+        -- lines: list(int)
+            Line numbers to align.
+        -- memoryLimit: int
+            The "--memory-limit" command line option value, in bytes.
+
+        Return a MemoryModel. The sample is loaded and aligned during
+        MEMORY_PILOT_TIME seconds to measure tokens and n-grams per line,
+        vocabulary growth between its two halves, and the number of new
+        alignments per line. Alignments found are discarded.
+        """
+        nbPilot = min(len(lines), MEMORY_PILOT_LINES)
+        self.set_corpus(sorted(random.sample(lines, nbPilot)))
+        half = max(nbPilot // 2, 1)
+        nbTokens = sum([len(line) for line in self.corpus])
+        nbTypes = len(self.allWords) - 1    # Without delimiter
+        halfTypes = set()
+        for line in self.corpus[:half]:
+            halfTypes.update(line)
+        halfTypes = len(halfTypes)
+        for ngramCorpus in self.ngramCorpora:
+            ngramTypes = set()
+            for lineNo, line in enumerate(ngramCorpus):
+                nbTokens += len(line)
+                if lineNo < half:
+                    ngramTypes.update(line)
+            halfTypes += len(ngramTypes)
+        nbTypes += sum([len(ngrams) for ngrams in self.allNgrams])
+        if half < nbPilot and 0 < halfTypes < nbTypes:
+            vocabBeta = math.log(1. * nbTypes / halfTypes) / \
+                        math.log(1. * nbPilot / half)
+            vocabBeta = min(max(vocabBeta, 0.1), 1.)
+        else:
+            vocabBeta = 1.
+        vocabK = nbTypes / nbPilot ** vocabBeta
+
+        counts, nbAlignments = self.counts, self.nbAlignments
+        self.counts = {}
+        tmpFile = make_temp_file(".al")
+        try:
+            nextRandomSize = Distribution(self.main_distribution, 1,
+                                          nbPilot).next
+            startTime = time()
+            while time() - startTime < MEMORY_PILOT_TIME:
+                self.align(random.sample(xrange(nbPilot), nextRandomSize()),
+                           tmpFile)
+            pilotTime = time() - startTime
+            nbPilotAlignments = self.nbAlignments - nbAlignments
+        finally:
+            tmpFile.close()
+            self.counts, self.nbAlignments = counts, nbAlignments
+            self.release_corpus()
+        lineBytes = LINE_BYTES * self.indexN + \
+                    TOKEN_BYTES * nbTokens / nbPilot
+        message("Memory pilot: %i lines, %.1f tokens/line, %i types "
+                "(growth %.2f), %.1f alignments/line\n" %
+                (nbPilot, 1. * nbTokens / nbPilot, nbTypes, vocabBeta,
+                 1. * nbPilotAlignments / nbPilot))
+        return MemoryModel(memoryLimit, lineBytes, vocabK, vocabBeta,
+                           1. * nbPilotAlignments / nbPilot, pilotTime)
+
+
+    def run_memory_bounded(self, lines, model, timeout, nbNewAlignments):
+        """Align subcorpora sized to fit in memory.
+
+        -- lines: list(int)
+            Line numbers left to align, in random order. Emptied.
+        -- model: MemoryModel
+        -- timeout: float
+            The "-t" command line argument (None if unlimited).
+        -- nbNewAlignments: int
+            The "-a" command line argument.
+
+        Each subcorpus gets as many lines as the model predicts to fit in
+        the memory left, and a share of the time left in proportion to
+        its size. The peak increase of resident set size observed while
+        loading, aligning and weighting it (see note_rss()) then corrects
+        the model for the next ones.
+        """
+        startTime = time()
+        subcorpusNo = 0
+        warned = False
+        while lines:
+            subcorpusNo += 1
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = max(timeout - (time() - startTime), 0.)
+            nbSelected = model.size_for(len(lines), remaining, len(lines))
+            if remaining is None:
+                budget = None
+            else:
+                budget = remaining * nbSelected / len(lines)
+            selection = sorted(lines[-nbSelected:])
+            del lines[-nbSelected:]
+            rssBefore = current_rss()
+            message("\r%i lines remaining. Subcorpus %i: %i lines" %
+                    (len(lines) + nbSelected, subcorpusNo, nbSelected))
+            if budget is not None:
+                message(" (timeout: %.2fs)" % budget)
+            message(", RSS %i MB\n" % (rssBefore >> 20))
+            self.countsFinal = not lines
+            self.set_corpus(selection)
+            self.peakRss = 0
+            self.note_rss()
+            self.run(budget, nbNewAlignments)
+            self.note_rss()
+            rssPeak = self.peakRss
+            model.update(nbSelected, budget, rssPeak - rssBefore)
+            self.release_corpus()
+            if rssPeak > model.limit and not warned:
+                message("Warning: memory limit exceeded (%i MB)\n" %
+                        (rssPeak >> 20))
+                warned = True
+
+
+    def note_rss(self):
+        """Update self.peakRss with the current resident set size.
+
+        Called about once per second while aligning, and when word
+        cooccurrences are counted for lexical weights, so that peaks
+        freed before run() returns are seen too.
+        """
+        self.peakRss = max(self.peakRss, current_rss())
+
+
+    def resume_state(self, stateDir):
+        """Load the state of a previous run, and index lines appended since.
+
+        -- stateDir: str
+            Directory written by save_state().
+
+        Old line offsets are loaded rather than recomputed, so that only
+        new lines are read (compressed files still have to be decompressed
+        up to them). Input files are checked to have only been appended to,
+        from the digest of their last STATE_CHECK_SIZE bytes. Alignments
+        and frequencies of the previous run are loaded into self.counts and
+        self.weightedAlignmentFile, so that new alignments add up to them.
+
+        Return a tuple (number of lines in previous run, number of lines).
+        """
+        stateFile = open(os.path.join(stateDir, STATE_FILENAME))
+        try:
+            state = json.load(stateFile)
+        finally:
+            stateFile.close()
+        assert len(state["files"]) == len(self.files), \
+               "Expected %i input files, as in previous run" % \
+               len(state["files"])
+        self.nbLanguages = state["nbLanguages"]
+        nbOldLines = state["nbLines"]
+        nbLines = None
+        for fileNo, (f, fileState) in enumerate(zip(self.files,
+                                                    state["files"])):
+            size = fileState["size"]
+            f.seek(max(size - STATE_CHECK_SIZE, 0))
+            tail = f.read(size - f.tell())
+            assert md5(tail).hexdigest() == fileState["digest"], \
+                   "File %s was modified since previous run (only " \
+                   "appending lines is allowed)" % f.name
+            fileOffsets = array(str(fileState["typecode"]))
+            offsetsFile = open(os.path.join(stateDir, "offsets.%i" % fileNo),
+                               "rb")
+            try:
+                fileOffsets.fromfile(offsetsFile, nbOldLines)
+            finally:
+                offsetsFile.close()
+
+            offset = size
+            newOffsets = []
+            fileLanguages = fileState["nbLanguages"]
+            lineId = nbOldLines - 1
+            for lineId, line in enumerate(f, nbOldLines):
+                fl = line.count('\t') + 1
+                assert fl == fileLanguages, "Found %i columns " \
+                       " instead of %i at line %i in file %s" % \
+                       (fl, fileLanguages, lineId + 1, f.name)
+                newOffsets.append(offset)
+                offset += len(line)
+            assert not newOffsets or not tail or tail.endswith('\n'), \
+                   "Last line of file %s was incomplete in previous run" % \
+                   f.name
+            if nbLines is None:
+                nbLines = lineId + 1
+            else:
+                assert nbLines == lineId + 1, \
+                       "Input files have different number of lines"
+            if newOffsets:
+                typecode = optimum_typecode(newOffsets[-1])
+                if typecode is None:
+                    fileOffsets = tuple(fileOffsets) + tuple(newOffsets)
+                else:
+                    if array(typecode).itemsize > fileOffsets.itemsize:
+                        fileOffsets = array(typecode, fileOffsets)
+                    fileOffsets.extend(newOffsets)
+            self.offsets.append(fileOffsets)
+            self.fileSizes.append(offset)
+
+        alignmentsFile = gzip.open(os.path.join(stateDir, "alignments.gz"))
+        try:
+            for line in alignmentsFile:
+                alignment_lw, freq = line.rstrip('\n').rsplit('\t', 1)
+                alignment = alignment_lw.rsplit('\t', 1)[0]
+                self.counts.setdefault(len(alignment), {})[hash(alignment)] = \
+                    int(freq, 16) * self.weightUnit
+                print >> self.weightedAlignmentFile, alignment_lw
+                self.nbAlignments += 1
+        finally:
+            alignmentsFile.close()
+        message("Previous run: %i lines, %i alignments\n" %
+                (nbOldLines, self.nbAlignments))
+        return nbOldLines, nbLines
+
+
+    def save_state(self, stateDir):
+        """Save what the next run needs to resume from this one.
+
+        -- stateDir: str
+
+        Files are: STATE_FILENAME (JSON description of input files), line
+        offsets of each input file ("offsets.<fileNo>", binary arrays), and
+        alignments with their lexical weights and frequencies
+        ("alignments.gz", as in set_proba()). The state is written into a
+        new directory, which then replaces <stateDir>.
+        """
+        newDir = stateDir.rstrip(os.sep) + ".new"
+        oldDir = stateDir.rstrip(os.sep) + ".old"
+        for d in (newDir, oldDir):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+        os.makedirs(newDir)
+        message("Saving state into %s\n" % stateDir)
+        files = []
+        for fileNo, (f, fileOffsets, size) in \
+                enumerate(zip(self.files, self.offsets, self.fileSizes)):
+            f.seek(0)
+            nbLanguages = f.readline().count('\t') + 1
+            f.seek(max(size - STATE_CHECK_SIZE, 0))
+            digest = md5(f.read(size - f.tell())).hexdigest()
+            if not isinstance(fileOffsets, array):
+                fileOffsets = array(optimum_typecode(max(fileOffsets[-1:]
+                                                         or [0])) or 'L',
+                                    fileOffsets)
+            offsetsFile = open(os.path.join(newDir, "offsets.%i" % fileNo),
+                               "wb")
+            try:
+                fileOffsets.tofile(offsetsFile)
+            finally:
+                offsetsFile.close()
+            files.append({"name": f.name, "size": size, "digest": digest,
+                          "nbLanguages": nbLanguages,
+                          "typecode": fileOffsets.typecode})
+
+        alignmentsFile = gzip.open(os.path.join(newDir, "alignments.gz"),
+                                   "wb", 1)
+        try:
+            self.weightedAlignmentFile.seek(0)
+            for line in self.weightedAlignmentFile:
+                line = line.rstrip('\n')
+                alignment = line.rsplit('\t', 1)[0]
+                print >> alignmentsFile, "%s\t%x" % \
+                      (line, self.counts[len(alignment)][hash(alignment)])
+        finally:
+            alignmentsFile.close()
+
+        stateFile = open(os.path.join(newDir, STATE_FILENAME), "w")
+        try:
+            json.dump({"nbLanguages": self.nbLanguages,
+                       "nbLines": len(self.offsets[0]),
+                       "files": files}, stateFile, indent=1)
+        finally:
+            stateFile.close()
+        if os.path.exists(stateDir):
+            os.rename(stateDir, oldDir)
+            os.rename(newDir, stateDir)
+            shutil.rmtree(oldDir)
+        else:
+            os.rename(newDir, stateDir)
+
 
-        
+    def release_corpus(self):
+        """Free memory used by the subcorpus loaded into memory."""
+        self.corpus = self.allNgrams = self.ngramCorpora = None
+        self.allWords = self.wordLanguages = self.wordFreq = None
+        self.lineMultiplicity = self.sampler = self.numpyCorpus = None
+
+
+    def collapse_duplicates(self, lineKeys):
+        """Keep only one copy of identical lines.
+
+        -- lineKeys: bytearray
+            For each line, a digest of its contents in all input files
+            (DIGEST_SIZE bytes each, concatenated, rather than a list of
+            strings which would take several times more memory).
+
+        Only offsets of the first copy of each line are kept in
+        self.offsets, and self.multiplicity records how many copies there
+        were. Return the number of distinct lines.
+        """
+        distinctIds = {}
+        kept = []
+        multiplicity = []
+        for lineId in xrange(len(lineKeys) // DIGEST_SIZE):
+            key = str(lineKeys[lineId * DIGEST_SIZE:
+                               (lineId + 1) * DIGEST_SIZE])
+            distinctId = distinctIds.get(key)
+            if distinctId is None:
+                distinctIds[key] = len(kept)
+                kept.append(lineId)
+                multiplicity.append(1)
+            else:
+                multiplicity[distinctId] += 1
+        del distinctIds
+        self.offsets = [optimum_array([fileOffsets[lineId]
+                                       for lineId in kept],
+                                      fileOffsets[kept[-1]])
+                        for fileOffsets in self.offsets]
+        self.multiplicity = optimum_array(multiplicity)
+        return len(kept)
 
     def set_corpus(self, lines):
         """Load subcorpus into memory.
@@ -895,6 +4158,7 @@ class Aligner:
             The line numbers. These are indices of arrays in self.offsets.
         """
         self.corpus = [[] for _ in lines]
+        self.numpyCorpus = None
         self.allWords, self.wordLanguages = [], []
         allWordIds = [{} for _ in xrange(self.nbLanguages)]
         nbLanguagesDone = 0
@@ -918,9 +4182,17 @@ class Aligner:
 
         # Compute word frequencies
         self.wordFreq = [0] * len(self.allWords)
-        for line in self.corpus:
-            for wordId in set(line):
-                self.wordFreq[wordId] += 1
+        if self.multiplicity is None:
+            self.lineMultiplicity = None
+            for line in self.corpus:
+                for wordId in set(line):
+                    self.wordFreq[wordId] += 1
+        else:
+            self.lineMultiplicity = [self.multiplicity[lineId]
+                                     for lineId in lines]
+            for line, nbCopies in zip(self.corpus, self.lineMultiplicity):
+                for wordId in set(line):
+                    self.wordFreq[wordId] += nbCopies
 
         # Add discontinuity delimiter
         self.allWords.append(self.delimiter)
@@ -943,6 +4215,15 @@ class Aligner:
         self.wordFreq.sort(reverse=True)
         self.wordFreq = optimum_array(self.wordFreq)
 
+        if self.sweep is not None:  # Tags never occur in the corpus
+            self.sweepTags = range(len(self.allWords),
+                                   len(self.allWords) + len(self.sweep))
+            self.allWords.extend([SWEEP_TAG % configNo
+                                  for configNo in xrange(len(self.sweep))])
+
+        if self.coverageSampling:
+            self.sampler = CoverageSampler(self.corpus, len(self.allWords))
+
         ### new with -i option ###
         # Store multiple n-gram-ized copies of the corpus to speed up
         # subsequent alignment phase. That's memory intensive, but
@@ -997,6 +4278,12 @@ class Aligner:
             if not all-in-memory).
         -- nbNewAlignments: int
             The "-a" command line argument.
+
+        If self.convergence is set, also stop when the most frequent
+        alignments are stable (see ConvergenceMonitor).
+
+        Return a tuple (time spent aligning, number of new alignments, rate
+        of new alignments per second when alignment stopped).
         """
         nbLines = len(self.corpus)
         if nbLines > 2: # Speed up by not using subcorpora of size 1 or nbLines
@@ -1019,6 +4306,13 @@ class Aligner:
         previousWriteLen = 0
         lastWriteTime = startTime = time()
         speed = sys.maxint
+        nbAlignmentsBefore = self.nbAlignments
+        samples = []    # Subcorpora to be aligned with align_batch()
+        batchLines = 0
+        if self.convergence is None:
+            monitor = None
+        else:
+            monitor = ConvergenceMonitor(self.convergenceTopK)
 
         print >> sys.stderr, "\rAligning... (ctrl-c to interrupt)"
         # Do not compress this temp file ! Some alignments are not actually
@@ -1040,11 +4334,23 @@ class Aligner:
                                   (nbSubcorporaDone,
                                    1. * subcorporaDoneSum / nbSubcorporaDone,
                                    self.nbAlignments, speed)
+                        if monitor is not None and \
+                           monitor.check(self.counts, t) is not None:
+                            if monitor.distance < self.convergence:
+                                message("\rTop %i alignments converged "
+                                        "(change %.2e)%s\n" %
+                                        (monitor.topK, monitor.distance,
+                                         " " * previousWriteLen))
+                                break
+                        if monitor is not None and \
+                           monitor.distance is not None:
+                            toWrite += ", top change %.2e" % monitor.distance
                         message("\r%s%s" % (toWrite," " * (previousWriteLen -
                                                            len(toWrite))))
                         previousWriteLen = len(toWrite)
                         previousNbAl = self.nbAlignments
                         lastWriteTime = t
+                        self.note_rss()
                     
                     
                     subcorpusSize = nextRandomSize()
@@ -1055,18 +4361,38 @@ class Aligner:
                     
                     nbSubcorporaDone += 1
                     subcorporaDoneSum += subcorpusSize
-                    self.align(random.sample(xrange(nbLines), subcorpusSize),
-                               tmpFile)
+                    if self.sampler is None:
+                        samples.append(random.sample(xrange(nbLines),
+                                                     subcorpusSize))
+                        batchLines += subcorpusSize
+                        if batchLines >= ALIGN_BATCH_LINES:
+                            batch, samples, batchLines = samples, [], 0
+                            self.align_batch(batch, tmpFile)
+                    else:
+                        lineIds, weight = self.sampler.sample(subcorpusSize)
+                        fracWeight, weight = math.modf(weight *
+                                                       self.weightUnit)
+                        weight = int(weight)
+                        if random.random() < fracWeight:
+                            weight += 1
+                        if weight:
+                            self.align(lineIds, tmpFile, weight)
             except KeyboardInterrupt:
                 toWrite = "(%i subcorpora, avg=%.2f) Alignment interrupted! " \
                           "Proceeding..." % (nbSubcorporaDone,
                                              1. * subcorporaDoneSum
-                                             / nbSubcorporaDone)
+                                             / max(nbSubcorporaDone, 1))
             else:
                 toWrite = "(%i subcorpora, avg=%.2f) Alignment done, " \
                           "proceeding... " % (nbSubcorporaDone,
                                               1. * subcorporaDoneSum
-                                              / nbSubcorporaDone)
+                                              / max(nbSubcorporaDone, 1))
+            if samples:     # Drawn subcorpora not aligned yet
+                self.align_batch(samples, tmpFile)
+            alignmentTime = time() - startTime
+            if speed == sys.maxint:     # Stopped before first measure
+                speed = (self.nbAlignments - nbAlignmentsBefore) \
+                        / max(alignmentTime, 1e-3)
             print >> sys.stderr, "\r%s%s" % \
                   (toWrite, " " * (previousWriteLen - len(toWrite)))
             
@@ -1077,6 +4403,8 @@ class Aligner:
                 weightN = 2 * nb2 * math.log(1 - 2. / (nbLines + 1)) \
                           / (nbLines * math.log(1 -
                                                 1. * nbLines / (nbLines + 1)))
+                weight1 *= self.weightUnit
+                weightN *= self.weightUnit
                 if weight1:
                     frac1, weight1 = math.modf(weight1)
                     weight1 = int(weight1)
@@ -1095,9 +4423,260 @@ class Aligner:
                         self.align(xrange(nbLines), tmpFile, w)
             
             tmpFile.seek(0)
-            self.weightFunc(tmpFile)
+            if self.pipelineWeights and not self.countsFinal and \
+               self.weightFunc == self._lexical_weight:
+                self.start_weighting(tmpFile)
+            else:
+                self.finish_weighting()     # Keep subcorpora in order
+                self.weightFunc(tmpFile)
         finally:
             tmpFile.close()
+        return (alignmentTime, self.nbAlignments - nbAlignmentsBefore,
+                speed)
+
+
+    def start_weighting(self, inputFile):
+        """Compute lexical weights of the subcorpus in a child process.
+
+        -- inputFile: file
+            Alignments of the subcorpus (see self.weightFunc).
+
+        The child process works on a copy of the subcorpus, so that the
+        next one can be loaded and aligned at the same time. At most one
+        subcorpus is weighted at a time: the previous one is waited for
+        first (see finish_weighting()).
+        """
+        self.finish_weighting()
+        outputFile = make_temp_file(".al_lw")
+        process = multiprocessing.Process(target=self.weight_subcorpus,
+                                          args=(inputFile, outputFile))
+        process.start()
+        self.weighting = process, outputFile
+
+
+    def weight_subcorpus(self, inputFile, outputFile):
+        """Compute lexical weights in a child process (see start_weighting()).
+
+        -- inputFile: file
+        -- outputFile: file
+            Weighted alignments are written into this file.
+        """
+        global __verbose__
+        __verbose__ = False     # Would mix with alignment progress
+        # Inherited objects are kept: the temporary file would be deleted,
+        # and freeing counts would copy all their memory pages. Counts
+        # are only needed for final frequencies (see _lexical_weight()).
+        self.inheritedObjects = self.weightedAlignmentFile, self.counts
+        self.weightedAlignmentFile = outputFile
+        self.counts = {}
+        self.weightFunc(inputFile)
+        outputFile.flush()
+
+
+    def finish_weighting(self):
+        """Wait for lexical weights of the previous subcorpus, if any.
+
+        Weighted alignments are appended to self.weightedAlignmentFile.
+        """
+        if self.weighting is None:
+            return
+        process, outputFile = self.weighting
+        self.weighting = None
+        try:
+            process.join()
+            assert process.exitcode == 0, \
+                   "Lexical weights computation failed"
+            outputFile.seek(0)
+            shutil.copyfileobj(outputFile, self.weightedAlignmentFile)
+        finally:
+            outputFile.close()
+
+
+    def run_adaptive(self, selections, timeout, nbNewAlignments):
+        """Align subcorpora, sharing the timeout according to productivity.
+
+        -- selections: list(list(int))
+            Line numbers of each subcorpus (see set_corpus()).
+        -- timeout: float
+            The "-t" command line argument.
+        -- nbNewAlignments: int
+            The "-a" command line argument.
+
+        1) Each subcorpus is aligned for ADAPTIVE_EXPLORATION of an even
+        share of the remaining time (time left unused by subcorpora that
+        stop early, because of -a or -c, goes to the next ones);
+        2) the remaining time is given to subcorpora still producing new
+        alignments, in proportion to their rate of new alignments when
+        they stopped, most productive first. Again, time left unused is
+        shared among the next ones.
+
+        As with an even split, only alignment time (as returned by run())
+        is charged against <timeout>: loading subcorpora, including those
+        aligned again, and computing lexical weights are not.
+        """
+        remaining = timeout
+        rates = []
+        for i, selection in enumerate(selections):
+            budget = ADAPTIVE_EXPLORATION * remaining / (len(selections) - i)
+            message("\rSubcorpus %i/%i: %i lines, %.2fs\n" %
+                    (i + 1, len(selections), len(selection), budget))
+            self.set_corpus(selection)
+            elapsed, nbNew, rate = self.run(budget, nbNewAlignments)
+            remaining -= elapsed
+            message("Subcorpus %i: %i new alignments in %.2fs, %i al/s at "
+                    "end\n" % (i + 1, nbNew, elapsed, rate))
+            if rate > nbNewAlignments:
+                rates.append((rate, i))
+
+        rates.sort(reverse=True)
+        totalRate = sum([rate for rate, _ in rates])
+        for rate, i in rates:
+            if remaining <= 0:
+                break
+            budget = remaining * rate / totalRate
+            totalRate -= rate
+            message("\rSubcorpus %i/%i (again, %i al/s): %.2fs\n" %
+                    (i + 1, len(selections), rate, budget))
+            self.set_corpus(selections[i])
+            elapsed, nbNew, rate = self.run(budget, nbNewAlignments)
+            remaining -= elapsed
+            message("Subcorpus %i: %i new alignments in %.2fs, %i al/s at "
+                    "end\n" % (i + 1, nbNew, elapsed, rate))
+
+
+    def run_parallel(self, selections, timeout, nbNewAlignments):
+        """Align subcorpora in self.parallelSubcorpora worker processes.
+
+        -- selections: list(list(int))
+            Line numbers of each subcorpus (see set_corpus()).
+        -- timeout: float
+        -- nbNewAlignments: int
+            See run(), for each subcorpus.
+
+        Each worker aligns one subcorpus and weights its alignments on
+        its own (see align_subcorpus()), then they are merged into
+        self.counts and self.weightedAlignmentFile, in the order of
+        <selections>. Each worker is given its own random seed, drawn
+        here. As many subcorpora as workers are in memory at once.
+
+        On ctrl-c, workers interrupt the alignment of their subcorpus as
+        run() does, subcorpora not started yet are skipped, and those
+        completed are merged. A second ctrl-c aborts.
+        """
+        global __subcorpusAligner__, __subcorpusStop__
+        __subcorpusAligner__ = self
+        __subcorpusStop__ = multiprocessing.Event()
+        nbWorkers = min(self.parallelSubcorpora, len(selections))
+        message("Aligning %i subcorpora at once\n" % nbWorkers)
+        resultFiles = [make_temp_file(".al_lw_freq") for _ in selections]
+        jobs = [(selection, timeout, nbNewAlignments,
+                 random.getrandbits(32), resultFile.name)
+                for selection, resultFile in zip(selections, resultFiles)]
+        # One process per subcorpus, so that memory is given back
+        pool = multiprocessing.Pool(nbWorkers, maxtasksperchild=1)
+        try:
+            results = pool.imap(align_subcorpus, jobs)
+            i = 0
+            while i < len(jobs):
+                # Without a timeout, waiting would block signals
+                try:
+                    nbNew = results.next(1.)
+                except multiprocessing.TimeoutError:
+                    continue
+                except KeyboardInterrupt:
+                    if __subcorpusStop__.is_set():
+                        raise
+                    __subcorpusStop__.set()
+                    message("\rAlignment interrupted! Finishing subcorpora "
+                            "being aligned...\n")
+                    continue
+                if nbNew is None:
+                    message("\rSubcorpus %i/%i: skipped\n" %
+                            (i + 1, len(selections)))
+                else:
+                    message("\rSubcorpus %i/%i: %i alignments\n" %
+                            (i + 1, len(selections), nbNew))
+                    self.merge_counts(resultFiles[i])
+                resultFiles[i].close()
+                i += 1
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            for resultFile in resultFiles:
+                resultFile.close()
+            __subcorpusAligner__ = __subcorpusStop__ = None
+
+
+    def align_subcorpus(self, selection, timeout, nbNewAlignments, seed,
+                        resultFilename):
+        """Align a subcorpus in a worker process (see run_parallel()).
+
+        -- selection: list(int)
+        -- timeout: float
+        -- nbNewAlignments: int
+            See run_parallel().
+        -- seed: int
+            Seed of the random generator.
+        -- resultFilename: str
+            Weighted alignments are written into this file, followed by
+            their frequency in hexadecimal (tab separated).
+
+        Return the number of alignments found.
+        """
+        random.seed(seed)
+        # Inherited temporary files would be deleted if they were garbage
+        # collected here, and input file positions are shared with other
+        # processes: keep them, and reopen inputs
+        self.inheritedFiles = self.files + [self.weightedAlignmentFile]
+        self.files = [open_compressed(f.name) for f in self.files]
+        self.weightedAlignmentFile = make_temp_file(".al_lw")
+        self.counts = {}
+        self.nbAlignments = 0
+        self.countsFinal = False
+        self.pipelineWeights = False
+        self.set_corpus(selection)
+        self.run(timeout, nbNewAlignments)
+        self.release_corpus()
+        resultFile = open(resultFilename, "wb")
+        try:
+            self.weightedAlignmentFile.seek(0)
+            for line in self.weightedAlignmentFile:
+                line = line.rstrip('\n')
+                alString = line.rsplit('\t', 1)[0]
+                print >> resultFile, "%s\t%x" % \
+                      (line, self.counts[len(alString)][hash(alString)])
+        finally:
+            resultFile.close()
+            # Workers exit without cleaning up
+            self.weightedAlignmentFile.close()
+            for f in self.files:
+                f.close()
+        return self.nbAlignments
+
+
+    def merge_counts(self, inputFile):
+        """Add weighted alignments and frequencies of a subcorpus.
+
+        -- inputFile: file
+            Lines "<alignment> <tab> <lexical weights> <tab> <frequency in
+            hexadecimal>" (see align_subcorpus()).
+
+        New alignments are appended to self.weightedAlignmentFile, with the
+        lexical weights they were first found with.
+        """
+        inputFile.seek(0)
+        for line in inputFile:
+            weighted, freq = line.rsplit('\t', 1)
+            alString = weighted.rsplit('\t', 1)[0]
+            bucket = self.counts.setdefault(len(alString), {})
+            alHash = hash(alString)
+            alFreq = bucket.get(alHash)
+            if alFreq is None:
+                print >> self.weightedAlignmentFile, weighted
+                self.nbAlignments += 1
+                alFreq = 0
+            bucket[alHash] = alFreq + int(freq, 16)
 
 
     def align(self, lineIds, outputFile, weight=1):
@@ -1110,13 +4689,19 @@ class Aligner:
 
         1) Associate to each n-gram the list of lines it appears on.
         Then, n-grams that strictly appear on the same lines are
-        grouped together;
-        2) for each of these groups, we go through the lines they
-        appear on. For each line, we output the selected words in the
-        correct order, if the resulting alignment verifies the
-        filtering constraints. We also output the complementary on
+        grouped together, whatever their order n (see
+        _group_by_vector() and _group_by_signature());
+        2) for each of these groups (once per group), we go through the
+        lines they appear on. For each line, we output the selected
+        words in the correct order, if the resulting alignment verifies
+        the filtering constraints. We also output the complementary on
         each line if it verifies these constraints as well.
 
+        This is done by count_batch(), as a batch of one subcorpus (see
+        align_batch()). With "--engine numpy", subcorpora of at least
+        NUMPY_MIN_LINES lines are aligned by _align_numpy() instead, with
+        the same counts (new alignments are written in another order).
+
         Alignments written to <outputFile> have the same format as the
         original corpus. Abslolute frequencies are kept in memory
         (self.counts), using <weight> as unit. All words are written
@@ -1124,16 +4709,493 @@ class Aligner:
         
         """
         
+        self.align_batch([lineIds], outputFile, weight)
+
+
+    def align_batch(self, samples, outputFile, weight=1):
+        """Get all possible alignments from several subcorpora.
+
+        -- samples: iterable(iterable(int))
+            The line ids of each subcorpus (see align())
+        -- outputFile: file
+        -- weight: int
+            See align().
+
+        Random subcorpus sizes are mostly tiny (see main_distribution()),
+        so that per-call overhead dominates when they are aligned one by
+        one. Here, it is shared by the whole batch (see count_batch()),
+        and each distinct alignment is formatted and counted only once.
+        """
+        smallSamples = []
+        for lineIds in samples:
+            if self.engine != 'numpy' or self.sweep is not None or \
+               len(lineIds) < NUMPY_MIN_LINES or \
+               not self._align_numpy(lineIds, outputFile, weight):
+                smallSamples.append(lineIds)
+        for candidate, candidateWeight in \
+                self.count_batch(smallSamples, weight):
+            self._add_alignment(candidate, candidateWeight, outputFile)
+
+
+    def count_batch(self, samples, weight=1):
+        """Count the alignments of several subcorpora (see align()).
+
+        -- samples: iterable(iterable(int))
+        -- weight: int
+            See align_batch().
+
+        Return a list of tuples (candidate, weight), where candidates are
+        tuples of phrases (tuples of word ids, see _add_alignment()), and
+        weights are summed over all lines of all subcorpora they were found
+        on. Candidates are listed in the order they were first found, so
+        that new alignments are written in the same order as when
+        subcorpora are aligned one by one.
+        """
         corpus = self.corpus
-        languageRange = range(self.nbLanguages)
-        ngramRange = range(2, self.indexN + 1)
+        wordLanguages = self.wordLanguages
+        lineMultiplicity = self.lineMultiplicity
+        # Filters (tag, minLanguages, minSize, maxSize, contiguousFields)
+        if self.sweep is None:
+            filters = [(None, self.minLanguages, self.minSize, self.maxSize,
+                        self.contiguousFields)]
+        else:   # One per configuration, tagged (see set_sweep())
+            filters = [(tag,) + sweepFilter for tag, sweepFilter
+                       in zip(self.sweepTags, self.sweepFilters)]
+        minNbWords = min([f[1] + f[2] - 1 for f in filters])
+        minGroupLanguages = min([f[1] for f in filters])
+        maxGroupLanguages = max([f[1] for f in filters])
+        delimiter = self.delimiter
+        lineWeight = weight
+        # Scratch buffers shared by all lines of all subcorpora
+        perfect = [[] for _ in xrange(self.nbLanguages)]
+        context = [[] for _ in xrange(self.nbLanguages)]
+        updates = {}
+        updatesGet = updates.get
+        found = []      # Candidates, in the order they were first found
+
+        for lineIds in samples:
+            groups = None
+            if self.signatureGrouping and \
+               len(lineIds) >= SIGNATURE_MIN_LINES:
+                groups = self._group_by_signature(lineIds)
+            if groups is None:
+                groups = self._group_by_vector(lineIds)
+
+            # All n-gram orders are grouped together above, so that each
+            # group of words with the same apparition vector is processed
+            # once
+            for linesAp, wordSet in groups:
+                # Check if there are enough words
+                nbWords = len(wordSet)
+                if nbWords < minNbWords:
+                    continue
+
+                # Check if there are words in at least minLanguages
+                l = set()
+                for word in wordSet:
+                    l.add(wordLanguages[word])
+                    if len(l) == maxGroupLanguages:
+                        break
+                if len(l) < minGroupLanguages:
+                    continue
+                groupFilters = filters
+                if len(filters) > 1:
+                    groupFilters = [f for f in filters
+                                    if nbWords >= f[1] + f[2] - 1 and
+                                    len(l) >= f[1]]
+                    if not groupFilters:
+                        continue
+
+                for lineId in linesAp:
+                    if lineMultiplicity is not None:
+                        lineWeight = weight * lineMultiplicity[lineId]
+                    words = corpus[lineId]
+                    for phrase in perfect:
+                        del phrase[:]
+                    for phrase in context:
+                        del phrase[:]
+                    for wordPos, word in enumerate(words):
+                        if word in wordSet:
+                            perfect[wordLanguages[word]].append(wordPos)
+                        else:
+                            context[wordLanguages[word]].append(wordPos)
+
+                    for positions in (perfect, context):
+                        for tag, minLanguages, minSize, maxSize, \
+                            contiguousFields in groupFilters:
+                            candidate = []
+                            nbLanguages = 0
+                            for phrase, contiguous in zip(positions,
+                                                          contiguousFields):
+                                size = len(phrase)
+                                # Check for length and contiguity
+                                if not size or \
+                                   not minSize <= size <= maxSize or \
+                                   (contiguous and
+                                    phrase[-1] - phrase[0] != size - 1):
+                                    candidate.append(())
+                                    continue
+                                nbLanguages += 1
+                                if not delimiter:
+                                    candidate.append(tuple(
+                                        [words[wordPos]
+                                         for wordPos in phrase]))
+                                    continue
+                                prev = phrase[0]
+                                newPhrase = []
+                                for wordPos in phrase:
+                                    if wordPos != prev + 1 and newPhrase:
+                                        newPhrase.append(0)
+                                    newPhrase.append(words[wordPos])
+                                    prev = wordPos
+                                candidate.append(tuple(newPhrase))
+
+                            if nbLanguages < minLanguages:
+                                continue
+                            if tag is not None:
+                                candidate[0] = (tag,) + candidate[0]
+                            candidate = tuple(candidate)
+                            candidateWeight = updatesGet(candidate)
+                            if candidateWeight is None:
+                                found.append(candidate)
+                                updates[candidate] = lineWeight
+                            else:
+                                updates[candidate] = candidateWeight + \
+                                                     lineWeight
+        return [(candidate, updates[candidate]) for candidate in found]
+
+
+    def _add_alignment(self, candidate, weight, outputFile):
+        """Count an alignment, and output it if it is new.
+
+        -- candidate: sequence(sequence(int))
+            Word ids of the phrase in each language (0 for delimiters).
+        -- weight: int
+        -- outputFile: file
+            See align().
+        """
+        alString = '\t'.join([' '.join([self.allWords[w] for w in phrase])
+                              for phrase in candidate])
+        bucket = self.counts.setdefault(len(alString), {})
+        alHash = hash(alString)
+        alFreq = bucket.get(alHash)
+        if alFreq is None:
+            bucket[alHash] = weight
+            print >> outputFile, '\t'.join([' '.join([hex(w)[2:]
+                                                      for w in phrase])
+                                            for phrase in candidate])
+            self.nbAlignments += 1
+            if self.sampler is not None:
+                coverage = self.sampler.coverage
+                for phrase in candidate:
+                    for w in phrase:
+                        coverage[w] += 1
+        else:
+            bucket[alHash] = alFreq + weight
+
+
+    def _numpy_corpus(self):
+        """Return the subcorpus as NumPy arrays (see self.numpyCorpus).
+
+        Items are words and n-grams of every order (see "-i"), numbered
+        consecutively: words keep their ids, then n-grams of order n are
+        offset by the number of items of lower orders.
+
+        Return a dict with keys:
+        'tokens', 'tokenStarts': words of all lines, and start of each line
+        in 'tokens' (one more for the end);
+        'items', 'itemStarts': same for the distinct items of each line;
+        'itemOffsets': first item id of each order;
+        'ngramWords': for each order n > 1, array of shape (nb n-grams, n)
+        of the words of each n-gram;
+        'languages': language of each word id;
+        'multiplicity': copies of each line, or None.
+        """
+        if self.numpyCorpus is not None:
+            return self.numpyCorpus
+        int64 = numpy.int64
+
+        def flatten(lines, offset=0):
+            starts = numpy.zeros(len(lines) + 1, int64)
+            numpy.cumsum(numpy.fromiter((len(line) for line in lines), int64,
+                                        len(lines)), out=starts[1:])
+            flat = numpy.fromiter(chain.from_iterable(lines), int64,
+                                  starts[-1])
+            return flat + offset, starts
+
+        tokens, tokenStarts = flatten(self.corpus)
+        itemOffsets = [0]
+        nbItems = len(self.allWords)
+        items, itemStarts = [tokens], [tokenStarts]
+        ngramWords = []
+        for ngramCorpus, ngrams in zip(self.ngramCorpora, self.allNgrams):
+            itemOffsets.append(nbItems)
+            flat, starts = flatten(ngramCorpus, nbItems)
+            items.append(flat)
+            itemStarts.append(starts)
+            nbItems += len(ngrams)
+            ngramWords.append(numpy.array(ngrams, int64).reshape(
+                len(ngrams), len(itemOffsets)))
+        # Interleave the items of all orders, line by line
+        lengths = sum([numpy.diff(starts) for starts in itemStarts])
+        allStarts = numpy.zeros(len(self.corpus) + 1, int64)
+        numpy.cumsum(lengths, out=allStarts[1:])
+        allItems = numpy.empty(allStarts[-1], int64)
+        position = allStarts[:-1].copy()
+        for flat, starts in zip(items, itemStarts):
+            lineLengths = numpy.diff(starts)
+            allItems[numpy.repeat(position - starts[:-1], lineLengths) +
+                     numpy.arange(len(flat))] = flat
+            position += lineLengths
+        if self.lineMultiplicity is None:
+            multiplicity = None
+        else:
+            multiplicity = numpy.array(self.lineMultiplicity, int64)
+        self.numpyCorpus = {
+            'tokens': tokens, 'tokenStarts': tokenStarts,
+            'items': allItems, 'itemStarts': allStarts,
+            'itemOffsets': numpy.array(itemOffsets, int64),
+            'ngramWords': ngramWords,
+            'languages': numpy.array(self.wordLanguages, int64),
+            'multiplicity': multiplicity}
+        return self.numpyCorpus
+
+
+    def _align_numpy(self, lineIds, outputFile, weight):
+        """Same as align(), with array operations.
+
+        -- lineIds: iterable(int)
+        -- outputFile: file
+        -- weight: int
+            See align().
+
+        1) The distinct (item, line) pairs of the subcorpus are sorted by
+        item, so that the lines of each item are contiguous. Items with
+        the same number of lines and the same sum of hashed line ids are
+        grouped together, which is then checked line by line;
+        2) each line of each group makes a row, masked by whether its
+        words belong to the group (perfect candidate) or not (context
+        candidate). Phrase lengths, contiguity and number of languages
+        are checked per row, and remaining candidates are encoded as byte
+        strings (word ids, 0 for delimiters, -1 ends each language);
+        3) only distinct candidates are counted and output by
+        _add_alignment(), with the summed weight of their rows, in the
+        order of their byte strings rather than the order align() finds
+        them in. Alignments of equal frequency may thus be output in
+        another order.
+
+        Return False, without aligning, if two groups of lines had the
+        same hash (align() then groups them by apparition vectors).
+        """
+        arrays = self._numpy_corpus()
+        int64, uint64 = numpy.int64, numpy.uint64
+        arange, repeat, flatnonzero = numpy.arange, numpy.repeat, \
+                                      numpy.flatnonzero
+        nbWords = len(self.allWords)
+        nbLanguages = self.nbLanguages
+        languages = arrays['languages']
+
+        def gather(flat, starts, lines):
+            """Concatenate slices of <flat>, return it with row indices."""
+            lengths = starts[lines + 1] - starts[lines]
+            rowStarts = numpy.cumsum(lengths) - lengths
+            rows = repeat(arange(len(lines)), lengths)
+            return (flat[starts[lines][rows] - rowStarts[rows] +
+                         arange(len(rows))], rows, lengths)
+
+        def runs(keys):
+            """Return starts and lengths of runs of equal sorted keys."""
+            isStart = numpy.empty(len(keys), bool)
+            isStart[:1] = True
+            numpy.not_equal(keys[1:], keys[:-1], isStart[1:])
+            starts = flatnonzero(isStart)
+            return starts, numpy.diff(numpy.append(starts, len(keys)))
+
+        # 1) Group items by lines
+        lineIds = numpy.fromiter(lineIds, int64)
+        nbLines = len(lineIds)
+        items, lines, _ = gather(arrays['items'], arrays['itemStarts'],
+                                 lineIds)
+        pairs = numpy.unique(items * nbLines + lines)
+        if not len(pairs):
+            return True
+        items, lines = numpy.divmod(pairs, nbLines)
+        itemStarts, itemSizes = runs(items)
+        items = items[itemStarts]
+        # Order-independent hash of lines (splitmix64 finalizer)
+        mixed = lines.astype(uint64) + uint64(0x9E3779B97F4A7C15)
+        mixed ^= mixed >> uint64(30)
+        mixed *= uint64(0xBF58476D1CE4E5B9)
+        mixed ^= mixed >> uint64(27)
+        mixed *= uint64(0x94D049BB133111EB)
+        mixed ^= mixed >> uint64(31)
+        hashes = numpy.add.reduceat(mixed, itemStarts)
+        order = numpy.lexsort((hashes, itemSizes))
+        isStart = numpy.empty(len(order), bool)
+        isStart[:1] = True
+        isStart[1:] = (itemSizes[order[1:]] != itemSizes[order[:-1]]) | \
+                      (hashes[order[1:]] != hashes[order[:-1]])
+        itemGroups = numpy.empty(len(order), int64)
+        itemGroups[order] = numpy.cumsum(isStart) - 1
+        leaders = order[isStart]    # One item per group
+        pairItems = repeat(arange(len(items)), itemSizes)
+        leaderPairs = itemStarts[leaders[itemGroups]][pairItems] + \
+                      arange(len(lines)) - itemStarts[pairItems]
+        if not numpy.array_equal(lines[leaderPairs], lines):
+            return False
+
+        # Words of each group, with their languages
+        memberGroups, memberWords = [], []
+        for n, offset in enumerate(arrays['itemOffsets']):
+            if n == 0:
+                selected = flatnonzero(items < nbWords)
+                memberWords.append(items[selected])
+                memberGroups.append(itemGroups[selected])
+            else:
+                selected = flatnonzero((items >= offset) &
+                                       (items < offset + len(
+                                           arrays['ngramWords'][n-1])))
+                memberWords.append(arrays['ngramWords'][n-1][
+                    items[selected] - offset].ravel())
+                memberGroups.append(repeat(itemGroups[selected], n + 1))
+        nbGroups = len(leaders)
+        members = numpy.unique(numpy.concatenate(memberGroups) * nbWords +
+                               numpy.concatenate(memberWords))
+        memberGroups = members // nbWords
+        groupNbWords = numpy.bincount(memberGroups, minlength=nbGroups)
+        groupLanguages = numpy.unique(memberGroups * (nbLanguages + 1) +
+                                      languages[members % nbWords])
+        groupNbLanguages = numpy.bincount(groupLanguages //
+                                          (nbLanguages + 1),
+                                          minlength=nbGroups)
+        kept = flatnonzero(
+            (groupNbWords >= self.minLanguages + self.minSize - 1) &
+            (groupNbLanguages >= self.minLanguages))
+
+        # 2) Rows: one per line of each kept group
+        rowPairs, rowGroups, _ = gather(arange(len(lines)),
+                                        numpy.append(itemStarts, len(lines)),
+                                        leaders[kept])
+        rowGroups = kept[rowGroups]
+        rowLines = lines[rowPairs]
+        tokenStarts = arrays['tokenStarts']
+        rowTokens = numpy.cumsum(tokenStarts[lineIds[rowLines] + 1] -
+                                 tokenStarts[lineIds[rowLines]])
+        contiguous = numpy.array(self.contiguousFields, bool)
+        if arrays['multiplicity'] is None:
+            rowWeights = repeat(int64(weight), len(rowLines))
+        else:
+            rowWeights = weight * arrays['multiplicity'][lineIds[rowLines]]
+        candidates = {}     # {encoded candidate: weight}
+        chunkStart = 0
+        while chunkStart < len(rowLines):
+            chunkEnd = max(numpy.searchsorted(
+                rowTokens, rowTokens[chunkStart] + NUMPY_CHUNK_TOKENS),
+                chunkStart + 1)
+            chunkLines = lineIds[rowLines[chunkStart:chunkEnd]]
+            tokens, rows, rowLengths = gather(arrays['tokens'],
+                                              tokenStarts, chunkLines)
+            positions = arange(len(rows)) - \
+                        (numpy.cumsum(rowLengths) - rowLengths)[rows]
+            keys = rowGroups[chunkStart:chunkEnd][rows] * nbWords + tokens
+            found = numpy.minimum(numpy.searchsorted(members, keys),
+                                  len(members) - 1)
+            inGroup = members[found] == keys
+            nbRows = len(chunkLines)
+            for mask in (inGroup, ~inGroup):
+                # Candidate words, sorted by row, language and position
+                selected = flatnonzero(mask)
+                wordLanguages = languages[tokens[selected]]
+                selected = selected[numpy.argsort(
+                    rows[selected] * nbLanguages + wordLanguages,
+                    kind='mergesort')]
+                phraseKeys = rows[selected] * nbLanguages + \
+                             languages[tokens[selected]]
+                phraseStarts, phraseSizes = runs(phraseKeys)
+                phraseEnds = phraseStarts + phraseSizes - 1
+                phraseLanguages = phraseKeys[phraseStarts] % nbLanguages
+                validPhrases = (phraseSizes >= self.minSize) & \
+                               (phraseSizes <= self.maxSize) & \
+                               (~contiguous[phraseLanguages] |
+                                (positions[selected[phraseEnds]] -
+                                 positions[selected[phraseStarts]] ==
+                                 phraseSizes - 1))
+                phraseRows = phraseKeys[phraseStarts] // nbLanguages
+                validRows = numpy.bincount(phraseRows[validPhrases],
+                                           minlength=nbRows) >= \
+                            self.minLanguages
+                validPhrases &= validRows[phraseRows]
+                selected = selected[repeat(validPhrases, phraseSizes)]
+                if not len(selected):
+                    continue
+
+                # Encode candidates: words, delimiters and separators are
+                # sorted by row, language, then position
+                selectedRows = rows[selected]
+                values = [tokens[selected]]
+                valueRows = [selectedRows]
+                valueLanguages = [languages[tokens[selected]]]
+                valuePositions = [2 * positions[selected]]
+                if self.delimiter:
+                    gaps = 1 + flatnonzero(
+                        (selectedRows[1:] == selectedRows[:-1]) &
+                        (valueLanguages[0][1:] == valueLanguages[0][:-1]) &
+                        (positions[selected[1:]] !=
+                         positions[selected[:-1]] + 1))
+                    values.append(numpy.zeros(len(gaps), int64))
+                    valueRows.append(selectedRows[gaps])
+                    valueLanguages.append(valueLanguages[0][gaps])
+                    valuePositions.append(valuePositions[0][gaps] - 1)
+                validRowIds = flatnonzero(validRows)
+                values.append(numpy.repeat(int64(-1),
+                                           len(validRowIds) * nbLanguages))
+                valueRows.append(repeat(validRowIds, nbLanguages))
+                valueLanguages.append(numpy.tile(arange(nbLanguages),
+                                                 len(validRowIds)))
+                valuePositions.append(repeat(int64(2 * rowLengths.max()),
+                                             len(validRowIds) * nbLanguages))
+                valueRows = numpy.concatenate(valueRows)
+                order = numpy.lexsort((numpy.concatenate(valuePositions),
+                                       numpy.concatenate(valueLanguages),
+                                       valueRows))
+                encoded = numpy.concatenate(values)[order].tostring()
+                ends = numpy.cumsum(numpy.bincount(valueRows)[validRowIds]) \
+                       * 8
+                weights = rowWeights[chunkStart + validRowIds].tolist()
+                start = 0
+                for end, rowWeight in zip(ends.tolist(), weights):
+                    key = encoded[start:end]
+                    candidates[key] = candidates.get(key, 0) + rowWeight
+                    start = end
+            chunkStart = chunkEnd
+
+        # 3) Output distinct candidates
+        for key, candidateWeight in candidates.iteritems():
+            candidate = [[]]
+            for w in numpy.fromstring(key, int64).tolist()[:-1]:
+                if w == -1:
+                    candidate.append([])
+                else:
+                    candidate[-1].append(w)
+            self._add_alignment(candidate, candidateWeight, outputFile)
+        return True
+
+
+    def _group_by_vector(self, lineIds):
+        """Group n-grams that appear on the same lines.
 
+        -- lineIds: iterable(int)
+            See align().
+
+        Return an iterator over tuples (apparition vector, set of word
+        ids), where the apparition vector is the tuple of ids of lines
+        the words appear on.
+        """
+        corpus = self.corpus
         vec_word = {}   # {tuple(int): set(int)}
         vw_setdefault = vec_word.setdefault
         
         for n in xrange(1, self.indexN + 1):
-            
-            
             if n == 1:
                 word_ap = {}
                 wa_setdefault = word_ap.setdefault
@@ -1155,82 +5217,64 @@ class Aligner:
                 for ngram, linesAp in ngram_ap.iteritems():
                     vw_setdefault(tuple(linesAp), set()
                                   ).update(self.allNgrams[n-2][ngram])
+        return vec_word.iteritems()
 
-            # Above part was changed with new option "-i", rest is identical
-            
 
-            minNbWords = self.minLanguages + self.minSize - 1
-            for linesAp, wordSet in vec_word.iteritems():
-                # Check if there are enough words
-                if len(wordSet) < minNbWords:
-                    continue
-                
-                # Check if there are words in at least minLanguages
-                l = set()
-                for word in wordSet:
-                    l.add(self.wordLanguages[word])
-                    if len(l) == self.minLanguages:
-                        break
-                if len(l) < self.minLanguages:
-                    continue
+    def _group_by_signature(self, lineIds):
+        """Group n-grams that appear on the same lines, by signatures.
 
-                #wordSet = set(wordSet) # Now it is a a set already
-                
-                for lineId in linesAp:
-                    words = corpus[lineId]
-                    perfect = [[] for _ in languageRange]
-                    context = [[] for _ in languageRange]
-                    for wordPos, word in enumerate(words):
-                        l = self.wordLanguages[word]
-                        if word in wordSet:
-                            perfect[l].append(wordPos)
-                        else:
-                            context[l].append(wordPos)
-                            
-                    for candidate in (perfect, context):
-                        nbLanguages = 0
-                        for languageId, phrase in enumerate(candidate):
-                            # Check for contiguity
-                            if (self.contiguousFields[languageId] and phrase
-                                and phrase[-1] - phrase[0] != len(phrase) - 1):
-                                candidate[languageId] = []
-                            # Check for length
-                            elif not (self.minSize <= len(phrase)
-                                      <= self.maxSize):
-                                candidate[languageId] = []
-                            
-                            if candidate[languageId]:
-                                nbLanguages += 1
-                        
-                        if nbLanguages < self.minLanguages:
-                            continue
+        -- lineIds: iterable(int)
+            See align().
 
-                        for i, phrase in enumerate(candidate):
-                            prev = None
-                            newPhrase = []
-                            for wordPos in phrase:
-                                if self.delimiter and prev is not None and \
-                                   wordPos != prev + 1:
-                                    newPhrase.append(0)
-                                newPhrase.append(words[wordPos])
-                                prev = wordPos
-                            candidate[i] = newPhrase
-
-                        stringToPrint = '\t'.join([' '.join([hex(w)[2:]
-                                                             for w in phrase])
-                                                   for phrase in candidate])
-                        alString = '\t'.join([' '.join([self.allWords[w]
-                                                            for w in phrase])
-                                                  for phrase in candidate])
-                        bucket = self.counts.setdefault(len(alString), {})
-                        alHash = hash(alString)
-                        alFreq = bucket.get(alHash)
-                        if alFreq is None:
-                            bucket[alHash] = weight
-                            print >> outputFile, stringToPrint
-                            self.nbAlignments += 1
+        Same as _group_by_vector(), without building a tuple of line ids
+        for each n-gram: the lines each n-gram appears on are appended to
+        a typed array while scanning lines. N-grams are then grouped by a
+        64-bit signature of their array, hashed once from its raw bytes.
+        Arrays are compared only when signatures collide, and only the
+        array of the first n-gram of each group is kept.
+
+        Return an iterator over tuples (apparition vector, set of word
+        ids), or None if two different arrays have the same signature.
+        """
+        corpus = self.corpus
+        typecode = optimum_typecode(max(lineIds))
+        groups = {}     # {signature: (array(int), set(int))}
+        groupsGet = groups.get
+
+        for n in xrange(1, self.indexN + 1):
+            ngramLines = {}     # {n-gram: array(int)}
+            nlGet = ngramLines.get
+            if n == 1:
+                for lineId in lineIds:
+                    for word in corpus[lineId]:
+                        linesAp = nlGet(word)
+                        if linesAp is None:
+                            ngramLines[word] = array(typecode, [lineId])
+                        elif linesAp[-1] != lineId:
+                            linesAp.append(lineId)
+            else:
+                ngramCorpus = self.ngramCorpora[n-2]
+                for lineId in lineIds:
+                    for ngram in ngramCorpus[lineId]:
+                        linesAp = nlGet(ngram)
+                        if linesAp is None:
+                            ngramLines[ngram] = array(typecode, [lineId])
                         else:
-                            bucket[alHash] = alFreq + weight
+                            linesAp.append(lineId)
+            # Arrays are released as soon as they are grouped
+            while ngramLines:
+                ngram, linesAp = ngramLines.popitem()
+                signature = hash(linesAp.tostring())
+                group = groupsGet(signature)
+                if group is None:
+                    group = groups[signature] = linesAp, set()
+                elif group[0] != linesAp:
+                    return None     # Signature collision
+                if n == 1:
+                    group[1].add(ngram)
+                else:
+                    group[1].update(self.allNgrams[n-2][ngram])
+        return groups.itervalues()
 
 
     def _dummy_weight(self, inputFile):
@@ -1249,13 +5293,220 @@ class Aligner:
                                        for word in phrase.split()])
                              for phrase in line.split('\t', nbSplits)])
 
+    def _low_frequencies(self, inputFile):
+        """Spot alignments that will be filtered out by self.minFreq.
+
+        -- inputFile: file
+            See self.weightFunc. Read, then rewound.
+
+        Return an array of booleans (one per alignment of <inputFile>), or
+        None if frequencies are not final yet (see self.countsFinal). They
+        are never final when a state is saved: resumed alignments may pass
+        the threshold later on, and need their weights then.
+        """
+        if self.minFreq <= 1 or not self.countsFinal or \
+           self.stateDir is not None:
+            return None
+        nbSplits = self.nbLanguages - 1
+        threshold = self.minFreq * self.weightUnit - self.weightUnit // 2
+        lowFreq = array('B')
+        for line in inputFile:
+            alString = '\t'.join([' '.join([self.allWords[int(word, 16)]
+                                             for word in phrase.split()])
+                                   for phrase in line.split('\t', nbSplits)])
+            lowFreq.append(self.counts[len(alString)][hash(alString)]
+                           < threshold)
+        inputFile.seek(0)
+        return lowFreq
+
+    def _store_weight(self, inputFile):
+        """Replace word ids by original strings, with corpus-wide weights.
+
+        -- inputFile: file
+
+        Same as _lexical_weight(), but cooccurrences and word frequencies
+        are looked up in self.coocStore, which holds them for the whole
+        corpus, rather than computed on the subcorpus.
+        
+        """
+        lowFreq = self._low_frequencies(inputFile)
+        del self.corpus # We don't need it anymore
+        nbSplits = self.nbLanguages - 1
+        allWords = self.allWords
+        for lineNo, line in enumerate(inputFile):
+            alignment = [[int(word, 16) for word in phrase.split()]
+                         for phrase in line.split('\t', nbSplits)]
+            if lowFreq is not None and lowFreq[lineNo]:
+                lexWeights = '-'
+            else:   # Discontinuity delimiters (0) are left out
+                lexWeights = ' '.join(["%f" % lw for lw in
+                                       self.coocStore.lexical_weights(
+                                           [[allWords[word] for word in phrase
+                                             if word]
+                                            for phrase in alignment])])
+            print >> self.weightedAlignmentFile, "%s\t%s" % \
+                  ('\t'.join([' '.join([allWords[word] for word in phrase])
+                              for phrase in alignment]), lexWeights)
+
+    def _subcorpus_cooc(self, FH):
+        """Count cooccurrences of all words of the subcorpus.
+
+        -- FH: int
+            Id of the first hapax (see _lexical_weight()).
+
+        Lines of self.corpus are emptied. Return a CoocDB.
+        """
+        # Compute a maximum for progress percentage
+        lastLanguage = self.nbLanguages - 1
+        nbSourceWords = 0
+        for word in xrange(FH):
+            if self.wordLanguages[word] != lastLanguage:
+                nbSourceWords += 1
+
+        message("\rComputing word cooccurrences...\n")
+        nextPercentage = Progression(nbSourceWords).next
+        coocDb = CoocDB(FH)
+        # Modify corpus in place: remove a whole language, index its
+        # words, re-read corpus to compute how many times each of these
+        # words appear with words from all other languages. Do this until
+        # only one language remains.
+        for sourceLanguage in xrange(lastLanguage):
+            sourceAp = {}
+            for lineId, line in enumerate(self.corpus):
+                newLine = []
+                for word in line:
+                    if self.wordLanguages[word] == sourceLanguage:
+                        sourceAp.setdefault(word, []).append(lineId)
+                    else:
+                        newLine.append(word)
+                self.corpus[lineId] = newLine
+            
+            # Force the progress percentage to grow uniformly
+            sources = sourceAp.keys()
+            random.shuffle(sources)
+            self._count_cooc(coocDb, sources, sourceAp, nextPercentage)
+            del sourceAp
+        return coocDb
+
+    def _count_cooc(self, coocDb, sources, sourceAp, nextPercentage):
+        """Count cooccurrences of source words (see count_cooc_shard()).
+
+        -- coocDb: CoocDB
+            Counts are added to it.
+        -- sources: list(int)
+            Source word ids, in the order they are to be counted.
+        -- sourceAp: dict(int: list(int))
+            Line ids of each source word, in self.corpus.
+        -- nextPercentage: function
+            Progression.next of the cooccurrence counting.
+
+        Words are counted in this process, in about a hundred chunks for
+        progress, unless there are __jobs__ processes and at least
+        COOC_PARALLEL_WORDS words. Source words are then dealt into
+        shards. Worker processes inherit self.corpus and <sourceAp> when
+        forked, read-only, and send back the arrays of their shards,
+        which are stored into <coocDb>.
+        """
+        global __coocSources__
+        if __jobs__ <= 1 or len(sources) < COOC_PARALLEL_WORDS:
+            __coocSources__ = self.corpus, sourceAp, self.lineMultiplicity
+            chunkSize = max(len(sources) // 100, 1)
+            try:
+                for start in xrange(0, len(sources), chunkSize):
+                    chunk = sources[start:start + chunkSize]
+                    for sw_pairs_freqs in count_cooc_shard(chunk):
+                        coocDb.set(*sw_pairs_freqs)
+                    nextPercentage(len(chunk))
+            finally:
+                __coocSources__ = None
+            return
+        nbShards = COOC_SHARDS_PER_JOB * __jobs__
+        shards = [sources[i::nbShards] for i in xrange(nbShards)]
+        __coocSources__ = self.corpus, sourceAp, self.lineMultiplicity
+        try:
+            pool = multiprocessing.Pool(__jobs__)
+        finally:
+            __coocSources__ = None
+        try:
+            for i, shard in enumerate(pool.imap(count_cooc_shard, shards)):
+                for sw_pairs_freqs in shard:
+                    coocDb.set(*sw_pairs_freqs)
+                nextPercentage(len(shards[i]))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _demand_cooc(self, inputFile, FH):
+        """Count cooccurrences of the word pairs found in alignments only.
+
+        -- inputFile: file
+            See self.weightFunc. Read, then rewound.
+        -- FH: int
+            Id of the first hapax (see _lexical_weight()).
+
+        Only pairs of words (not hapaxes) appearing in the same alignment
+        are ever looked up. They are collected first, then counted in a
+        single scan of the subcorpus. Return a CoocDB.
+        """
+        message("\rCollecting word pairs of alignments...\n")
+        nbSplits = self.nbLanguages - 1
+        required = {}   # {source word: set(target words)}
+        for line in inputFile:
+            alignment = [[word for word in [int(w, 16) for w in phrase.split()]
+                          if 0 < word < FH]   # Not delimiters nor hapaxes
+                         for phrase in line.split('\t', nbSplits)]
+            for srcLang, sourcePhrase in enumerate(alignment):
+                targets = [tw for target in alignment[srcLang+1:]
+                           for tw in target]
+                if not targets:
+                    continue
+                for sw in sourcePhrase:
+                    targetSet = required.get(sw)
+                    if targetSet is None:
+                        required[sw] = set(targets)
+                    else:
+                        targetSet.update(targets)
+        inputFile.seek(0)
+
+        message("\rComputing word cooccurrences...\n")
+        nextPercentage = Progression(max(len(self.corpus), 1)).next
+        coocs = dict([(sw, {}) for sw in required])
+        for lineId, line in enumerate(self.corpus):
+            if self.lineMultiplicity is None:
+                nbCopies = 1
+            else:
+                nbCopies = self.lineMultiplicity[lineId]
+            lineWords = set(line)
+            for sw in line:
+                targetSet = required.get(sw)
+                if targetSet is not None:
+                    cooc = coocs[sw]
+                    for tw in targetSet.intersection(lineWords):
+                        cooc[tw] = cooc.get(tw, 0) + nbCopies
+            nextPercentage()
+        del required
+        coocDb = CoocDB(FH)
+        for sw, cooc in coocs.iteritems():
+            if cooc:
+                coocDb.add(sw, cooc)
+        return coocDb
+
     def _lexical_weight(self, inputFile):
         """Compute lexical weights and replace word ids by original strings.
 
         -- inputFile: file
+
+        If frequencies are final (see _low_frequencies()), alignments less
+        frequent than self.minFreq get a dash instead of lexical weights,
+        since they will be filtered out of the output.
         
         """
         FH = len(self.wordFreq) - self.wordFreq.count(1)    # First Hapax
+        nbSplits = self.nbLanguages - 1
+
+        # Spot alignments to be filtered out before counts are dumped
+        lowFreq = self._low_frequencies(inputFile)
 
         # Make all words appear at most once on all lines and remove hapaxes:
         # since they occur only once, there is no need to remember how many
@@ -1263,13 +5514,6 @@ class Aligner:
         for lineId, line in enumerate(self.corpus):
             self.corpus[lineId] = [word for word in set(line) if word < FH]
 
-        # Compute a maximum for progress percentage
-        lastLanguage = self.nbLanguages - 1
-        nbSourceWords = 0
-        for word in xrange(FH):
-            if self.wordLanguages[word] != lastLanguage:
-                nbSourceWords += 1
-
         # Dump alignment counts into temporary file to save memory
         dictFile = make_temp_file(".dict.gz")
         zDictFile = gzip.GzipFile(fileobj=dictFile, mode="wb", compresslevel=1)
@@ -1281,53 +5525,34 @@ class Aligner:
             zDictFile.close()
             self.counts.clear()
             
-            message("\rComputing word cooccurrences...\n")
-            nextPercentage = Progression(nbSourceWords).next
-            coocDb = CoocDB(FH)
-            # Modify corpus in place: remove a whole language, index its
-            # words, re-read corpus to compute how many times each of these
-            # words appear with words from all other languages. Do this until
-            # only one language remains.
-            for sourceLanguage in xrange(lastLanguage):
-                sourceAp = {}
-                for lineId, line in enumerate(self.corpus):
-                    newLine = []
-                    for word in line:
-                        if self.wordLanguages[word] == sourceLanguage:
-                            sourceAp.setdefault(word, []).append(lineId)
-                        else:
-                            newLine.append(word)
-                    self.corpus[lineId] = newLine
-                
-                # Force the progress percentage to grow uniformly
-                sources = sourceAp.keys()
-                random.shuffle(sources)
-                for sw in sources:
-                    cooc = {}
-                    for lineId in sourceAp[sw]:
-                        for tw in self.corpus[lineId]:
-                            cooc[tw] = cooc.get(tw, 0) + 1
-                    if cooc:
-                        coocDb.add(sw, cooc)
-                    nextPercentage()
-                del sourceAp
+            if self.demandCooc:
+                coocDb = self._demand_cooc(inputFile, FH)
+            else:
+                coocDb = self._subcorpus_cooc(FH)
+            self.note_rss()
             
             del self.corpus
 
             message("\rComputing lexical weights...\n")
             nextPercentage = Progression(self.nbAlignments).next
-            nbSplits = self.nbLanguages - 1
 
-            for line in inputFile:
+            for lineNo, line in enumerate(inputFile):
                 alignment0 = [[int(word, 16) for word in phrase.split()]
                               for phrase in line.split('\t', nbSplits)]
+                if lowFreq is not None and lowFreq[lineNo]:
+                    print >> self.weightedAlignmentFile, "%s\t-" % \
+                          '\t'.join([' '.join([self.allWords[word]
+                                               for word in phrase])
+                                     for phrase in alignment0])
+                    nextPercentage()
+                    continue
                 # Copy of alignment0 without discontinuity separator
                 alignment = [[word for word in phrase if word]
                              for phrase in alignment0]
 
                 # Get a local copy of word cooccurrences, including hapaxes
                 cooc = {}
-                for srcLang in xrange(lastLanguage):
+                for srcLang in xrange(nbSplits):
                     targets = alignment[srcLang+1:]
                     for sw in alignment[srcLang]:
                         c = cooc.setdefault(sw, {})
@@ -1420,12 +5645,26 @@ ALIGNMENT_FILES is the concatenation of several ALIGNMENT_FILE's.''')
                       help="""Do not align. Input files are
 pre-generated alignment files (plain text format) to be merged into a
 single alignment file.""")
+    parser.add_option('--serve', dest='address', default=None,
+                      help="""Do not align. Load alignment files
+(plain text format) or an index (see --index), and answer phrase
+lookups over HTTP on ADDRESS ("[host:]port") until interrupted. POST
+/lookup with a JSON object {"phrases": [...], "language": int, "k":
+int}; GET /stats for latency percentiles.""")
+    parser.add_option('--cache-size', dest='cache_size', type='int',
+                      default=100000, help="""(compatible with --serve)
+Number of lookup results kept in cache. [default: %default]""")
     parser.add_option('-T', '--temp-dir', dest='dir', default=None,
                       help="""(compatible with -m) Where to write
 temporary files. Default is OS dependant.""")
     parser.add_option('-q', '--quiet', default=False, action='store_true',
                       help="""(compatible with -m) Do not show
                       progress information on standard error.""")
+    parser.add_option('-j', '--jobs', dest='nb_jobs', type='int', default=1,
+                      help="""(compatible with -m) Number of threads
+used to compress .gz output (see -O), and of processes used to index
+uncompressed input files, to format output and to count word
+cooccurrences (see -w). [default: %default]""")
 
     alterGroup = optparse.OptionGroup(parser,
                                       "Options to alter alignment behaviour")
@@ -1433,6 +5672,47 @@ temporary files. Default is OS dependant.""")
                       default=-1, help="""Stop alignment when number of
 new alignments per second is lower than NB_AL. Specify -1 to run
 indefinitely. [default: %default]""")
+    alterGroup.add_option('-c', '--convergence', dest='tolerance',
+                          type='float', default=None, help="""Stop
+alignment when the relative frequencies of the CONVERGENCE_TOP most
+frequent alignments change by less than TOLERANCE (total variation
+distance, between 0 and 1) between two checks. Checks are made every
+%i seconds at least.""" % CONVERGENCE_CHECK_INTERVAL)
+    alterGroup.add_option('--convergence-top', dest='top_k', type='int',
+                          default=1000, help="""Number of most frequent
+alignments compared by -c. [default: %default]""")
+    alterGroup.add_option('--coverage-sampling', dest='coverage',
+                          default=False, action='store_true',
+                          help="""Draw subcorpora around lines containing
+words found in few alignments so far, to cover rare words faster.
+Frequencies are corrected with importance weights so that translation
+probabilities remain unbiased.""")
+    alterGroup.add_option('-u', '--collapse-duplicates', dest='collapse',
+                          default=False, action='store_true',
+                          help="""Load identical input lines only once,
+and count their alignments and word frequencies as many times as they
+occur. Saves memory and time on corpora with many duplicates. Results
+differ from those of the uncollapsed corpus: subcorpora are drawn among
+distinct lines, so that copies of a line never appear in the same
+subcorpus, and frequencies only match on average.""")
+    alterGroup.add_option('--signature-grouping', dest='signatures',
+                          default=False, action='store_true',
+                          help="""Group words appearing on the same lines
+of subcorpora of at least %i lines by 64-bit signatures of their lines
+rather than by tuples of lines, keeping lines in typed arrays. This uses
+less memory and time on large subcorpora (see -S). Results are the
+same.""" % SIGNATURE_MIN_LINES)
+    alterGroup.add_option('--engine', dest='engine', default='python',
+                          help="""Alignment engine: "python" or "numpy".
+The NumPy engine (requires NumPy) aligns subcorpora of at least %i lines
+with array operations, and gives the same counts (alignments of equal
+frequency may be output in another order). [default: %%default]"""
+                          % NUMPY_MIN_LINES)
+    alterGroup.add_option('--seed', dest='seed', type='int', default=None,
+                          help="""Seed of the random generator used to
+sample subcorpora, so that they are drawn in the same order. How many of
+them are aligned still depends on speed (-t, -a and -c all depend on
+timing), so that outputs of two runs may differ.""")
     alterGroup.add_option('-i', '--index-ngrams', dest='index_n', type='int',
                       default=1, help="""Consider n-grams up to
 n=INDEX_N as tokens. Increasing this value increases the number of
@@ -1442,6 +5722,44 @@ memory [default: %default]""")
                           type='int', help="""Maximum number of
 sentences (i.e. input lines) to be loaded in memory at once. Specify 0
 for all-in-memory. [default: %default]""")
+    alterGroup.add_option('--memory-limit', dest='memory_mb', type='int',
+                          default=None, help="""Choose the number of
+sentences loaded in memory at once (see -S) so that the process uses at
+most about MEMORY_MB megabytes. Sizes are estimated from a sample of the
+input, then adapted to the memory actually used by each subcorpus, and
+are never less than %i lines. With --adaptive, the first estimate is
+used for all subcorpora.""" % MEMORY_MIN_LINES)
+    alterGroup.add_option('--parallel-subcorpora', dest='parallel',
+                          type='int', default=1, help="""Number of
+subcorpora (see -S) aligned at the same time, in as many processes. Each
+one still gets its share of -t, so that the total time is divided by
+about PARALLEL, but memory use is multiplied by as much. Not compatible
+with --adaptive and --memory-limit. [default: %default]""")
+    alterGroup.add_option('--pipeline-weights', dest='pipeline',
+                          default=False, action='store_true',
+                          help="""With -w and -S, compute lexical weights
+of each subcorpus in a child process, while the next subcorpus is being
+aligned. Two subcorpora are then in memory at once. Not compatible with
+--memory-limit.""")
+    alterGroup.add_option('--state', dest='state_dir', default=None,
+                          help="""Save alignment counts and the index of
+input lines into directory STATE_DIR. If STATE_DIR already holds the
+state of a previous run on the same input files, lines appended to them
+since then are aligned (along with some old lines, see --mix-ratio), and
+their alignments are added to the previous ones before computing
+probabilities, instead of aligning the whole corpus again.""")
+    alterGroup.add_option('--mix-ratio', dest='mix_ratio', type='float',
+                          default=0.5, help="""With --state, number of
+old lines, randomly chosen, aligned along with each new line, so that
+subcorpora mix old and new data. Alignments found again in old lines
+add up to their previous frequency. [default: %default]""")
+    alterGroup.add_option('--adaptive', default=False, action='store_true',
+                          help="""With -S and -t, share the timeout
+among subcorpora according to their productivity rather than evenly:
+each subcorpus is first given half of its even share, then the
+remaining time goes to subcorpora in proportion to their final rate of
+new alignments per second. Time left unused by subcorpora that stop
+early (-a, -c) goes to the others.""")
     alterGroup.add_option('-t', '--timeout', dest='nb_sec', type='float',
                           default=-1, help="""Stop alignment after
 NB_SEC seconds elapsed. Specify -1 to run indefinitely. [default:
@@ -1449,6 +5767,19 @@ NB_SEC seconds elapsed. Specify -1 to run indefinitely. [default:
     alterGroup.add_option('-w', '--weight', default=False, action='store_true',
                       help="""Compute lexical weights (requires
 additional computation time and memory).""")
+    alterGroup.add_option('--cooc-store', dest='cooc_store', default=None,
+                          help="""With -w, compute lexical weights from
+word cooccurrences of the whole input rather than of each subcorpus,
+looked up in file COOC_STORE. It is built in one pass over the input if
+it does not exist, and rebuilt if it was built from another input (other
+number of lines, size or modification time). With -m, lexical
+weights of merged alignments are recomputed from it.""")
+    alterGroup.add_option('--demand-cooc', dest='demand', default=False,
+                          action='store_true', help="""With -w, count
+word cooccurrences only for the word pairs found in alignments of each
+subcorpus, collected beforehand, in a single pass over the subcorpus.
+Faster when alignments cover few of all possible pairs. Not compatible
+with --cooc-store.""")
     parser.add_option_group(alterGroup)
 
     filteringGroup = optparse.OptionGroup(parser, "Filtering options")
@@ -1470,6 +5801,31 @@ alignment that contains an N-gram with N < MIN_N. [default:
                               default=7, help="""Filter out any
 alignment that contains an N-gram with N > MAX_N (0 for no
 limit). [default: %default]""")
+    filteringGroup.add_option('--min-freq', dest='min_freq', type='int',
+                              default=1, help="""(compatible with -m)
+Filter out any alignment found less than MIN_FREQ times. These
+alignments are neither sorted nor output, and their lexical weights are
+not computed when possible (see -w). Translation probabilities of other
+alignments are unchanged. [default: %default]""")
+    filteringGroup.add_option('--min-proba', dest='min_proba', type='float',
+                              default=0., help="""(compatible with -m)
+Filter out any alignment whose translation probabilities are all lower
+than MIN_PROBA. Translation probabilities of other alignments are
+unchanged. [default: %default]""")
+    filteringGroup.add_option('--top-k-per-phrase', dest='top_phrase',
+                              type='int', default=0, help="""(compatible
+with -m) Keep only the TOP_PHRASE most frequent alignments of each phrase
+in the first language (0 for all). Translation probabilities are
+unchanged. [default: %default]""")
+    filteringGroup.add_option('--sweep', dest='sweep', default=None,
+                              help="""Output one table per filter
+configuration in SWEEP, all counted from the same random subcorpora, a
+semicolon-separated list of configurations made of -D, -l, -n and -N
+options (e.g. "-N 3; -n 2 -N 7 -D 1"). Options left out keep their
+command line values. Tables are written into OUTPUT (see -O), with the
+configuration number (1-based) appended, before the compression
+extension if any (e.g. "table.txt.2", "table.txt.2.gz"). -a and
+--coverage-sampling consider alignments of all tables together.""")
     parser.add_option_group(filteringGroup)
 
     formattingGroup = optparse.OptionGroup(parser, "Output formatting options")
@@ -1492,6 +5848,42 @@ headers) and TMX (<xml:lang>) output formats (see -o option).""")
                                help="""(compatible with -m) Output
 format. Possible values are "plain", "moses", "html", and "tmx".
 [default: %default]""")
+    formattingGroup.add_option('-O', '--output-file', dest='output',
+                               default=None, help="""(compatible with
+-m) Write alignments into OUTPUT rather than standard output. OUTPUT is
+compressed on the fly if its name ends with .gz or .bz2 (see -j).""")
+    formattingGroup.add_option('--sort', default=False, action='store_true',
+                               help="""(compatible with -m) Sort output
+by source phrase (first language) rather than by frequency, as Moses
+tools require before binarizing, in bounded memory (see
+--sort-buffer). Requires "plain" or "moses" output format. See also
+--index for a binary lookup form.""")
+    formattingGroup.add_option('--sort-buffer', dest='sort_mb', type='int',
+                               default=256, help="""(compatible with -m)
+Megabytes of output sorted in memory at once with --sort; larger
+outputs are sorted by runs spilled into temporary files. [default:
+%default]""")
+    formattingGroup.add_option('--index', dest='index', default=None,
+                               help="""(compatible with -m) Also write
+alignments into INDEX, sorted by phrase in each language, so that
+alignments of a given phrase can be looked up without loading the whole
+table (see PhraseIndex class).""")
+    formattingGroup.add_option('--shards', dest='nb_shards', type='int',
+                               default=1, help="""(compatible with -m)
+Split output into NB_SHARDS files, numbered from 0, that can be read in
+parallel. Alignments are dealt to shards in turn, so that each shard
+remains sorted by frequency. Requires -O, and "plain" or "moses" output
+format. [default: %default]""")
+    formattingGroup.add_option('--pairs', dest='pairs', default=None,
+                               help="""(compatible with -m) Rather than
+multilingual alignments, output one bilingual table per pair of languages
+in PAIRS, projected from the multilingual alignments, with translation
+probabilities normalized within each pair. PAIRS is "all", or a
+comma-separated list of pairs of field numbers joined by a dash (e.g.
+"1-2,1-3"). Tables are written into OUTPUT (see -O), with the pair
+inserted before the extension, using languages of -L if specified (e.g.
+"table.en-fr.gz"). Use -l to also get alignments missing some languages.
+Lexical weights are not projected.""")
     parser.add_option_group(formattingGroup)
 
     options, args = parser.parse_args()
@@ -1501,26 +5893,24 @@ format. Possible values are "plain", "moses", "html", and "tmx".
     if not args:    # Read standard input
         args = ["-"]
 
-    global __verbose__, __tmpDir__
+    global __verbose__, __tmpDir__, __jobs__
     __verbose__, __tmpDir__ = not options.quiet, options.dir
+    __jobs__ = max(options.nb_jobs, 1)
     if 'psyco' in globals():
         message("Using psyco module\n")
 
-    format = options.format.lower()
-    if "plain".startswith(format):
-        writer = PlainWriter(sys.stdout)
-    elif "moses".startswith(format):
-        writer = MosesWriter(sys.stdout)
-    elif "html".startswith(format):
-        writer = HTMLWriter(sys.stdout, options.encoding, options.lang)
-    elif "tmx".startswith(format):
-        writer = TMXWriter(sys.stdout, options.encoding, options.lang)
-    else:
-        parser.error("Unknown output format for option -o")
+    if options.address is not None:
+        if options.merge:
+            parser.error("--serve and -m options are mutually exclusive")
+        try:
+            parse_address(options.address)
+        except ValueError:
+            parser.error("Invalid address for option --serve")
+        serve(args, options.address, options.cache_size, options.encoding)
+        return
 
-    if options.merge:
-        merge(args, writer)
-    else:
+    sweep = None
+    if not options.merge:
         try:    # Check whether the -D option value is well formed
             parse_field_numbers(options.fields, 0)
         except ValueError:
@@ -1531,13 +5921,214 @@ format. Possible values are "plain", "moses", "html", and "tmx".
             options.max_n = sys.maxint
         if options.index_n < 1:
             parser.error("-i option must be positive")
-        if options.index_n > options.max_n:
+        if options.sweep is not None:
+            try:
+                sweep = []
+                for config in parse_sweep(options.sweep):
+                    fields = config.get('D', options.fields)
+                    parse_field_numbers(fields, 0)
+                    if 'l' in config:
+                        minLanguages = int(config['l'])
+                    else:
+                        minLanguages = options.nb_lang
+                    maxSize = int(config.get('N', options.max_n))
+                    if maxSize <= 0:
+                        maxSize = sys.maxint
+                    sweep.append(FilterConfig(
+                        fields, minLanguages,
+                        int(config.get('n', options.min_n)), maxSize))
+            except ValueError:
+                parser.error("Invalid configuration list for option --sweep")
+            for configNo, config in enumerate(sweep):
+                if options.index_n > config.maxSize:
+                    parser.error("-i option value should not be greater "
+                                 "than that of -N in configuration %i of "
+                                 "--sweep" % (configNo + 1))
+            if options.output is None:
+                parser.error("--sweep option requires -O")
+            if options.weight or options.pairs is not None or \
+               options.nb_shards > 1 or options.index is not None or \
+               options.state_dir is not None:
+                parser.error("--sweep option cannot be used with -w, "
+                             "--pairs, --shards, --index or --state-dir")
+        if sweep is None and options.index_n > options.max_n:
             parser.error(
                 "-i option value should not be greater than that of -N")
-        
-        Aligner(args, writer, options.nb_al, options.nb_sent, options.nb_sec,
-                options.weight, options.fields, options.nb_lang, options.min_n,
-                options.max_n, options.delim, options.index_n)
+        if options.top_k < 1:
+            parser.error("--convergence-top option must be positive")
+        if options.memory_mb is not None:
+            if options.memory_mb < 1:
+                parser.error("--memory-limit option must be positive")
+            if options.nb_sent:
+                parser.error("-S and --memory-limit options are mutually "
+                             "exclusive")
+            options.memory_mb <<= 20
+        if options.state_dir is not None:
+            if "-" in args:
+                parser.error("--state option cannot be used with standard "
+                             "input")
+            if options.collapse:
+                parser.error("--state and -u options are mutually exclusive")
+        if options.mix_ratio < 0:
+            parser.error("--mix-ratio option must not be negative")
+        if options.parallel < 1:
+            parser.error("--parallel-subcorpora option must be positive")
+        if options.parallel > 1 and (options.adaptive or
+                                     options.memory_mb is not None):
+            parser.error("--parallel-subcorpora option cannot be used with "
+                         "--adaptive or --memory-limit")
+        if options.pipeline and options.memory_mb is not None:
+            parser.error("--pipeline-weights and --memory-limit options are "
+                         "mutually exclusive")
+        if options.cooc_store is not None and not options.weight:
+            parser.error("--cooc-store option requires -w")
+        if options.cooc_store is not None and \
+           os.path.exists(options.cooc_store):
+            try:
+                if not is_cooc_store(options.cooc_store):
+                    parser.error("Invalid cooccurrence store for option "
+                                 "--cooc-store: %s is not a cooccurrence "
+                                 "store" % options.cooc_store)
+            except IOError, e:
+                parser.error("Invalid cooccurrence store for option "
+                             "--cooc-store: %s" % e)
+        if options.demand and not options.weight:
+            parser.error("--demand-cooc option requires -w")
+        if options.demand and options.cooc_store is not None:
+            parser.error("--demand-cooc and --cooc-store options are "
+                         "mutually exclusive")
+        if options.engine not in ('python', 'numpy'):
+            parser.error("Unknown engine for option --engine")
+        if options.engine == 'numpy' and numpy is None:
+            parser.error("--engine numpy requires the numpy module")
+        if options.seed is not None:
+            random.seed(options.seed)
+
+    if options.min_freq < 1:
+        parser.error("--min-freq option must be positive")
+    if options.top_phrase < 0:
+        parser.error("--top-k-per-phrase option must not be negative")
+    minFreq, minProba, topK = \
+             options.min_freq, options.min_proba, options.top_phrase
+    if options.pairs is not None:  # Filters apply to pair tables instead
+        minFreq, minProba, topK = 1, 0., 0
+
+    for format in ("plain", "moses", "html", "tmx"):
+        if format.startswith(options.format.lower()):
+            break
+    else:
+        parser.error("Unknown output format for option -o")
+    if options.sort and format not in ("plain", "moses"):
+        parser.error('--sort option requires "plain" or "moses" output '
+                     'format')
+    if options.sort_mb < 1:
+        parser.error("--sort-buffer option must be positive")
+    if options.nb_shards < 1:
+        parser.error("--shards option must be positive")
+    if options.pairs is not None:
+        try:
+            pairs = parse_pairs(options.pairs)
+        except ValueError:
+            parser.error("Invalid pair list for option --pairs")
+        if options.output is None:
+            parser.error("--pairs option requires -O")
+        if options.nb_shards > 1 or options.index is not None:
+            parser.error("--pairs option cannot be used with --shards or "
+                         "--index")
+    if options.nb_shards > 1:
+        if options.output is None:
+            parser.error("--shards option requires -O")
+        if format not in ("plain", "moses"):
+            parser.error('--shards option requires "plain" or "moses" '
+                         'output format')
+        outputFile = ShardedOutput(
+            [open_output(f, __jobs__)
+             for f in shard_filenames(options.output, options.nb_shards)])
+    elif options.output is not None and options.pairs is None and \
+         sweep is None:
+        outputFile = open_output(options.output, __jobs__)
+    else:
+        outputFile = sys.stdout
+
+    if options.index is not None:
+        index = PhraseIndexBuilder(options.index)
+    else:
+        index = None
+
+    coocStore = None
+    if options.merge and options.cooc_store is not None:
+        try:
+            coocStore = CoocStore(options.cooc_store)
+        except (IOError, ValueError), e:
+            parser.error("Invalid cooccurrence store for option "
+                         "--cooc-store: %s" % e)
+
+    def make_writer(outputFile, languages):
+        if format == "plain":
+            writer = PlainWriter(outputFile)
+        elif format == "moses":
+            writer = MosesWriter(outputFile)
+        elif format == "html":
+            writer = HTMLWriter(outputFile, options.encoding, languages)
+        else:
+            writer = TMXWriter(outputFile, options.encoding, languages)
+        if options.sort:
+            writer = SortingWriter(writer, options.sort_mb << 20)
+        return writer
+
+    sweepFiles = []
+    pairFiles = []
+    def make_pair_writer(source, target):
+        if options.lang is None:
+            languages = None
+            names = (source + 1, target + 1)
+        else:
+            languageList = options.lang.split(',')
+            assert max(source, target) < len(languageList), \
+                   "Not enough languages for option -L"
+            names = (languageList[source], languageList[target])
+            languages = "%s,%s" % names
+        pairFile = open_output(suffixed_filenames(options.output,
+                                                  ["%s-%s" % names])[0],
+                               __jobs__)
+        pairFiles.append(pairFile)
+        return make_writer(pairFile, languages)
+
+    try:
+        if sweep is not None:
+            sweepFiles = [open_output(f, __jobs__)
+                          for f in suffixed_filenames(
+                              options.output, [str(configNo + 1) for configNo
+                                               in xrange(len(sweep))])]
+            writer = [make_writer(f, options.lang) for f in sweepFiles]
+        elif options.pairs is None:
+            writer = make_writer(outputFile, options.lang)
+        else:
+            writer = PairWriter(pairs, make_pair_writer, options.min_freq,
+                                options.min_proba, options.top_phrase)
+
+        if options.merge:
+            merge(args, writer, index, minFreq, minProba, topK, coocStore)
+        else:
+            Aligner(args, writer, options.nb_al, options.nb_sent,
+                    options.nb_sec, options.weight, options.fields,
+                    options.nb_lang, options.min_n, options.max_n,
+                    options.delim, options.index_n, index,
+                    options.tolerance, options.top_k, options.adaptive,
+                    options.coverage, options.collapse, options.memory_mb,
+                    options.state_dir, options.mix_ratio, minFreq, minProba,
+                    topK, options.signatures, options.engine,
+                    options.parallel, options.pipeline, options.cooc_store,
+                    options.demand, sweep)
+        if index is not None:
+            index.close()
+    finally:
+        if outputFile is not sys.stdout:
+            outputFile.close()
+        for f in pairFiles + sweepFiles:
+            f.close()
+        if coocStore is not None:
+            coocStore.close()
 
 
 if __name__ == '__main__':